@@ -8,19 +8,30 @@ import os
 import re
 import geopandas as gpd
 from shapely.geometry import Point
-from collections import defaultdict
+from scipy.spatial import cKDTree
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
 import us
 import numpy as np
 import netCDF4
 from datetime import date, timedelta
 import time
 import glob
+import json
+import hashlib
 import traceback
+import zipfile
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
 import dask
 import dateparser
 import xarray as xr
 import bottleneck # rolling window aggregations are faster and use less memory when bottleneck is installed http://xarray.pydata.org/en/stable/computation.html#rolling-window-operations
-import cPickle as pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import rpy2
 import feather
 from rpy2 import robjects
@@ -29,6 +40,7 @@ pandas2ri.activate()
 
 #Custom functions
 from Download_gist import *
+from HMStoDF import filelisthash
 
 #Set up paths
 rootdir = 'D:/Mathis/ICSL/stormwater'
@@ -40,17 +52,25 @@ if not os.path.isdir(NARRdir):
 NARRoutdir = os.path.join(rootdir, 'results/NARR')
 if not os.path.isdir(NARRoutdir):
     os.mkdir(NARRoutdir)
+#Compute derived meteorological variables only at station cells rather than over the entire NARR grid (see stationseries)
+narrstationmode = True
+#Copies of raw NARR files chunked in time-contiguous spatial tiles, read in place of the raw files (see narr_rechunk)
+NARRrechunkdir = os.path.join(rootdir, 'results/NARR_rechunked')
+#Rechunking reads and rewrites every raw file once, which only pays off if station series are extracted repeatedly
+#(e.g. for new stations). Off by default, an existing store is used either way
+narrrechunk = False
+dlcachedir = os.path.join(rootdir, 'data/dlcache') #Download cache shared across scripts
 
 #Import variables
 monitortab = os.path.join(AQIdir, 'aqs_monitors.csv')
 sitetab = os.path.join(AQIdir, 'aqs_sites.csv')
 if not os.path.exists(monitortab):
     print('Monitor tab does not exist...')
-    dlfile('https://aqs.epa.gov/aqsweb/airdata/aqs_monitors.zip', AQIdir)
+    dlfile('https://aqs.epa.gov/aqsweb/airdata/aqs_monitors.zip', AQIdir, cachedir=dlcachedir)
 monitors = pd.read_csv(monitortab)
 if not os.path.exists(sitetab):
     print('Site tab does not exist...')
-    dlfile('https://aqs.epa.gov/aqsweb/airdata/aqs_sites.zip', AQIdir)
+    dlfile('https://aqs.epa.gov/aqsweb/airdata/aqs_sites.zip', AQIdir, cachedir=dlcachedir)
 sites = pd.read_csv(sitetab)
 NLCD_imp = os.path.join(rootdir, 'data/NLCD_2016_Impervious_L48_20190405.img') #Based on 2016 data
 cs_ref = arcpy.Describe(NLCD_imp).SpatialReference
@@ -69,7 +89,8 @@ sites_smokejoin = os.path.join(AQIgdb, 'sitessmokejoin')
 sites_smokejointab = os.path.join(AQIgdb, 'sitessmokejoin_tab')
 sites_smokejoin_subpd = os.path.join(AQIdir, 'sitessmokejoin_tabsub.p')
 
-airdatall = os.path.join(AQIdir, 'daily_SPEC_collate.csv')
+airdatall = os.path.join(AQIdir, 'daily_SPEC_collate.parquet') #Parquet dataset partitioned by year
+airdatstore = os.path.join(AQIdir, 'daily_SPEC_store.parquet') #Station-day store partitioned by year and state
 #airdat_uniquetab = os.path.join(AQIdir, 'daily_SPEC_unique.csv')
 airdat_uniquedf_pickle =  os.path.join(rootdir, 'results/airdat_uniquedfproj.p')
 
@@ -96,30 +117,96 @@ def getclosest_ij(X, Y, Xpt, Ypt):
     # Get 2D index for latvals and lonvals arrays from 1D index
     return np.unravel_index(minindex_flattened, X.shape)
 
+def regularstep(coords, rtol=1e-6):
+    "Spacing of a 1D array of coordinates if it is regularly spaced (e.g. NARR Lambert Conformal grid), None otherwise"
+    coords = np.asarray(coords, dtype=float)
+    if coords.ndim != 1 or coords.shape[0] < 2:
+        return(None)
+    steps = np.diff(coords)
+    if steps[0] != 0 and np.allclose(steps, steps[0], rtol=rtol, atol=0):
+        return(steps[0])
+    return(None)
+
+def getclosest_ij_regular(xcol, yrow, Xpt, Ypt):
+    """Vectorized getclosest_ij for a regular grid where X[i, j] = xcol[j] and Y[i, j] = yrow[i].
+    The closest row and column are computed arithmetically from the grid origin and spacing, then the exact squared
+    distances of the 3x3 neighbouring cells are compared so that ties and rounding are resolved as with argmin
+    (first cell in row-major order).
+    xcol, yrow (required): 1D arrays of regularly spaced coordinates of grid columns and rows
+    Xpt, Ypt (required): arrays of point coordinates
+    Returns arrays of row and column indices"""
+    xcol = np.asarray(xcol, dtype=float)
+    yrow = np.asarray(yrow, dtype=float)
+    Xpt = np.asarray(Xpt, dtype=float).ravel()
+    Ypt = np.asarray(Ypt, dtype=float).ravel()
+
+    jguess = np.rint((Xpt - xcol[0])/regularstep(xcol)).clip(0, xcol.shape[0]-1).astype(int)
+    iguess = np.rint((Ypt - yrow[0])/regularstep(yrow)).clip(0, yrow.shape[0]-1).astype(int)
+
+    #Candidate rows and columns (n points x 3), in ascending order so that argmin keeps the first of tied cells
+    offsets = np.array([-1, 0, 1])
+    icand = (iguess[:, None] + offsets).clip(0, yrow.shape[0]-1)
+    jcand = (jguess[:, None] + offsets).clip(0, xcol.shape[0]-1)
+    dist_sq = np.square(xcol[jcand][:, None, :] - Xpt[:, None, None]) + \
+              np.square(yrow[icand][:, :, None] - Ypt[:, None, None])
+    minindex_flattened = dist_sq.reshape(dist_sq.shape[0], 9).argmin(axis=1)
+    ptindex = np.arange(Xpt.shape[0])
+    return(icand[ptindex, minindex_flattened // 3], jcand[ptindex, minindex_flattened % 3])
+
+def getclosest_ij_kdtree(X, Y, Xpt, Ypt):
+    """Vectorized getclosest_ij for irregular grids (e.g. 2D curvilinear coordinates), using a KD-tree of grid cells.
+    Returns arrays of row and column indices"""
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    tree = cKDTree(np.column_stack([X.ravel(), Y.ravel()]))
+    _, minindex_flattened = tree.query(np.column_stack([np.asarray(Xpt, dtype=float).ravel(),
+                                                        np.asarray(Ypt, dtype=float).ravel()]))
+    return(np.unravel_index(minindex_flattened, X.shape))
+
+def getclosest_ij_arr(X, Y, Xpt, Ypt):
+    """Vectorized getclosest_ij for arrays of points.
+    X, Y (required): either 1D arrays of grid column (X) and row (Y) coordinates or 2D arrays of grid coordinates.
+        If 2D arrays are a tiled regular grid, they are reduced to their first row and column.
+    Regular grids are located arithmetically (see getclosest_ij_regular), other grids with a KD-tree.
+    Returns arrays of row and column indices"""
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    if X.ndim == 2 and Y.ndim == 2 and np.all(X == X[0, :]) and np.all(Y == Y[:, [0]]):
+        X = X[0, :]
+        Y = Y[:, 0]
+    if X.ndim == 1 and Y.ndim == 1:
+        if regularstep(X) is not None and regularstep(Y) is not None:
+            return(getclosest_ij_regular(X, Y, Xpt, Ypt))
+        X, Y = np.meshgrid(X, Y)
+    return(getclosest_ij_kdtree(X, Y, Xpt, Ypt))
+
 def getclosest_ij_df(X, Y, XYpt):
     """# A function to find the index of the point closest pt(in squared distance) to give lat/lon value.
     latlonpt may be a 2-column dataframe (lat-lon) or a list/tuple of lat=lon for a point.
-    If data.frame, returns a data.frame of unique coordinates from the original data.frame together with index columns"""
+    X and Y may be 2D grids of coordinates or 1D arrays of column and row coordinates (see getclosest_ij_arr).
+    If data.frame, returns a data.frame of unique coordinates from the original data.frame together with index columns
+    (ix_min: grid row, iy_min: grid column, as returned by getclosest_ij)"""
 
     if isinstance(XYpt, pd.DataFrame):
         print('x and y to locate are panda series, proceeding in pd framework...')
         if XYpt.shape[1] == 2:
             #Get unique set of coordinates
-            xypt_unique = XYpt.drop_duplicates()
-            #Get closest grid for each unique coordinate and return data.frame to join to original one
-            return xypt_unique.apply(
-                lambda x: pd.Series([x[0], x[1]] +
-                                    list(getclosest_ij(X, Y, float(x[0]), float(x[1]))),
-                                    index = list(XYpt.columns.values) + ['ix_min', 'iy_min']), axis=1)
+            xypt_unique = XYpt.drop_duplicates().copy()
+            #Get closest grid for all unique coordinates at once and return data.frame to join to original one
+            ix, iy = getclosest_ij_arr(X, Y, xypt_unique.iloc[:, 0].values, xypt_unique.iloc[:, 1].values)
+            xypt_unique['ix_min'] = ix
+            xypt_unique['iy_min'] = iy
+            return(xypt_unique)
         else:
             raise ValueError('Wrong number of columns in XYpt')
 
-def subsetNARRlevel(indir, pattern, sel_level, outnc, overwrite=False):
+def subsetNARRlevel(indir, pattern, sel_level, outnc, overwrite=False, cdflist=None):
     if os.path.exists(outnc) and overwrite == False:
         print('{} already exists and overwrite=False, skipping...'.format(outnc))
     else:
-        pathpattern = os.path.join(indir, pattern)
-        cdflist = glob.glob(pathpattern)
+        if cdflist is None:
+            pathpattern = os.path.join(indir, pattern)
+            cdflist = glob.glob(pathpattern)
         print('Extracting {0}'.format(cdflist))
 
         try:
@@ -136,49 +223,336 @@ def subsetNARRlevel(indir, pattern, sel_level, outnc, overwrite=False):
                         pass
         #level_i = np.where(sourcef['level'] == level)[0][0]
 
-def narr_daynightstat(indir, regexpattern, outdir, dnlist = ['day', 'night'], statlist = ['mean', 'min', 'max']):
+#Rechunked copies of NARR files registered with registerrechunked, by source file and pressure level
+rechunkindex = {}
+
+def rechunkkey(ncfile, level=None):
+    "Key of a source file and pressure level in rechunkindex"
+    return('{0}|{1}'.format(os.path.normcase(os.path.abspath(ncfile)), level))
+
+def narr_rechunk(ncfile, outnc, varname=None, level=None, tile=32, maxmem=512):
+    """Copy the data variable of a NARR netcdf file to a (time, y, x) netcdf chunked in spatial tiles that each hold
+    the entire time series of tile x tile cells, compressed with zlib, so that a time series at a cell only requires
+    reading and decompressing one chunk rather than the entire file.
+    The file is rechunked in bands of rows read across all time steps, each at most maxmem MB in memory.
+    varname (optional): data variable, the file name up to the first '.' by default (e.g. air in air.2m.2014.nc)
+    level (optional): pressure level to copy from files with multiple levels"""
+    if varname is None:
+        varname = os.path.split(ncfile)[1].split('.')[0]
+    da = opennarrvar(ncfile, varname, level=level).transpose('time', 'y', 'x')
+    nt, ny, nx = da.shape
+    tile = min(tile, ny, nx)
+    bandrows = tile*max(1, int(maxmem*1e6/(nt*tile*nx*max(np.dtype(da.dtype).itemsize, 4))))
+    tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+    nc = createoutnc(tmpnc, da, 'time', da['time'].values, varname, chunksizes=(nt, tile, tile), zlib=True)
+    try:
+        for y0 in range(0, ny, bandrows):
+            y1 = min(y0 + bandrows, ny)
+            nc.variables[varname][:, y0:y1, :] = da.isel(y=slice(y0, y1)).values.astype(np.float32)
+    finally:
+        nc.close()
+        da.close()
+    if os.path.exists(outnc):
+        os.remove(outnc)
+    os.rename(tmpnc, outnc)
+    return({'varname': varname, 'level': level, 'chunks': [nt, tile, tile]})
+
+def narr_rechunkstore(indir, pattern, outdir, level=None, tile=32, maxmem=512, overwrite=False):
+    """Rechunk NARR files in indir matching a glob pattern to outdir (see narr_rechunk), one file per source file and
+    level. A json index in outdir (_index.json) records the source, size and modification time of each source file so
+    that files that have not changed since they were rechunked are skipped and rechunked files can be looked up
+    (see registerrechunked)
+    Returns the index dictionary by rechunked file name"""
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    indexfile = os.path.join(outdir, '_index.json')
+    storeindex = {}
+    if os.path.exists(indexfile):
+        with open(indexfile, 'r') as f:
+            storeindex = json.load(f)
+
+    for ncfile in sorted(glob.glob(os.path.join(indir, pattern))):
+        outname = os.path.split(ncfile)[1] if level is None else \
+            '{0}.{1}.nc'.format(os.path.splitext(os.path.split(ncfile)[1])[0], level)
+        outnc = os.path.join(outdir, outname)
+        entry = {'source': os.path.abspath(ncfile), 'size': os.path.getsize(ncfile),
+                 'mtime': os.path.getmtime(ncfile)}
+        if not overwrite and os.path.exists(outnc) and \
+                all(storeindex.get(outname, {}).get(k) == v for k, v in entry.items()):
+            print('{} is up to date, skipping...'.format(outnc))
+            continue
+
+        print('Rechunking {0} to {1}...'.format(ncfile, outnc))
+        entry.update(narr_rechunk(ncfile, outnc, level=level, tile=tile, maxmem=maxmem))
+        storeindex[outname] = entry
+        with open(indexfile + '.tmp', 'w') as f:
+            json.dump(storeindex, f, indent=1, sort_keys=True)
+        if os.path.exists(indexfile):
+            os.remove(indexfile)
+        os.rename(indexfile + '.tmp', indexfile)
+    return(storeindex)
+
+def registerrechunked(storedir):
+    """Register the rechunked files of a store written by narr_rechunkstore so that opennarrvar and opencdfvar
+    transparently open them in place of their source files, as long as the source files have not changed"""
+    with open(os.path.join(storedir, '_index.json'), 'r') as f:
+        storeindex = json.load(f)
+    for outname, entry in storeindex.items():
+        rechunkindex[rechunkkey(entry['source'], entry['level'])] = dict(entry, path=os.path.join(storedir, outname))
+    print('{0} rechunked files registered from {1}'.format(len(storeindex), storedir))
+
+def rechunkedpath(ncfile, level=None):
+    """Path of the registered rechunked copy of a netcdf file for a given level (see registerrechunked), or None if
+    there is none or the source file changed since it was rechunked"""
+    entry = rechunkindex.get(rechunkkey(ncfile, level))
+    if entry is not None and os.path.exists(entry['path']) and os.path.getsize(ncfile) == entry['size'] and \
+            os.path.getmtime(ncfile) == entry['mtime']:
+        return(entry['path'])
+    return(None)
+
+def opennarrvar(yeardat, varname, level=None):
+    """Lazily open the data variable of a NARR netcdf file (or of a file derived from it) as a DataArray, without
+    pressure level dimension or coordinate. If a rechunked copy of the file was registered (see registerrechunked),
+    it is opened instead.
+    level (optional): pressure level to select in files with multiple levels (e.g. 700 in air.YYYYMM.nc)"""
+    rechunked = rechunkedpath(yeardat, level)
+    if rechunked is not None:
+        yeardat, level = rechunked, None
+    xrd = xr.open_dataset(yeardat)
+    #If xarray.DataArray was directly saved to netcdf before being converted manually to xarray.Dataset
+    datavars = list(xrd.data_vars.keys())
+    if len(datavars) == 1 and datavars[0] == '__xarray_dataarray_variable__':
+        varname = '__xarray_dataarray_variable__'
+    da = xrd[varname]
+    if level is not None:
+        da = da.sel(level=level)
+    #Drop pressure level coordinates
+    if 'level' in da.dims:
+        da = da.squeeze('level', drop=True)
+    elif 'level' in da.coords:
+        da = da.drop('level')
+    return(da)
+
+def createoutnc(outnc, template, datedim, dates, varname, keepattrs=True, chunksizes=None, zlib=False):
+    """Create a netcdf file to write a (date, y, x) variable to incrementally, one or more dates at a time.
+    Coordinates along y and x (e.g. x, y, lat, lon) and, if keepattrs, attributes are copied from the template
+    DataArray.
+    Values are stored as float32, by default contiguously and without compression, as when written with xarray.
+    chunksizes (optional): (date, y, x) chunk shape to store values in chunks, with zlib compression if zlib
+    Returns the open netCDF4.Dataset"""
+    xycoords = {c: template[c] for c in template.coords if len(template[c].dims) > 0 and
+                set(template[c].dims) <= set(['y', 'x'])}
+    xycoords[datedim] = pd.DatetimeIndex(dates)
+    xr.Dataset(coords=xycoords).to_netcdf(outnc)
+
+    nc = netCDF4.Dataset(outnc, 'a')
+    for dim in ['y', 'x']:
+        if dim not in nc.dimensions:
+            nc.createDimension(dim, template.sizes[dim])
+    ncvar = nc.createVariable(varname, 'f4', (datedim, 'y', 'x'), fill_value=np.float32(np.nan), zlib=zlib,
+                              chunksizes=chunksizes)
+    if keepattrs:
+        ncvar.setncatts({k: v for k, v in template.attrs.items() if k not in
+                         ['scale_factor', 'add_offset', '_FillValue', 'missing_value', 'valid_range', 'actual_range',
+                          'packing', '_Unsigned']})
+    return(nc)
+
+def daynightindex(times, dnlist):
+    """Assign 3-hourly time steps to dates and to day or night periods. Dates are shifted by 8h so that the preceding
+    night is part of a date.
+    Returns dictionaries by period of the dates of the period and of the date index of each time step (-1 for time steps
+    of the other period)"""
+    # Add 8h to datetime so that e.g. 02/01 16h-02/02 8h is 02/02 00*02/02 16h (preceding night is now consider part of that date
+    times = pd.DatetimeIndex(times)
+    shifted_date = (times + pd.to_timedelta(timedelta(hours=8))).floor('d')
+    # Assign night vs day
+    daynight = np.where(times.hour.isin(range(0, 17)), 'night', 'day')
+
+    perdates = {}
+    perdateidx = {}
+    for per in dnlist:
+        perdates[per] = pd.DatetimeIndex(np.unique(shifted_date[daynight == per]))
+        perdateidx[per] = np.where(daynight == per, perdates[per].get_indexer(shifted_date), -1)
+    return(perdates, perdateidx)
+
+def narr_daynightstat(indir, regexpattern, outdir, dnlist = ['day', 'night'], statlist = ['mean', 'min', 'max'],
+                      timechunk=80):
+    """Compute daily statistics of 3-hourly NARR data separately for day and night time steps.
+    Each yearly file is read once, timechunk time steps at a time: running sums, counts, minima and maxima are updated
+    for each date (shifted by 8h so that the preceding night is part of a date) and period, and each date is written to
+    all requested outputs ({outdir}/{datname}_{day|night}{mean|min|max}.nc) as soon as its last time step is read"""
     for yeardat in getfilelist(indir, os.path.split(regexpattern)[1]):
         print('Processing {}...'.format(yeardat))
         outdat = os.path.join(outdir, '{}_'.format(os.path.splitext(os.path.split(yeardat)[1])[0]))
 
-        if not glob.glob('{0}{1}*'.format(outdat, dnlist[0])):
+        if not all(os.path.exists('{0}{1}{2}.nc'.format(outdat, per, stat)) for per in dnlist for stat in statlist):
             datname = os.path.splitext(os.path.split(yeardat)[1])[0]
             varname = datname.split('.')[0]
-
-            xrd = xr.open_dataset(yeardat, chunks={'time': 10})
-            # Add 8h to datetime so that e.g. 02/01 16h-02/02 8h is 02/02 00*02/02 16h (preceding night is now consider part of that date
-            xrd.coords['shifted_datetime'] = ('time', xrd['time'].values + pd.to_timedelta(timedelta(hours=8)))
-            xrd.coords['shifted_date'] = ('time', xrd.shifted_datetime.dt.floor('d'))
-            # Assign night vs day
-            xrd.coords['daynight'] = ('time', xr.where(xrd.time.dt.hour.isin(range(0, 17)), 'night', 'day'))
-
-            #Drop pressure level coordinates
-            if 'level' in xrd.coords._names:
-                xrd = xrd.drop('level')
-
-            #For each of 'day' and 'night' in dnlist
-            for per in dnlist:
-                #Output dataset name
-                outnc = '{0}{1}'.format(outdat, per)
-
-                #If xarray.DataArray was directly saved to netcdf before being converted manually to xarray.Dataset
-                datavars = xrd.data_vars.keys()
-                if len(datavars) == 1 and datavars[0] == '__xarray_dataarray_variable__':
-                    varname = '__xarray_dataarray_variable__'
-
-                if 'mean' in statlist:
-                    xrd[varname].where(xrd.daynight == per, drop=True). \
-                        groupby('shifted_date').mean(dim='time').to_netcdf('{}mean.nc'.format(outnc))
-                if 'min' in statlist:
-                    xrd[varname].where(xrd.daynight == per, drop=True). \
-                        groupby('shifted_date').min(dim='time').to_netcdf('{}min.nc'.format(outnc))
-                if 'max' in statlist:
-                    xrd[varname].where(xrd.daynight == per, drop=True). \
-                        groupby('shifted_date').max(dim='time').to_netcdf('{}max.nc'.format(outnc))
+            da = opennarrvar(yeardat, varname).transpose('time', 'y', 'x')
+            times = pd.DatetimeIndex(da['time'].values)
+
+            #For each period: dates, date index of each time step (-1 if in other period), and last time step of each date
+            perdates, perdateidx = daynightindex(times, dnlist)
+            perlast = {}
+            outnc = {}
+            #Write to temporary files until complete so that incomplete outputs are not considered to exist
+            tmpdat = os.path.join(outdir, 'tmp_{}'.format(os.path.split(outdat)[1]))
+            try:
+                for per in dnlist:
+                    perlast[per] = np.array([np.flatnonzero(perdateidx[per] == i)[-1]
+                                             for i in range(len(perdates[per]))], dtype=int)
+                    for stat in statlist:
+                        outnc[(per, stat)] = createoutnc('{0}{1}{2}.nc'.format(tmpdat, per, stat), da,
+                                                         'shifted_date', perdates[per], da.name)
+
+                running = {}
+                for t0 in range(0, len(times), timechunk):
+                    t1 = min(t0 + timechunk, len(times))
+                    block = da.isel(time=slice(t0, t1)).values.astype(np.float64)
+                    for t in range(t0, t1):
+                        for per in dnlist:
+                            i = perdateidx[per][t]
+                            if i < 0:
+                                continue
+                            vals = block[t - t0]
+                            valid = ~np.isnan(vals)
+                            if (per, i) not in running:
+                                running[(per, i)] = {'sum': np.zeros(vals.shape), 'count': np.zeros(vals.shape),
+                                                     'min': np.full(vals.shape, np.inf),
+                                                     'max': np.full(vals.shape, -np.inf)}
+                            r = running[(per, i)]
+                            r['sum'] += np.where(valid, vals, 0)
+                            r['count'] += valid
+                            np.fmin(r['min'], vals, out=r['min'])
+                            np.fmax(r['max'], vals, out=r['max'])
+
+                            #Write all statistics of the date once its last time step has been read
+                            if perlast[per][i] == t:
+                                r = running.pop((per, i))
+                                nodata = r['count'] == 0
+                                statvals = {'mean': r['sum']/np.where(nodata, 1, r['count']),
+                                            'min': r['min'], 'max': r['max']}
+                                for stat in statlist:
+                                    outnc[(per, stat)].variables[da.name][i, :, :] = \
+                                        np.where(nodata, np.nan, statvals[stat]).astype(np.float32)
+            finally:
+                for ncf in outnc.values():
+                    ncf.close()
+                da.close()
+
+            for per, stat in outnc:
+                if os.path.exists('{0}{1}{2}.nc'.format(outdat, per, stat)):
+                    os.remove('{0}{1}{2}.nc'.format(outdat, per, stat))
+                os.rename('{0}{1}{2}.nc'.format(tmpdat, per, stat), '{0}{1}{2}.nc'.format(outdat, per, stat))
         else:
             print('{} already exists, skipping...'.format(outdat))
 
-def narr_d36stat(indir, regexpattern, outdir, dstat = None, multidstat = None):
+def rollingwindow(values, window, stat):
+    """Rolling statistic over the first axis of an array whose first window-1 rows are the halo (the last rows of the
+    preceding chunk, or NaN at the start of the record). As with rolling(...).construct('window').stat('window'),
+    missing values are skipped: sums of windows without any value are 0, means, minima and maxima are NaN.
+    Sums and means are computed with cumulative sums, minima and maxima with the van Herk/Gil-Werman algorithm,
+    all vectorized over grid cells.
+    Returns an array with len(values) - window + 1 rows"""
+    nout = values.shape[0] - window + 1
+    valid = ~np.isnan(values)
+    if stat in ['sum', 'mean']:
+        zeros = np.zeros((1,) + values.shape[1:])
+        csum = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0), axis=0)])
+        wsum = csum[window:] - csum[:nout]
+        if stat == 'sum':
+            return(wsum)
+        ccount = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+        wcount = ccount[window:] - ccount[:nout]
+        return(np.where(wcount > 0, wsum/np.where(wcount > 0, wcount, 1), np.nan))
+    elif stat in ['min', 'max']:
+        ufunc = np.fmin if stat == 'min' else np.fmax
+        #Split into blocks of window rows: running stat from the start (g) and from the end (h) of each block
+        nblocks = int(np.ceil(float(values.shape[0])/window))
+        padded = np.concatenate([values, np.full((nblocks*window - values.shape[0],) + values.shape[1:], np.nan)])
+        blocks = padded.reshape((nblocks, window) + values.shape[1:])
+        g = ufunc.accumulate(blocks, axis=1).reshape(padded.shape)
+        h = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(padded.shape)
+        #Each window spans the end of one block and the start of the next one
+        return(ufunc(h[:nout], g[window-1:window-1+nout]))
+    else:
+        raise ValueError('Rolling statistics is not sum, mean, min, or max')
+
+def rollingblocks(blocks, window, stat):
+    """Apply rollingwindow to a sequence of (dates, values) chunks along the time axis, carrying the last window-1
+    rows of each chunk over to the next one so that only one chunk and its halo are held in memory"""
+    halo = None
+    for dates, values in blocks:
+        if halo is None:
+            halo = np.full((window - 1,) + values.shape[1:], np.nan)
+        extended = np.concatenate([halo, values])
+        yield(dates, rollingwindow(extended, window, stat))
+        halo = extended[extended.shape[0] - (window - 1):]
+
+def dailyblocks(da, dstat=None, datechunk=100):
+    """Read a (time or date, y, x) (or (time or date, site)) DataArray in chunks of datechunk dates and compute daily statistics.
+    dstat (optional): 'mean', 'min', or 'max' of time steps of each date (skipping missing values), 'diff' with
+        the preceding date (daily data only), or None to keep daily data as is
+    Returns the list of output dates and a generator of (dates, values) chunks"""
+    if 'date' in da.dims:
+        timedim = 'date'
+        stepdates = pd.DatetimeIndex(da['date'].values)
+    elif 'time' in da.dims:
+        if dstat not in ['mean', 'min', 'max']:
+            raise ValueError('Daily statistics is not mean, min, or max')
+        timedim = 'time'
+        stepdates = pd.DatetimeIndex(da['time'].values).floor('d')
+    else:
+        raise ValueError('{} has neither a time nor a date dimension'.format(da.name))
+    da = da.transpose(*([timedim] + [d for d in da.dims if d != timedim]))
+    dates, starts = np.unique(stepdates, return_index=True)
+    dates = pd.DatetimeIndex(dates)
+    ends = np.append(starts[1:], len(stepdates))
+
+    def blockgen():
+        previous = None
+        for d0 in range(0, len(dates), datechunk):
+            d1 = min(d0 + datechunk, len(dates))
+            values = da.isel({timedim: slice(starts[d0], ends[d1 - 1])}).values.astype(np.float64)
+            offsets = starts[d0:d1] - starts[d0]
+            if dstat == 'mean':
+                valid = ~np.isnan(values)
+                count = np.add.reduceat(valid, offsets, axis=0)
+                values = np.where(count > 0, np.add.reduceat(np.where(valid, values, 0), offsets, axis=0) /
+                                  np.where(count > 0, count, 1), np.nan)
+            elif dstat == 'min':
+                values = np.fmin.reduceat(values, offsets, axis=0)
+            elif dstat == 'max':
+                values = np.fmax.reduceat(values, offsets, axis=0)
+            elif dstat == 'diff':
+                extended = values if previous is None else np.concatenate([previous, values])
+                previous = values[-1:]
+                yield(dates[max(d0, 1):d1], np.diff(extended, n=1, axis=0))
+                continue
+            elif dstat is not None:
+                raise ValueError('Daily statistics is not mean, min, max, or diff')
+            yield(dates[d0:d1], values)
+
+    return(dates[1:] if dstat == 'diff' else dates, blockgen())
+
+def writeblocks(blocks, outnc, template, datedim, dates, varname):
+    """Write a sequence of (dates, values) chunks to a new netcdf file as they are computed (see createoutnc).
+    The file is written under a temporary name and renamed once complete"""
+    tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+    nc = createoutnc(tmpnc, template, datedim, dates, varname)
+    try:
+        i = 0
+        for blockdates, values in blocks:
+            nc.variables[varname][i:i + len(blockdates), :, :] = values.astype(np.float32)
+            i += len(blockdates)
+    finally:
+        nc.close()
+    os.rename(tmpnc, outnc)
+
+def narr_d36stat(indir, regexpattern, outdir, dstat = None, multidstat = None, datechunk=100):
+    """Compute daily statistics (dstat: mean, min, max or diff) and/or multi-day rolling statistics
+    (multidstat: {number of days: mean, min, or max}) of NARR data. Files are streamed datechunk dates at a time
+    (see dailyblocks and rollingblocks) and written incrementally, so memory use does not depend on record length"""
     xrlist = getfilelist(indir, os.path.split(regexpattern)[1])
     if len(xrlist) > 0:
         for yeardat in xrlist:
@@ -186,66 +560,501 @@ def narr_d36stat(indir, regexpattern, outdir, dstat = None, multidstat = None):
             outdat = os.path.join(outdir, '{0}_{1}.nc'.format(os.path.splitext(os.path.split(yeardat)[1])[0], dstat))
 
             if multidstat is not None:
-                outdat = '{0}_{1}day{2}.nc'.format(os.path.splitext(outdat)[0], multidstat.keys()[0], multidstat.values()[0])
+                window, multistat = list(multidstat.items())[0]
+                outdat = '{0}_{1}day{2}.nc'.format(os.path.splitext(outdat)[0], window, multistat)
 
             if not os.path.exists(outdat):
                 datname = os.path.splitext(os.path.split(yeardat)[1])[0]
                 varname = datname.split('.')[0]
 
-                xrd = xr.open_dataset(yeardat)
-                if 'shifted_date' in xrd.coords.keys():
-                    xrd = xrd.rename({'shifted_date':'date'})
-                    xrd = xrd.chunk({'date': 100, 'x': 40, 'y': 40})
-                else:
-                    xrd.coords['date'] = ('time', xrd.time.dt.floor('d'))
-                    xrd = xrd.chunk({'time': 100, 'x': 40, 'y': 40})
-
-                #Drop pressure level coordinates
-                if 'level' in xrd.coords._names:
-                    xrd = xrd.drop('level')
-
-                #If xarray.DataArray was directly saved to netcdf before being converted manually to xarray.Dataset
-                datavars = xrd.data_vars.keys()
-                if len(datavars) == 1 and datavars[0] == '__xarray_dataarray_variable__':
-                    varname = '__xarray_dataarray_variable__'
+                da = opennarrvar(yeardat, varname)
+                if 'shifted_date' in da.dims:
+                    da = da.rename({'shifted_date': 'date'})
+                if dstat is None and 'date' not in da.dims:
+                    raise ValueError('Multiday statistics require daily data, provide a daily statistics (dstat)')
 
                 #Compute daily stat
-                if dstat is not None:
-                    if dstat == 'mean':
-                        xrd = xrd[varname].groupby('date').mean(dim='time')
-                    elif dstat == 'min':
-                        xrd = xrd[varname].groupby('date').min(dim='time')
-                    elif dstat == 'max':
-                        xrd = xrd[varname].groupby('date').max(dim='time')
-                    elif dstat == 'diff':
-                        xrd = xrd[varname].diff(dim='date', n=1)
-                    else:
-                        raise ValueError('Daily statistics is not mean, min, or max')
-                    xrd = xrd.chunk({'date':100, 'x':100, 'y':100})
+                dates, blocks = dailyblocks(da, dstat=dstat, datechunk=datechunk)
 
                 if multidstat is not None:
-                    if isinstance(xrd, xr.Dataset):
-                        xrd = xrd[varname]
-
-                    if multidstat.values()[0] == 'mean':
-                        xrd = xrd.rolling(date=multidstat.keys()[0], center=False,
-                                          min_periods=multidstat.keys()[0]).construct('window').mean('window')
-                    elif multidstat.values()[0] == 'min':
-                        xrd = xrd.rolling(date=multidstat.keys()[0], center=False,
-                                          min_periods=multidstat.keys()[0]).construct('window').min('window')
-                    elif multidstat.values()[0] == 'max':
-                        xrd = xrd.rolling(date=multidstat.keys()[0], center=False,
-                                          min_periods=multidstat.keys()[0]).construct('window').max('window')
-                    else:
+                    if multistat not in ['mean', 'min', 'max']:
                         raise ValueError('Multiday statistics is not mean, min, or max over 3 or 6 days')
+                    blocks = rollingblocks(blocks, window, multistat)
 
-                print("Saving {} to netcdf. This might take a while...".format(outdat))
-                xrd.to_dataset(name=datname.split('.')[0]).chunk({'date':100, 'x':100, 'y':100}).to_netcdf(outdat)
+                print("Saving {} to netcdf...".format(outdat))
+                try:
+                    writeblocks(blocks, outdat, da, 'date', dates, varname)
+                finally:
+                    da.close()
             else:
                 print('{} already exists, skipping...'.format(outdat))
     else:
         raise ValueError('regexpattern does not correspond to any existing dataset')
 
+def windrpi(u, v, halo=None, window=8):
+    """Wind speed (wspd) and recirculation potential index (rpi) of arrays of u and v wind components whose first axis
+    is time, with rolling sums over window time steps.
+    halo (optional): u, v, and wspd of the last window-1 time steps preceding the arrays (from a previous call),
+        missing values at the start of the record by default
+    Returns wspd, rpi and the halo for the next chunk"""
+    wspd = np.sqrt(u**2 + v**2)
+    if halo is None:
+        halo = np.full((3, window - 1) + u.shape[1:], np.nan)
+    extended = np.concatenate([halo, np.stack([u, v, wspd])], axis=1)
+    usum, vsum, wspdsum = [rollingwindow(extended[i], window, 'sum') for i in range(3)]
+    rpi = pow((3*usum**2) + (3*vsum**2), 0.5)/3*wspdsum
+    return(wspd, rpi, extended[:, extended.shape[1] - (window - 1):])
+
+def narr_wspdrpi(uwndnc, vwndnc, outwspd=None, outrpi=None, window=8, timechunk=240):
+    """Compute wind speed (wspd) and recirculation potential index (rpi) from 3-hourly u and v wind components in a
+    single pass over both files, timechunk time steps at a time with a halo of window-1 time steps for the rolling
+    sums over the past 24h (window), writing both outputs incrementally.
+    outwspd, outrpi (optional): output netcdf files, None to skip an output"""
+    uwnd = opennarrvar(uwndnc, 'uwnd').transpose('time', 'y', 'x')
+    vwnd = opennarrvar(vwndnc, 'vwnd').transpose('time', 'y', 'x')
+    times = pd.DatetimeIndex(uwnd['time'].values)
+    if not times.equals(pd.DatetimeIndex(vwnd['time'].values)):
+        raise ValueError('{0} and {1} do not have the same time steps'.format(uwndnc, vwndnc))
+
+    outs = {}
+    try:
+        for outvar, outnc in [('wspd', outwspd), ('rpi', outrpi)]:
+            if outnc is not None:
+                tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+                outs[outvar] = (outnc, tmpnc, createoutnc(tmpnc, uwnd, 'time', times, outvar, keepattrs=False))
+
+        halo = None
+        for t0 in range(0, len(times), timechunk):
+            t1 = min(t0 + timechunk, len(times))
+            u = uwnd.isel(time=slice(t0, t1)).values.astype(np.float64)
+            v = vwnd.isel(time=slice(t0, t1)).values.astype(np.float64)
+            wspd, rpi, halo = windrpi(u, v, halo=halo, window=window)
+            if 'wspd' in outs:
+                outs['wspd'][2].variables['wspd'][t0:t1, :, :] = wspd.astype(np.float32)
+            if 'rpi' in outs:
+                outs['rpi'][2].variables['rpi'][t0:t1, :, :] = rpi.astype(np.float32)
+    finally:
+        for outnc, tmpnc, nc in outs.values():
+            nc.close()
+        uwnd.close()
+        vwnd.close()
+    for outnc, tmpnc, nc in outs.values():
+        os.rename(tmpnc, outnc)
+
+def centeredmean(values, window, axis):
+    """Centered moving mean along an axis of an array, with cumulative sums. As with rolling(center=True).mean()
+    (min_periods=window), means of windows that contain missing values or extend beyond the array are missing"""
+    values = np.moveaxis(values, axis, 0)
+    nout = values.shape[0] - window + 1
+    out = np.full(values.shape, np.nan)
+    if nout > 0:
+        valid = ~np.isnan(values)
+        zeros = np.zeros((1,) + values.shape[1:])
+        csum = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0), axis=0)])
+        ccount = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+        wsum = csum[window:] - csum[:nout]
+        wcount = ccount[window:] - ccount[:nout]
+        out[window//2:window//2 + nout] = np.where(wcount == window, wsum/window, np.nan)
+    return(np.moveaxis(out, 0, axis))
+
+def boxmean(values, window=9):
+    """window x window moving mean over the y and x axes of a (time, y, x) array, computed separably along y then x
+    (same as rolling(y=window, center=True).mean().rolling(x=window, center=True).mean())"""
+    return(centeredmean(centeredmean(values.astype(np.float64), window, axis=1), window, axis=2))
+
+def narr_boxsmooth(innc, varname, outnc, window=9, timechunk=40, workers=4):
+    """Smooth a 3-hourly NARR file with a window x window moving mean (see boxmean), timechunk time steps at a time.
+    Blocks are read and written in order by the calling thread and smoothed concurrently by a pool of workers (numpy
+    releases the GIL), with at most 2*workers blocks in memory. The output is chunked by time block and compressed"""
+    da = opennarrvar(innc, varname).transpose('time', 'y', 'x')
+    times = da['time'].values
+    tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+    nc = createoutnc(tmpnc, da, 'time', times, varname,
+                     chunksizes=(min(timechunk, len(times)), da.sizes['y'], da.sizes['x']), zlib=True)
+    p = ThreadPool(workers)
+    try:
+        pending = deque()
+        for t0 in range(0, len(times), timechunk):
+            t1 = min(t0 + timechunk, len(times))
+            pending.append((t0, t1, p.apply_async(boxmean, (da.isel(time=slice(t0, t1)).values, window))))
+            while len(pending) >= 2*workers or (t1 == len(times) and len(pending) > 0):
+                b0, b1, result = pending.popleft()
+                nc.variables[varname][b0:b1, :, :] = result.get().astype(np.float32)
+    finally:
+        p.close()
+        p.join()
+        nc.close()
+        da.close()
+    os.rename(tmpnc, outnc)
+
+def narr_lts(air700nc, pottmpnc, outnc):
+    """Compute lower-tropospheric stability (lts) from air temperature at 700 hPa (see subsetNARRlevel) and surface
+    potential temperature: lts = potential temperature (700 hPa) - potential temperature (surface)"""
+    air700 = xr.open_dataset(air700nc, chunks={'time': 20}).drop('level')
+    tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+    with xr.open_dataset(pottmpnc, chunks={'time': 20}) as pottmp_sfc:
+        airpottmp_join = xr.merge([air700, pottmp_sfc], join='inner')
+        airpottmp_join['pottmp700'] = airpottmp_join.air*pow(1000.0/700.0, 0.286)
+        lts = airpottmp_join.pottmp700 - airpottmp_join.pottmp
+        print('Saving to netdcdf. This might take a while... {}'.format(outnc))
+        lts.to_dataset(name='lts').to_netcdf(tmpnc)
+    air700.close()
+    os.rename(tmpnc, outnc)
+
+#Registry of NARR variables (see registernarrvar), by variable name
+narrvars = {}
+
+def registernarrvar(outputs, compute=None, inputs=None, params=None):
+    """Register NARR variables computed together from other registered variables (or raw NARR variables if compute is
+    None), so that they can be requested by name (see requestnarrvars).
+    outputs (required): dictionary of variable names to netcdf files, with a {year} field for variables with one file
+        per year (e.g. results/NARR/lts.{year}.nc), or without for variables in a single file for all years. Files of raw
+        variables may be glob patterns (e.g. air.{year}[0-9][0-9].nc for monthly files)
+    compute (optional): function called as compute(infiles, outfiles, **params), with infiles a dictionary of lists of
+        input files by argument name and outfiles a dictionary of output files by variable name
+    inputs (optional): dictionary of argument names to names of input variables
+    params (optional): dictionary of additional arguments to compute"""
+    node = {'name': sorted(outputs)[0], 'outputs': outputs, 'compute': compute, 'inputs': inputs or {},
+            'params': params or {}}
+    for name in outputs:
+        narrvars[name] = node
+
+def narrvaryearly(name):
+    "Whether a registered variable has one file per year"
+    return('{year}' in narrvars[name]['outputs'][name])
+
+def narrvarfiles(name, years):
+    """Existing files of a registered raw variable, or files of a derived variable, for a list of years (all years
+    are in the same file for variables without yearly files)"""
+    template = narrvars[name]['outputs'][name]
+    if not narrvaryearly(name):
+        return([template])
+    if narrvars[name]['compute'] is None:
+        return(sorted(itertools.chain.from_iterable(glob.glob(template.format(year=yr)) for yr in years)))
+    return([template.format(year=yr) for yr in years])
+
+def narrvarpattern(name):
+    "Directory and regular expression of the file names of a registered variable (e.g. for stationfiles)"
+    indir, template = os.path.split(narrvars[name]['outputs'][name])
+    return(indir, '^{}$'.format(re.escape(template).replace(re.escape('{year}'), '[0-9]{4}')))
+
+def narrstem(name):
+    "File name of a registered variable without extension, with a {year} field for yearly variables"
+    return(os.path.splitext(os.path.split(narrvars[name]['outputs'][name])[1])[0])
+
+def narrreg_level(infiles, outfiles, level):
+    "Registry counterpart to subsetNARRlevel"
+    outnc = list(outfiles.values())[0]
+    tmpnc = os.path.join(os.path.split(outnc)[0], 'tmp_{}'.format(os.path.split(outnc)[1]))
+    subsetNARRlevel(None, None, level, tmpnc, overwrite=True, cdflist=infiles['source'])
+    if os.path.exists(tmpnc):
+        os.rename(tmpnc, outnc)
+
+def narrreg_lts(infiles, outfiles):
+    "Registry counterpart to narr_lts"
+    narr_lts(infiles['air700'][0], infiles['pottmp'][0], outfiles['lts'])
+
+def narrreg_wspdrpi(infiles, outfiles, window=8):
+    "Registry counterpart to narr_wspdrpi"
+    narr_wspdrpi(infiles['uwnd'][0], infiles['vwnd'][0], outwspd=outfiles['wspd.10m'], outrpi=outfiles['rpi'],
+                 window=window)
+
+def narrreg_boxsmooth(infiles, outfiles, window=9):
+    "Registry counterpart to narr_boxsmooth"
+    innc = infiles['source'][0]
+    narr_boxsmooth(innc, os.path.split(innc)[1].split('.')[0], list(outfiles.values())[0], window=window)
+
+def narrreg_daynight(infiles, outfiles, dnlist, statlist):
+    "Registry counterpart to narr_daynightstat"
+    indir, infile = os.path.split(infiles['source'][0])
+    narr_daynightstat(indir, '^{}$'.format(re.escape(infile)), os.path.split(list(outfiles.values())[0])[0],
+                      dnlist=dnlist, statlist=statlist)
+
+def narrreg_d36(infiles, outfiles, dstat, multidstat):
+    "Registry counterpart to narr_d36stat"
+    indir, infile = os.path.split(infiles['source'][0])
+    narr_d36stat(indir, '^{}$'.format(re.escape(infile)), os.path.split(list(outfiles.values())[0])[0],
+                 dstat=dstat, multidstat=multidstat)
+
+def registerdaynight(var, outdir, dnlist, statlist):
+    """Register day and night statistics of a registered variable (see narr_daynightstat), named as
+    var_[day|night][stat] (e.g. lts_daymin)"""
+    registernarrvar({'{0}_{1}{2}'.format(var, per, stat): os.path.join(outdir, '{0}_{1}{2}.nc'.format(
+        narrstem(var), per, stat)) for per in dnlist for stat in statlist},
+                    narrreg_daynight, {'source': var}, {'dnlist': dnlist, 'statlist': statlist})
+
+def registerd36(var, outdir, dstat=None, multidstat=None):
+    """Register daily and multi-day statistics of a registered variable (see narr_d36stat), named as var_[dstat] or
+    var.diff, followed by .[N]day[stat] for multi-day statistics (e.g. wspd.10m_max.3daymean, shum.2m_daymean.diff)"""
+    name = var if dstat is None else '{0}.diff'.format(var) if dstat == 'diff' else '{0}_{1}'.format(var, dstat)
+    outnc = os.path.join(outdir, '{0}_{1}.nc'.format(narrstem(var), dstat))
+    if multidstat is not None:
+        window, multistat = list(multidstat.items())[0]
+        name = '{0}.{1}day{2}'.format(name, window, multistat)
+        outnc = '{0}_{1}day{2}.nc'.format(os.path.splitext(outnc)[0], window, multistat)
+    registernarrvar({name: outnc}, narrreg_d36, {'source': var}, {'dstat': dstat, 'multidstat': multidstat})
+
+def narrjobs(names, years):
+    """Jobs to compute registered variables for a list of years: (node, year) pairs, with year None for variables in a
+    single file for all years, ordered so that the inputs of each job are computed by preceding jobs"""
+    jobs = []
+    visited = set()
+    def visit(name, yrs):
+        node = narrvars[name]
+        if node['compute'] is None:
+            return
+        for yr in (yrs if narrvaryearly(name) else [None]):
+            if (node['name'], yr) not in visited:
+                visited.add((node['name'], yr))
+                for invar in node['inputs'].values():
+                    visit(invar, [yr] if yr is not None else years)
+                jobs.append((node, yr))
+    for name in names:
+        if name not in narrvars:
+            raise ValueError('{} is not a registered NARR variable'.format(name))
+        visit(name, years)
+    return(jobs)
+
+def requestnarrvars(names, years, memofile):
+    """Compute registered NARR variables for a list of years, along with the variables they depend on.
+    Each computation is memoized in memofile (json) with a key made of the function, its parameters and the names,
+    sizes and modification times of its input files (see filelisthash): files whose key has not changed are not
+    recomputed, and files whose inputs or parameters changed are recomputed along with all files that depend on them.
+    Existing files without a key (e.g. computed before they were registered) are kept and their key recorded, unless
+    one of their inputs was computed in the same request.
+    Returns the dictionary of files of the requested variables by variable name"""
+    computed = set()
+    memo = {}
+    if os.path.exists(memofile):
+        with open(memofile, 'r') as f:
+            memo = json.load(f)
+
+    for node, yr in narrjobs(names, years):
+        infiles = {arg: narrvarfiles(invar, [yr] if yr is not None and narrvaryearly(invar) else years)
+                   for arg, invar in node['inputs'].items()}
+        outfiles = {name: path.format(year=yr) for name, path in node['outputs'].items()}
+        missing = [f for f in itertools.chain.from_iterable(infiles.values()) if not os.path.exists(f)] + \
+                  [arg for arg, files in infiles.items() if len(files) == 0]
+        if len(missing) > 0:
+            print('Missing inputs for {0}, skipping: {1}'.format(sorted(outfiles.values()), missing))
+            continue
+
+        h = hashlib.sha256()
+        h.update('{0}_{1}_{2}'.format(node['compute'].__name__, json.dumps(node['params'], sort_keys=True),
+                                      filelisthash(itertools.chain.from_iterable(infiles.values()))).encode('utf-8'))
+        key = h.hexdigest()
+        memokeys = [memo.get(os.path.split(f)[1]) for f in outfiles.values()]
+        inputcomputed = any(f in computed for f in itertools.chain.from_iterable(infiles.values()))
+        if all(os.path.exists(f) for f in outfiles.values()) and \
+                all(k == key or (k is None and not inputcomputed) for k in memokeys):
+            if None in memokeys:
+                print('Recording existing {}...'.format(sorted(outfiles.values())))
+            else:
+                print('{} up to date, skipping...'.format(sorted(outfiles.values())))
+        else:
+            print('Computing {}...'.format(sorted(outfiles.values())))
+            for f in outfiles.values():
+                if os.path.exists(f):
+                    os.remove(f)
+            node['compute'](infiles, outfiles, **node['params'])
+            if not all(os.path.exists(f) for f in outfiles.values()):
+                print('Failed to compute {}'.format([f for f in outfiles.values() if not os.path.exists(f)]))
+                continue
+            computed.update(outfiles.values())
+
+        for f in outfiles.values():
+            memo[os.path.split(f)[1]] = key
+        with open(memofile + '.tmp', 'w') as f:
+            json.dump(memo, f, indent=1, sort_keys=True)
+        if os.path.exists(memofile):
+            os.remove(memofile)
+        os.rename(memofile + '.tmp', memofile)
+    return({name: narrvarfiles(name, years) for name in names})
+
+def stationcells(ncfile, sitesx, sitesy):
+    "Row (y) and column (x) indices of the cells of the grid of a netcdf file closest to stations (see getclosest_ij_arr)"
+    with xr.open_dataset(ncfile) as xrd:
+        return(getclosest_ij_arr(xrd['x'].values, xrd['y'].values, sitesx, sitesy))
+
+def stationseries(ncfiles, varname, cells, level=None, window=1, timechunk=240):
+    """Time series of a NARR variable at station cells, read from a list of netcdf files timechunk time steps at a
+    time, so that derived variables and statistics can then be computed on a compact (time, site) array rather than
+    over the entire grid.
+    cells (required): tuple of arrays of station identifiers, and of row and column indices of the station cells
+        (see stationcells)
+    level (optional): pressure level to select in files with multiple levels
+    window (optional): if > 1, mean of the window x window cells centered on each station cell rather than the value of
+        the station cell. As with rolling(y=window, center=True).mean().rolling(x=window, center=True).mean(), the
+        mean is missing if any of the cells is missing or outside of the grid
+    Returns a (time or date, site) float32 DataArray"""
+    sites, iy, ix = cells
+    offsets = np.arange(window) - window//2
+    serieslist = []
+    for ncfile in sorted(ncfiles):
+        da = opennarrvar(ncfile, varname, level=level)
+        if 'shifted_date' in da.dims:
+            da = da.rename({'shifted_date': 'date'})
+        timedim = [d for d in da.dims if d not in ['y', 'x']][0]
+        da = da.transpose(timedim, 'y', 'x')
+
+        #Cells of the window around each station cell (site, window, window)
+        celly = iy[:, None, None] + offsets[None, :, None] + np.zeros((1, 1, window), dtype=int)
+        cellx = ix[:, None, None] + offsets[None, None, :] + np.zeros((1, window, 1), dtype=int)
+        ingrid = (celly >= 0) & (celly < da.sizes['y']) & (cellx >= 0) & (cellx < da.sizes['x'])
+        celly = celly.clip(0, da.sizes['y'] - 1)
+        cellx = cellx.clip(0, da.sizes['x'] - 1)
+
+        values = np.empty((da.sizes[timedim], len(sites)), dtype=np.float32)
+        if len(chunkbounds(da, timedim)) == 1: #Time-contiguous chunks (e.g. rechunked file), read tiles with stations
+            block = tileseries(da, celly.ravel(), cellx.ravel(), timedim).reshape((-1,) + celly.shape)
+            values[:] = np.where(ingrid, block, np.nan).reshape(-1, len(sites), window*window).mean(axis=2)
+        else:
+            for t0 in range(0, da.sizes[timedim], timechunk):
+                t1 = min(t0 + timechunk, da.sizes[timedim])
+                block = da.isel({timedim: slice(t0, t1)}).values.astype(np.float64)[:, celly, cellx]
+                values[t0:t1] = np.where(ingrid, block, np.nan).reshape(t1 - t0, len(sites), -1).mean(axis=2)
+        serieslist.append(xr.DataArray(values, dims=(timedim, 'site'),
+                                       coords={timedim: da[timedim].values, 'site': sites}, name=da.name))
+        da.close()
+    return(xr.concat(serieslist, dim=serieslist[0].dims[0]).sortby(serieslist[0].dims[0]))
+
+def tileseries(da, yidx, xidx, timedim='time'):
+    """Entire time series of a (time, y, x) DataArray at a set of (y, x) cells, reading only the chunks (see
+    chunkbounds) that contain cells, each once and across all time steps
+    Returns a (time, cell) float64 array"""
+    yidx, xidx = np.asarray(yidx, dtype=np.int64), np.asarray(xidx, dtype=np.int64)
+    ybounds, xbounds = chunkbounds(da, 'y'), chunkbounds(da, 'x')
+    yends, xends = np.append(ybounds[1:], da.sizes['y']), np.append(xbounds[1:], da.sizes['x'])
+    tilecode = (np.searchsorted(ybounds, yidx, side='right') - 1)*len(xbounds) + \
+               np.searchsorted(xbounds, xidx, side='right') - 1
+    values = np.empty((da.sizes[timedim], len(yidx)), dtype=np.float64)
+    for code in np.unique(tilecode):
+        cellsin = np.where(tilecode == code)[0]
+        ty, tx = divmod(code, len(xbounds))
+        block = da.isel(y=slice(ybounds[ty], yends[ty]), x=slice(xbounds[tx], xends[tx])). \
+            transpose(timedim, 'y', 'x').values
+        values[:, cellsin] = block[:, yidx[cellsin] - ybounds[ty], xidx[cellsin] - xbounds[tx]]
+    return(values)
+
+def stationfiles(store, indir, regexpattern, cells, readfiles=True):
+    """Names of the station time series in indir whose file name matches regexpattern (as with getfilelist).
+    store (required): dictionary of station time series (see stationseries) by the path of the netcdf file that
+        would contain them if computed over the entire grid
+    readfiles (optional): whether netcdf files in indir that are not in store yet are extracted at station cells and
+        added to it (e.g. raw NARR files). Otherwise, only series in store are considered, so that files left in an
+        output directory by a previous computation over the entire grid are not used"""
+    if readfiles:
+        for ncfile in getfilelist(indir, regexpattern):
+            if ncfile not in store:
+                store[ncfile] = stationseries([ncfile], os.path.split(ncfile)[1].split('.')[0], cells)
+    return(sorted([f for f in store if os.path.abspath(f).startswith(os.path.abspath(indir)) and
+                   re.search(regexpattern, os.path.split(f)[1])]))
+
+def station_subsetlevel(store, indir, pattern, sel_level, outnc, cells):
+    "Station counterpart to subsetNARRlevel (see stationfiles)"
+    if outnc not in store:
+        cdflist = glob.glob(os.path.join(indir, pattern))
+        print('Extracting {0} at stations'.format(cdflist))
+        store[outnc] = stationseries(cdflist, os.path.split(cdflist[0])[1].split('.')[0], cells, level=sel_level)
+
+def station_lts(store, air700nc, pottmplist, outdir, cells):
+    """Station counterpart to the computation of lower-tropospheric stability (lts) from air temperature at 700 hPa
+    (air700nc, see station_subsetlevel) and yearly surface potential temperature files (pottmplist)"""
+    for yeardat in pottmplist:
+        outdat = os.path.join(outdir,
+                              'lts.{}.nc'.format(re.compile('[0-9]{4}').search(os.path.split(yeardat)[1]).group()))
+        if outdat not in store:
+            air700, pottmp = xr.align(store[air700nc], stationseries([yeardat], 'pottmp', cells), join='inner')
+            store[outdat] = (air700.astype(np.float64)*pow(1000.0/700.0, 0.286) - pottmp).astype(np.float32). \
+                rename('lts')
+
+def station_wspdrpi(store, uwndnc, vwndnc, outwspd, outrpi, cells, window=8):
+    "Station counterpart to narr_wspdrpi (see windrpi)"
+    if not (outwspd in store and outrpi in store):
+        uwnd = stationseries([uwndnc], 'uwnd', cells)
+        vwnd = stationseries([vwndnc], 'vwnd', cells)
+        wspd, rpi, halo = windrpi(uwnd.values.astype(np.float64), vwnd.values.astype(np.float64), window=window)
+        store[outwspd] = uwnd.copy(data=wspd.astype(np.float32)).rename('wspd')
+        store[outrpi] = uwnd.copy(data=rpi.astype(np.float32)).rename('rpi')
+
+def station_boxmean(store, ncfiles, varname, outdir, cells, window=9):
+    "Station counterpart to the window x window smoothing of yearly NARR files (e.g. crain.YYYY_9x9.nc)"
+    for yeardat in ncfiles:
+        outdat = os.path.join(outdir, '{0}_{1}x{1}.nc'.format(os.path.splitext(os.path.split(yeardat)[1])[0], window))
+        if outdat not in store:
+            store[outdat] = stationseries([yeardat], varname, cells, window=window)
+
+def station_daynightstat(store, indir, regexpattern, outdir, cells, dnlist = ['day', 'night'],
+                         statlist = ['mean', 'min', 'max']):
+    "Station counterpart to narr_daynightstat (see stationfiles)"
+    for yeardat in stationfiles(store, indir, os.path.split(regexpattern)[1], cells,
+                                readfiles=os.path.abspath(indir) != os.path.abspath(outdir)):
+        outdat = os.path.join(outdir, '{}_'.format(os.path.splitext(os.path.split(yeardat)[1])[0]))
+        if not all('{0}{1}{2}.nc'.format(outdat, per, stat) in store for per in dnlist for stat in statlist):
+            da = store[yeardat]
+            perdates, perdateidx = daynightindex(da['time'].values, dnlist)
+            for per in dnlist:
+                inper = perdateidx[per] >= 0
+                pergroups = pd.DataFrame(da.values[inper].astype(np.float64)).groupby(perdateidx[per][inper])
+                for stat in statlist:
+                    statdf = getattr(pergroups, stat)()
+                    store['{0}{1}{2}.nc'.format(outdat, per, stat)] = xr.DataArray(
+                        statdf.values.astype(np.float32), dims=('date', 'site'), name=da.name,
+                        coords={'date': perdates[per][statdf.index.values], 'site': da['site'].values})
+
+def station_d36stat(store, indir, regexpattern, outdir, cells, dstat = None, multidstat = None):
+    "Station counterpart to narr_d36stat (see stationfiles)"
+    for yeardat in stationfiles(store, indir, os.path.split(regexpattern)[1], cells,
+                                readfiles=os.path.abspath(indir) != os.path.abspath(outdir)):
+        outdat = os.path.join(outdir, '{0}_{1}.nc'.format(os.path.splitext(os.path.split(yeardat)[1])[0], dstat))
+        if multidstat is not None:
+            window, multistat = list(multidstat.items())[0]
+            outdat = '{0}_{1}day{2}.nc'.format(os.path.splitext(outdat)[0], window, multistat)
+
+        if outdat not in store:
+            da = store[yeardat]
+            if dstat is None and 'date' not in da.dims:
+                raise ValueError('Multiday statistics require daily data, provide a daily statistics (dstat)')
+            dates, blocks = dailyblocks(da, dstat=dstat, datechunk=max(da.shape[0], 1))
+            if multidstat is not None:
+                if multistat not in ['mean', 'min', 'max']:
+                    raise ValueError('Multiday statistics is not mean, min, or max over 3 or 6 days')
+                blocks = rollingblocks(blocks, window, multistat)
+            values = np.concatenate([block[1] for block in blocks])
+            store[outdat] = xr.DataArray(values.astype(np.float32), dims=('date', 'site'), name=da.name,
+                                         coords={'date': dates, 'site': da['site'].values})
+
+def stationstoDF(indf, store, outdir, regexpattern, outfile=None, datecol='date', idcol='UID', overwrite=False):
+    """Station counterpart to extractCDFstoDF: gather the station time series of store in outdir whose file name
+    matches regexpattern into a wide table of station-dates (idcol, datecol), with one column per variable named as
+    with gridded files (file name without year)"""
+    if outfile is not None and os.path.exists(outfile) and not overwrite:
+        print('{} already exists and overwrite==False, reading it...'.format(outfile))
+        return(pd.read_parquet(outfile))
+
+    vardict = defaultdict(list)
+    for f in store:
+        if os.path.abspath(f).startswith(os.path.abspath(outdir)) and re.search(regexpattern, os.path.split(f)[1]):
+            vardict[re.sub(r'[0-9]{4}_', '', os.path.splitext(os.path.split(f)[1])[0])].append(f)
+
+    df = stationdates(indf, idcol, datecol)
+    for var in vardict:
+        values = np.full(len(df), np.nan, dtype=np.float32)
+        for f in sorted(vardict[var]):
+            dateidx = pd.DatetimeIndex(store[f]['date'].values).get_indexer(df[datecol])
+            siteidx = pd.Index(store[f]['site'].values).get_indexer(df[idcol])
+            found = np.where((dateidx >= 0) & (siteidx >= 0))[0]
+            values[found] = store[f].values[dateidx[found], siteidx[found]]
+        df[var] = values
+
+    df = df.drop(columns=['x', 'y'])
+    if outfile is not None:
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), outfile + '.tmp')
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        os.rename(outfile + '.tmp', outfile)
+    return(df)
+
 def extractCDFtoDF(indf, incdf, indir, varname, keepcols=None, datecol = None, level=None, outfile=None, overwrite=False):
     """
     Function to extract netcdf values at a set of points and dates for a list of netcdf files.
@@ -333,8 +1142,8 @@ def extractCDFtoDF(indf, incdf, indir, varname, keepcols=None, datecol = None, l
         #print('Getting index of pixels closest to points in df...')
 
         df_ij = df.merge(getclosest_ij_df(
-            X=np.tile(sourcef['x'].values, [sourcef['y'].shape[0], 1]),
-            Y=np.tile(np.transpose(np.asmatrix(sourcef['y'].values[::-1])), [1, sourcef['x'].shape[0]]),
+            X=sourcef['x'].values,
+            Y=sourcef['y'].values[::-1],
             XYpt=df[['x', 'y']]),
             how='left', on=['x', 'y'])
 
@@ -352,18 +1161,19 @@ def extractCDFtoDF(indf, incdf, indir, varname, keepcols=None, datecol = None, l
         if level is not None:
             if 'level' in sourcef.dims:
                 level_i = np.where(sourcef['level'] == level)[0][0]
-                df_ij[varname] = (sourcef[varname].isel(
-                    time=xr.DataArray(df_ij.date_index, dims='z'),
-                    x=xr.DataArray(df_ij.ix_min.astype(int), dims='z'),
-                    y=xr.DataArray(df_ij.iy_min.astype(int), dims='z'),
-                    level=level_i)).values
+                df_ij[varname], gatherstats = chunkgather(sourcef[varname].isel(level=level_i),
+                                                          dateidx=df_ij.date_index,
+                                                          yidx=df_ij.iy_min.astype(int),
+                                                          xidx=df_ij.ix_min.astype(int),
+                                                          datedim='time')
             else:
                 raise ValueError("A 'level' argument was provided but netCDF does not have a level dimension")
         else:
-            df_ij[varname] = (sourcef[varname].isel(
-                date=xr.DataArray(df_ij.date_index, dims='z'),
-                x=xr.DataArray(df_ij.ix_min.astype(int), dims='z'),
-                y=xr.DataArray(df_ij.iy_min.astype(int), dims='z'))).values
+            df_ij[varname], gatherstats = chunkgather(sourcef[varname],
+                                                      dateidx=df_ij.date_index,
+                                                      yidx=df_ij.iy_min.astype(int),
+                                                      xidx=df_ij.ix_min.astype(int))
+        print('{0} chunks decoded, {1:.1f} MB read'.format(gatherstats['chunks'], gatherstats['bytes']/1e6))
 
         #Delete intermediate columns
         #print('Deleting indices columns')
@@ -383,6 +1193,350 @@ def extractCDFtoDF(indf, incdf, indir, varname, keepcols=None, datecol = None, l
         raise ValueError('{} already exists and overwrite==False, '
                          'either set overwrite==True or change outfile'.format(outfile))
 
+def opencdfvar(ncfile, varname, level=None):
+    """Lazily open the data variable of a netcdf file (e.g. a yearly NARR file or a statistics computed with
+    narr_daynightstat or narr_d36stat) as a DataArray with date, y, x dimensions, without loading any value.
+    varname (required): name of the output variable (e.g. air.2m_mean), the data variable in the file is either the
+        only data variable of the file or varname up to the first '.'
+    level (optional): if the netcdf has multiple pressure levels, which level to extract. If a rechunked copy of the
+        file was registered for this level (see registerrechunked), it is opened instead"""
+    rechunked = rechunkedpath(ncfile, level)
+    if rechunked is not None:
+        ncfile, level = rechunked, None
+    xrd = xr.open_dataset(ncfile)
+    if 'shifted_date' in xrd.dims:
+        xrd = xrd.rename({'shifted_date': 'date'})
+    elif 'date' not in xrd.dims and 'time' in xrd.dims:
+        xrd = xrd.rename({'time': 'date'})
+
+    datavars = list(xrd.data_vars.keys())
+    if len(datavars) == 1:
+        da = xrd[datavars[0]]
+    elif varname.split('.')[0] in datavars:
+        da = xrd[varname.split('.')[0]]
+    else:
+        da = xrd[varname]
+
+    if 'level' in da.dims:
+        if level is None:
+            raise ValueError('{} has multiple pressure levels, provide a level argument'.format(ncfile))
+        da = da.isel(level=int(np.where(da['level'].values == level)[0][0]))
+    elif level is not None:
+        raise ValueError("A 'level' argument was provided but netCDF does not have a level dimension")
+    return(da.rename(varname).transpose('date', 'y', 'x'))
+
+def chunkbounds(da, dim, defaultchunk=100):
+    """Start index of each chunk of a DataArray along a dimension: storage chunks of the netcdf variable if chunked,
+    otherwise dask chunks if the array is backed by dask, otherwise blocks of defaultchunk"""
+    n = da.sizes[dim]
+    storagechunks = da.encoding.get('chunksizes')
+    if storagechunks is not None and da.encoding.get('original_shape') == da.shape:
+        return(np.arange(0, n, storagechunks[list(da.dims).index(dim)]))
+    if da.chunks is not None:
+        return(np.concatenate([[0], np.cumsum(da.chunks[list(da.dims).index(dim)])[:-1]]))
+    return(np.arange(0, n, defaultchunk))
+
+def chunkgather(da, dateidx, yidx, xidx, datedim='date'):
+    """Values of a (date, y, x) DataArray at a set of (date, y, x) index triples, in the same order.
+    Triples are grouped by chunk (see chunkbounds) so that each chunk is read and decompressed once, all the points
+    that fall in it are taken from memory, and the values are scattered back to the original order.
+    Returns the array of values and a dictionary with the number of chunks decoded and bytes read (uncompressed)"""
+    dims = [datedim, 'y', 'x']
+    idx = [np.asarray(i, dtype=np.int64) for i in [dateidx, yidx, xidx]]
+    bounds = [chunkbounds(da, dim) for dim in dims]
+    ends = [np.append(b[1:], da.sizes[dim]) for b, dim in zip(bounds, dims)]
+    chunkidx = [np.searchsorted(b, i, side='right') - 1 for b, i in zip(bounds, idx)]
+
+    #Sort points by chunk, then split into runs of points in the same chunk
+    chunkcode = np.ravel_multi_index(chunkidx, [len(b) for b in bounds])
+    order = np.argsort(chunkcode, kind='mergesort')
+    runstarts = np.flatnonzero(np.diff(np.concatenate([[-1], chunkcode[order]])))
+    runends = np.append(runstarts[1:], len(order))
+
+    values = np.full(len(order), np.nan, dtype=da.dtype if da.dtype.kind == 'f' else np.float64)
+    stats = {'chunks': 0, 'bytes': 0, 'points': len(order)}
+    for start, end in zip(runstarts, runends):
+        pts = order[start:end]
+        c = [ci[pts[0]] for ci in chunkidx]
+        lo = [b[ci] for b, ci in zip(bounds, c)]
+        block = da.isel({dim: slice(b[ci], e[ci]) for dim, b, e, ci in zip(dims, bounds, ends, c)}). \
+            transpose(*dims).values
+        values[pts] = block[idx[0][pts] - lo[0], idx[1][pts] - lo[1], idx[2][pts] - lo[2]]
+        stats['chunks'] += 1
+        stats['bytes'] += block.nbytes
+    return(values, stats)
+
+def stationdates(indf, idcol='UID', datecol='date'):
+    "Unique station-dates (idcol, datecol, x, y) of a table, with dates as datetime and sorted by station and date"
+    df = indf[[idcol, datecol, 'x', 'y']].drop_duplicates(subset=[idcol, datecol])
+    df = df.assign(**{idcol: df[idcol].astype(str)})
+    if df[datecol].dtype.name != 'datetime64[ns]':
+        df[datecol] = pd.to_datetime(df[datecol], format='%Y-%m-%d')
+    return(df.sort_values([idcol, datecol], kind='mergesort').reset_index(drop=True))
+
+def extractCDFstoDF(indf, vardict, outfile=None, datecol='date', idcol='UID', level=None, overwrite=False):
+    """Extract netcdf values of multiple variables at a set of station-dates in a single pass.
+    Each netcdf file is opened once, the grid cell of each station and the date index of each station-date are
+    computed once for all variables, and values are gathered chunk by chunk so that each chunk is read once
+    (see chunkgather).
+
+    :param indf: table of station-dates with idcol, x, y (in the projection of the netcdf grid) and datecol columns
+    :param vardict: dictionary of output variable names (e.g. air.2m_mean) to lists of netcdf files (e.g. yearly files)
+    :param outfile: parquet file to write the wide table of station-dates (idcol, datecol) and variables to. Each
+        variable is also written to its own parquet file in a directory named after outfile (outfile_vars) as soon as
+        it is extracted, so that a rerun only extracts variables that failed or were not extracted yet
+    :param datecol: date column in the dataframe
+    :param idcol: station identifier column in the dataframe
+    :param level: if netcdf have multiple pressure levels, which level to extract
+    :param overwrite: False or True, whether to overwrite outfile and variables already extracted
+    Returns the wide table, sorted by idcol and datecol. Variables that could not be extracted are missing
+    """
+    vardir = None
+    if outfile is not None:
+        vardir = '{}_vars'.format(os.path.splitext(outfile)[0])
+        if not os.path.exists(vardir):
+            os.mkdir(vardir)
+        if os.path.exists(outfile) and not overwrite and \
+                all(os.path.exists(os.path.join(vardir, '{}.parquet'.format(var))) for var in vardict):
+            print('{} already exists and overwrite==False, reading it...'.format(outfile))
+            return(pd.read_parquet(outfile))
+
+    df = stationdates(indf, idcol, datecol)
+
+    #Date of each station-date as an index in the array of unique dates
+    datecodes, uniquedates = pd.factorize(df[datecol], sort=True)
+    uniquedates = pd.DatetimeIndex(uniquedates)
+
+    gridcache = {}
+    failedlist = []
+    for var in vardict:
+        varfile = os.path.join(vardir, '{}.parquet'.format(var)) if vardir is not None else None
+        if varfile is not None and os.path.exists(varfile) and not overwrite:
+            print('{} already extracted, reading it...'.format(var))
+            df[var] = df[[idcol, datecol]].merge(pd.read_parquet(varfile), on=[idcol, datecol], how='left')[var].values
+            continue
+
+        print('Extracting {}...'.format(var))
+        values = np.full(len(df), np.nan, dtype=np.float32)
+        varstats = {'chunks': 0, 'bytes': 0}
+        try:
+            for ncfile in sorted(vardict[var]):
+                da = opencdfvar(ncfile, var, level=level)
+                try:
+                    #Grid cell of each station, computed once for each distinct grid
+                    gridkey = (da['x'].shape[0], float(da['x'][0]), da['y'].shape[0], float(da['y'][0]))
+                    if gridkey not in gridcache:
+                        iy, ix = getclosest_ij_arr(da['x'].values, da['y'].values, df['x'].values, df['y'].values)
+                        gridcache[gridkey] = (iy, ix)
+                    iy, ix = gridcache[gridkey]
+
+                    #Index of each unique date in the file (-1 if not in the file), then of each station-date
+                    filedateidx = pd.DatetimeIndex(da['date'].values).get_indexer(uniquedates)[datecodes]
+                    infile = np.where(filedateidx >= 0)[0]
+                    if len(infile) > 0:
+                        values[infile], filestats = chunkgather(da, filedateidx[infile], iy[infile], ix[infile])
+                        varstats['chunks'] += filestats['chunks']
+                        varstats['bytes'] += filestats['bytes']
+                finally:
+                    da.close()
+        except Exception:
+            traceback.print_exc()
+            print('Skipping {}...'.format(var))
+            failedlist.append(var)
+            df[var] = np.full(len(df), np.nan, dtype=np.float32)
+            continue
+
+        df[var] = values
+        print('{0} values extracted from {1} chunks ({2:.1f} MB read)'.format(
+            len(df), varstats['chunks'], varstats['bytes']/1e6))
+        if varfile is not None:
+            pq.write_table(pa.Table.from_pandas(df[[idcol, datecol, var]], preserve_index=False), varfile + '.tmp')
+            if os.path.exists(varfile):
+                os.remove(varfile)
+            os.rename(varfile + '.tmp', varfile)
+
+    if len(failedlist) > 0:
+        print('{} could not be extracted and were left missing...'.format(', '.join(failedlist)))
+    df = df.drop(columns=['x', 'y'])
+    if outfile is not None:
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), outfile + '.tmp')
+        if os.path.exists(outfile):
+            os.remove(outfile)
+        os.rename(outfile + '.tmp', outfile)
+    return(df)
+
+def stationdaykey(uids, dates, uidcats):
+    """Integer key of station-dates: code of the UID in uidcats (upper 32 bits) and number of days since 1970
+    (lower 32 bits). Station-dates whose UID is not in uidcats or whose date is missing get a key of -1"""
+    uidcodes = pd.Categorical(pd.Series(uids).astype(str).values, categories=uidcats).codes.astype(np.int64)
+    days = pd.to_datetime(pd.Series(dates)).values.astype('datetime64[D]')
+    key = (uidcodes << 32) + (days.astype(np.int64) + 2**31)
+    key[(uidcodes < 0) | np.isnat(days)] = -1
+    return(key)
+
+def collatestationdays(df, sources, idcol='UID', datecol='date', sourcedatecol=None, columns=None, how='left'):
+    """Add the columns of tables of station-days (e.g. written by extractCDFstoDF) to a table of records in a single
+    allocation, rather than with successive merges. The (idcol, datecol) key of df is computed once, each source is
+    aligned to it with an index lookup, and all new columns are assembled at once.
+    df (required): table to add columns to, can have multiple records per station-date
+    sources (required): list of parquet files or DataFrames with unique (idcol, sourcedatecol) records
+    sourcedatecol (optional): date column in sources, datecol by default
+    columns (optional): list of columns to add, all columns of sources by default. Columns already in df are skipped
+    how (optional): 'left' keeps all records of df, 'inner' only those found in at least one source"""
+    if sourcedatecol is None:
+        sourcedatecol = datecol
+    uidcats = pd.unique(df[idcol].astype(str))
+    dfkey = stationdaykey(df[idcol], df[datecol], uidcats)
+
+    newcols = {}
+    found = np.zeros(len(df), dtype=bool)
+    for source in sources:
+        if isinstance(source, pd.DataFrame):
+            sdf = source
+        else:
+            sdf = pq.read_table(source, columns=None if columns is None else
+                                [idcol, sourcedatecol] + list(columns)).to_pandas()
+        if columns is not None:
+            sdf = sdf[[idcol, sourcedatecol] + [c for c in columns if c in sdf.columns]]
+        sourceindex = pd.Index(stationdaykey(sdf[idcol], sdf[sourcedatecol], uidcats))
+        if not sourceindex[sourceindex >= 0].is_unique:
+            raise ValueError('Station-dates are not unique in {}'.format(
+                source if not isinstance(source, pd.DataFrame) else 'DataFrame'))
+        pos = sourceindex.get_indexer(dfkey)
+        pos[dfkey < 0] = -1
+        found |= pos >= 0
+        for col in sdf.columns:
+            if col in [idcol, sourcedatecol] or col in df.columns or col in newcols:
+                continue
+            newcols[col] = pd.api.extensions.take(sdf[col].values, pos, allow_fill=True)
+
+    if how == 'inner':
+        df = df[found]
+        newcols = {col: vals[found] for col, vals in newcols.items()}
+    elif how != 'left':
+        raise ValueError("how should be 'left' or 'inner'")
+    return(pd.concat([df, pd.DataFrame(newcols, index=df.index)], axis=1))
+
+def AQSUID(df):
+    "Unique site identifier from AQS State Code, County Code, Site Num and the last three characters of coordinates"
+    return(df['State Code'].astype(str).str.zfill(2) + \
+           df['County Code'].astype(str) + \
+           df['Site Num'].astype(str) + \
+           df["Latitude"].astype(str).str[-3:] + \
+           df["Longitude"].astype(str).str[-3:])
+
+def readAQSzip(inzip, usecols, dtype, paramregex=None, paramexclregex=None, UIDset=None, chunksize=10**6):
+    """Read the csv table in an EPA AQS daily data zip file (e.g. daily_SPEC_2018.zip) in chunks, without extracting it.
+    Yields chunks that only contain usecols (typed with dtype, 'Date Local' parsed as dates), the records of
+    parameters whose name matches paramregex and not paramexclregex, and the records of sites in UIDset, with a UID
+    column (see AQSUID). Parameter names are matched once per unique name rather than for every record"""
+    with zipfile.ZipFile(inzip) as zipf:
+        csvname = [f for f in zipf.namelist() if os.path.splitext(f)[1] == '.csv'][0]
+        with zipf.open(csvname) as csvf:
+            for chunk in pd.read_csv(csvf, usecols=lambda c: c in usecols, dtype=dtype, parse_dates=['Date Local'],
+                                     chunksize=chunksize):
+                if paramregex is not None or paramexclregex is not None:
+                    params = pd.Series(chunk['Parameter Name'].unique()).astype(str)
+                    keep = pd.Series(True, index=params.index)
+                    if paramregex is not None:
+                        keep &= params.str.contains(paramregex)
+                    if paramexclregex is not None:
+                        keep &= ~params.str.contains(paramexclregex)
+                    chunk = chunk[chunk['Parameter Name'].isin(params[keep])]
+                chunk = chunk.assign(UID=AQSUID(chunk))
+                if UIDset is not None:
+                    chunk = chunk[chunk['UID'].isin(UIDset)]
+                if len(chunk) > 0:
+                    yield chunk
+
+def AQSziptoparquet(ziplist, outdir, usecols, dtype, paramregex=None, paramexclregex=None, UIDset=None,
+                    chunksize=10**6):
+    """Ingest a list of EPA AQS daily data zip files into a parquet dataset partitioned by year (see readAQSzip),
+    so that the full table never needs to be held in memory. UID is stored as a categorical column"""
+    partdir = outdir + '_part'
+    if os.path.exists(partdir):
+        shutil.rmtree(partdir)
+    schema = None
+    for inzip in ziplist:
+        print('Ingesting {}...'.format(os.path.split(inzip)[1]))
+        for chunk in readAQSzip(inzip, usecols, dtype, paramregex=paramregex, paramexclregex=paramexclregex,
+                                UIDset=UIDset, chunksize=chunksize):
+            chunk = chunk.assign(UID=chunk['UID'].astype('category'), year=chunk['Date Local'].dt.year)
+            if schema is None:
+                schema = arrowschema(chunk)
+            pq.write_to_dataset(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False),
+                                root_path=partdir, partition_cols=['year'])
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.rename(partdir, outdir)
+
+def writestationdays(df, outdir, datecol='Date Local', append=False, row_group_size=50000):
+    """Write a table of station-day records to a parquet store partitioned by year and state (year=YYYY/state=SS),
+    sorted by UID and date within each partition so that row group statistics allow skipping data when querying
+    by site or date (see readstationdays).
+    df (required): table with a UID column (starting with the two-digit state code) and a datecol column
+    append (optional): whether to add the records to an existing store, otherwise the store is replaced"""
+    df = df.assign(UID=df['UID'].astype(str))
+    df = df.assign(year=df[datecol].dt.year, state=df['UID'].str[:2]).sort_values(['UID', datecol], kind='mergesort')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if append:
+        pq.write_to_dataset(table, root_path=outdir, partition_cols=['year', 'state'], row_group_size=row_group_size)
+    else:
+        partdir = outdir + '_part'
+        if os.path.exists(partdir):
+            shutil.rmtree(partdir)
+        pq.write_to_dataset(table, root_path=partdir, partition_cols=['year', 'state'], row_group_size=row_group_size)
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.rename(partdir, outdir)
+
+def stationdaystore(indir, outdir, datecol='Date Local'):
+    """Build a station-day parquet store (see writestationdays) from a dataset partitioned by year
+    (e.g. written by AQSziptoparquet), processing one year at a time to bound memory use"""
+    partdir = outdir + '_part'
+    if os.path.exists(partdir):
+        shutil.rmtree(partdir)
+    for yeardir in sorted(glob.glob(os.path.join(indir, 'year=*'))):
+        print('Processing {}...'.format(os.path.split(yeardir)[1]))
+        writestationdays(pd.read_parquet(yeardir), partdir, datecol=datecol, append=True)
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.rename(partdir, outdir)
+
+def readstationdays(indir, UIDs=None, startdate=None, enddate=None, params=None, columns=None,
+                    datecol='Date Local', paramcol='Parameter Name'):
+    """Query a station-day parquet store (see writestationdays). Partitions of other years and states are not read,
+    records are then filtered by UID, date and parameter.
+    UIDs (optional): list of site UIDs to load
+    startdate, enddate (optional): range of dates to load (inclusive)
+    params (optional): list of parameter names to load (values of paramcol)
+    columns (optional): list of columns to load, all columns by default
+    Returns a DataFrame without the year and state partition columns"""
+    #Partition values are parsed as integers (e.g. state=06 as 6) by pyarrow, so states are filtered as integers and
+    #padded back to strings. pyarrow.dataset (explicit partition schema) is not available for python 2
+    partfilters = []
+    rowfilters = {}
+    if UIDs is not None:
+        UIDs = sorted(set(str(uid) for uid in UIDs))
+        partfilters.append(('state', 'in', sorted(set(int(uid[:2]) for uid in UIDs))))
+        rowfilters['UID'] = lambda col: col.astype(str).isin(UIDs)
+    if startdate is not None or enddate is not None:
+        startdate = pd.Timestamp(startdate) if startdate is not None else pd.Timestamp.min
+        enddate = pd.Timestamp(enddate) if enddate is not None else pd.Timestamp.max
+        partfilters.extend([('year', '>=', startdate.year), ('year', '<=', enddate.year)])
+        rowfilters[datecol] = lambda col: (col >= startdate) & (col <= enddate)
+    if params is not None:
+        rowfilters[paramcol] = lambda col: col.isin(list(params))
+    readcols = None if columns is None else list(columns) + [c for c in rowfilters if c not in columns]
+    df = pq.ParquetDataset(indir, filters=partfilters if len(partfilters) > 0 else None). \
+        read(columns=readcols).to_pandas()
+    for col, f in rowfilters.items():
+        df = df[f(df[col]).values]
+    if 'state' in df.columns:
+        df['state'] = df['state'].astype(int).astype(str).str.zfill(2)
+    dropcols = ['year', 'state'] if columns is None else [c for c in df.columns if c not in columns]
+    return(df.drop(columns=[c for c in dropcols if c in df.columns]).reset_index(drop=True))
+
 #-----------------------------------------------------------------------------------------------------------------------
 # SELECT SITES THAT RECORD CHEMICAL CONCENTRATIONS
 #-----------------------------------------------------------------------------------------------------------------------
@@ -491,162 +1645,84 @@ for var in varfolder_dic:
 # COMPUTE DERIVED VARIABLES
 # Does not include wind direction
 #-----------------------------------------------------------------------------------------------------------------------
-#-------------- subset datasets by pressure level
-subsetNARRlevel(indir=NARRdir, pattern = 'hgt.*.nc', sel_level = 850, outnc = os.path.join(NARRoutdir, 'hgt.850.nc'))
-subsetNARRlevel(indir=NARRdir, pattern = 'vwnd.2*.nc', sel_level = 500, outnc = os.path.join(NARRoutdir, 'vwnd.500.nc'))
-subsetNARRlevel(indir=NARRdir, pattern = 'air.20*.nc', sel_level = 700, outnc = os.path.join(NARRoutdir, 'air.700.nc'))
+#Raw NARR variables: yearly files, and monthly files of variables at multiple pressure levels
+for var in ['pottmp.sfc', 'uwnd.10m', 'vwnd.10m', 'crain', 'air.sfc', 'shum.2m', 'dswrf', 'lftx4', 'air.2m', 'rhum.2m',
+            'pres.sfc']:
+    registernarrvar({var: os.path.join(NARRdir, '{}.{{year}}.nc'.format(var))})
+for var in ['hgt', 'vwnd', 'air']:
+    registernarrvar({var: os.path.join(NARRdir, '{}.{{year}}[0-9][0-9].nc'.format(var))})
+
+#Subset datasets by pressure level
+for var, level in [('hgt', 850), ('vwnd', 500), ('air', 700)]:
+    registernarrvar({'{0}.{1}'.format(var, level): os.path.join(NARRoutdir, '{0}.{1}.nc'.format(var, level))},
+                    narrreg_level, {'source': var}, {'level': level})
 
-#-------------- compute derived variables -------------------
 #lts
 # (lower-tropospheric stability) = potential temperatures (700 hPa) - potential temperatures (surface)
 #To compute potential temperature at 700 hPa: PT700 = Temperature @ 700 hPa * (standard pressure/700)^(gas constant/specific heat)
 #with standard pressure = 1000 hPa and gas constant/specific heat =  0.286
 #So lts = (temperature_700*(1000/700)^0.286)- potential temp_surface
-
-air700 = xr.open_dataset(os.path.join(NARRoutdir, 'air.700.nc'), chunks={'time':20}).drop('level')
-for yeardat in glob.glob(os.path.join(NARRdir, 'pottmp.sfc.*.nc')):
-    print('Processing {}...'.format(yeardat))
-    outdat = os.path.join(NARRoutdir,
-                          'lts.{}.nc'.format(re.compile('[0-9]{4}').search(os.path.split(yeardat)[1]).group()))
-    if not os.path.exists(outdat):
-        with xr.open_dataset(yeardat, chunks={'time': 20}) as pottmp_sfc:
-            airpottmp_join = xr.merge([air700, pottmp_sfc], join='inner')
-            airpottmp_join['pottmp700'] = airpottmp_join.air*pow(1000.0/700.0, 0.286)
-            lts = airpottmp_join.pottmp700 - airpottmp_join.pottmp
-            ltsdt = lts.to_dataset(name  ='lts')
-            print('Saving to netdcdf. This might take a while... {}'.format(outdat))
-            ltsdt.to_netcdf(outdat)
-            del lts
-            del ltsdt
-    else:
-        print('{} already exists, skipping...'.format(outdat))
+registernarrvar({'lts': os.path.join(NARRoutdir, 'lts.{year}.nc')}, narrreg_lts,
+                {'air700': 'air.700', 'pottmp': 'pottmp.sfc'})
 
 #wspd (windspeed at 10 m) and rpi (recirculation potential index) = 1 - L/S
 #the vector sum magnitude (L) and scalar sum (S) of surface wind speeds over the previous 24 h (Allwine and Whitemane 1994)
 #https://www.sciencedirect.com/science/article/abs/pii/1352231094900485
 #L = sqrt((3*sumforpast24h(uwind))^2+(3*sumforpast24h(vwind))^2)
 #S = 3*sumoverpast24h(uwind^2+vwind^2)^1/2
-for yr in range(2014, 2020):
-    print('Processing {}...'.format(yr))
-    outwspd = os.path.join(NARRoutdir, 'wspd.10m.{}.nc'.format(yr))
-    outrpi = os.path.join(NARRoutdir, 'rpi.{}.nc'.format(yr))
-
-    if not (os.path.exists(outrpi) and os.path.exists(outwspd)):
-        uvw = xr.merge([xr.open_dataset(os.path.join(NARRdir, 'uwnd.10m.{}.nc'.format(yr)),
-                                        chunks={'x': 10, 'y': 10}),
-                        xr.open_dataset(os.path.join(NARRdir, 'vwnd.10m.{}.nc'.format(yr)),
-                                        chunks={'x': 10, 'y': 10}).vwnd])
-        # Compute wspd
-        if not os.path.exists(outwspd):
-            wspd = pow(uvw.uwnd**2 + uvw.vwnd**2, 0.5)
-            wspddt = wspd.to_dataset(name='wspd')
-            print('Saving {} to netcdf. This might take hours...'.format(outwspd))
-            wspddt.to_netcdf(outwspd)
-            del wspd
-            del wspddt
-
-        # Compute rpi
-        if not os.path.exists(outrpi):
-            #Used .construct('window').sum('window') rather than simply .sum() due to MemoryError issues (see https://github.com/pydata/xarray/issues/3165)
-            rpi = (pow((3*uvw.uwnd.rolling(time=8, center=False, min_periods=8).construct('window').sum('window')**2) +
-                       (3*uvw.vwnd.rolling(time=8, center=False, min_periods=8).construct('window').sum('window')**2), 0.5)/
-                   3*pow(uvw.uwnd**2 + uvw.vwnd**2, 0.5).rolling(time=8, center=False, min_periods=8).construct('window').sum('window'))
-
-            # Can easily lead to memory error. Switching to single-threaded scheduler did not help
-            # Need to chunk but will likely also lead to error if chunking across time — must mess with the rolling
-            # Lazy computing pushes all calculations to .to_netcdf
-            # If does not work again. Try doing a first rolling, saving. Then another rolling, saving. Then combining, etc.
-            rpidt = rpi.to_dataset(name  ='rpi')
-            print('Saving {} to netcdf. This might take hours...'.format(outrpi))
-            rpidt.to_netcdf(outrpi)
-
-            del rpi
-            del rpidt
-            del uvw
-
-    else:
-        print('{} already exists, skipping...'.format(outdat))
-
-#crain_9x9
-for yeardat in glob.glob(os.path.join(NARRdir, 'crain.*.nc')):
-    print('Processing {}...'.format(yeardat))
-    outdat = os.path.join(NARRoutdir, '{}_9x9.nc'.format(os.path.splitext(os.path.split(yeardat)[1])[0]))
-    if not os.path.exists(outdat):
-        with xr.open_dataset(yeardat, chunks={'time':292}) as crainf:
-            crainroll = crainf['crain'].rolling(y=9, center=True).mean().rolling(x=9, center=True).mean()
-            crainrolldt = crainroll.to_dataset(name='crain')
-            crainrolldt.to_netcdf(outdat)
-        del crainroll
-        del crainrolldt
-    else:
-        print('{} already exists, skipping...'.format(outdat))
-
-#air.sfc 9x9
-for yeardat in glob.glob(os.path.join(NARRdir, 'air.sfc*.nc')):
-    print('Processing {}...'.format(yeardat))
-    outdat = os.path.join(NARRoutdir, '{}_9x9.nc'.format(os.path.splitext(os.path.split(yeardat)[1])[0]))
-    if not os.path.exists(outdat):
-        with xr.open_dataset(yeardat, chunks={'time':5}) as airsfcf:
-            airsfcroll = airsfcf['air'].rolling(y=9, center=True).mean().rolling(x=9, center=True).mean()
-            airsfcrolldt = airsfcroll.to_dataset(name='air')
-            airsfcrolldt.to_netcdf(outdat)
-        del airsfcroll
-    else:
-        print('{} already exists, skipping...'.format(outdat))
-
-#Night/Day stats
-narr_daynightstat(indir=NARRdir, regexpattern='shum[.]2m.*[.]nc',
-                  outdir=NARRoutdir, statlist=['mean', 'min'])
-narr_daynightstat(indir=NARRdir, regexpattern='dswrf.*[.]nc',
-                  outdir=NARRoutdir, dnlist=['day'], statlist=['min'])
-narr_daynightstat(indir=NARRdir, regexpattern='lftx4.*[.]nc',
-                  outdir=NARRoutdir, dnlist=['night'], statlist=['min'])
-narr_daynightstat(indir=NARRdir, regexpattern='lts.*[.]nc',
-                  outdir=NARRoutdir, dnlist=['day'], statlist=['min'])
-narr_daynightstat(indir=NARRoutdir, regexpattern='wspd[.]10m[.][0-9]{4}[.]nc',
-                  outdir=NARRoutdir, statlist=['mean', 'min', 'max'])
-narr_daynightstat(indir=NARRoutdir, regexpattern='crain[.][0-9]{4}[_]9x9[.]nc',
-                  outdir=NARRoutdir, dnlist=['night'], statlist=['max'])
-narr_daynightstat(indir=NARRoutdir, regexpattern='vwnd[.]500[.]nc',
-                  outdir=NARRoutdir, dnlist=['day'], statlist=['max'])
-narr_daynightstat(indir=NARRoutdir, regexpattern='air[.]sfc[.][0-9]{4}_9x9[.]nc',
-                  outdir=NARRoutdir, dnlist=['night'], statlist=['min'])
-
-#Compute 1-, 3- and 6-day maxima, minima, and means
-narr_d36stat(indir=NARRoutdir, regexpattern='crain[.][0-9]{4}[_]9x9[.]nc',
-             outdir=NARRoutdir, dstat = 'max', multidstat = {6: 'mean'})
-narr_d36stat(indir=NARRoutdir, regexpattern='dswrf.*daymin.*[.]nc',
-             outdir=NARRoutdir, multidstat = {6: 'max'})
-narr_d36stat(indir=NARRdir, regexpattern='air[.]2m.*[.]nc',
-             outdir=NARRoutdir, dstat = 'max')
-narr_d36stat(indir=NARRoutdir, regexpattern='shum[.]2m[.][0-9]{4}_nightmin[.]nc',
-             outdir=NARRoutdir, multidstat = {6: 'mean'})
-narr_d36stat(indir=NARRoutdir, regexpattern='lftx4[.][0-9]{4}_nightmin[.]nc',
-             outdir=NARRoutdir, multidstat = {3: 'mean'})
-narr_d36stat(indir=NARRdir, regexpattern='rhum[.]2m[.][0-9]{4}[.]nc',
-             outdir=NARRoutdir, dstat = 'mean')
-narr_d36stat(indir=NARRoutdir, regexpattern='air[.]sfc.[0-9]{4}_9x9_nightmin[.]nc',
-             outdir=NARRoutdir,multidstat= {6: 'max'})
-narr_d36stat(indir=NARRoutdir, regexpattern='vwnd[.]500_daymax[.]nc',
-             outdir=NARRoutdir,multidstat= {6: 'max'})
-narr_d36stat(indir=NARRoutdir, regexpattern='shum[.]2m[.][0-9]{4}_daymean[.]nc',
-             outdir=NARRoutdir, dstat='diff')
-narr_d36stat(indir=NARRdir, regexpattern='pres[.]sfc[.][0-9]{4}[.]nc',
-             outdir=NARRoutdir, dstat='max')
-narr_d36stat(indir=NARRoutdir, regexpattern='rpi[.][0-9]{4}[.]nc',
-             outdir=NARRoutdir, dstat='max')
-narr_d36stat(indir=NARRoutdir, regexpattern='wspd[.]10m[.][0-9]{4}_daymax[.]nc',
-             outdir=NARRoutdir, multidstat = {3: 'max'})
-narr_d36stat(indir=NARRoutdir, regexpattern='wspd[.]10m[.][0-9]{4}[.]nc',
-             outdir=NARRoutdir, dstat = 'max', multidstat = {3: 'min'})
-narr_d36stat(indir=NARRoutdir, regexpattern='wspd[.]10m[.][0-9]{4}[.]nc',
-             outdir=NARRoutdir, dstat = 'max', multidstat = {3: 'mean'})
-narr_d36stat(indir=NARRdir, regexpattern='lftx4.*[.]nc',
-             outdir=NARRoutdir, dstat = 'mean')
-narr_d36stat(indir=NARRoutdir, regexpattern='vwnd[.]500[.]nc',
-             outdir=NARRoutdir, dstat = 'min')
-narr_d36stat(indir=NARRoutdir, regexpattern='hgt[.]850[.]nc',
-             outdir=NARRoutdir, dstat='max', multidstat = {6: 'max'})
+registernarrvar({'wspd.10m': os.path.join(NARRoutdir, 'wspd.10m.{year}.nc'),
+                 'rpi': os.path.join(NARRoutdir, 'rpi.{year}.nc')}, narrreg_wspdrpi, {'uwnd': 'uwnd.10m', 'vwnd': 'vwnd.10m'})
+
+#crain_9x9 and air.sfc 9x9
+for var in ['crain', 'air.sfc']:
+    registernarrvar({'{}_9x9'.format(var): os.path.join(NARRoutdir, '{}.{{year}}_9x9.nc'.format(var))},
+                    narrreg_boxsmooth, {'source': var}, {'window': 9})
+
+#Night/Day stats: (variable, periods, statistics)
+narr_daynightspecs = [
+    ('shum.2m', ['day', 'night'], ['mean', 'min']),
+    ('dswrf', ['day'], ['min']),
+    ('lftx4', ['night'], ['min']),
+    ('lts', ['day'], ['min']),
+    ('wspd.10m', ['day', 'night'], ['mean', 'min', 'max']),
+    ('crain_9x9', ['night'], ['max']),
+    ('vwnd.500', ['day'], ['max']),
+    ('air.sfc_9x9', ['night'], ['min']),
+]
+for var, dnlist, statlist in narr_daynightspecs:
+    registerdaynight(var, NARRoutdir, dnlist, statlist)
+
+#1-, 3- and 6-day maxima, minima, and means: (variable, daily statistics, multi-day statistics)
+narr_d36specs = [
+    ('crain_9x9', 'max', {6: 'mean'}),
+    ('dswrf_daymin', None, {6: 'max'}),
+    ('air.2m', 'max', None),
+    ('shum.2m_nightmin', None, {6: 'mean'}),
+    ('lftx4_nightmin', None, {3: 'mean'}),
+    ('rhum.2m', 'mean', None),
+    ('air.sfc_9x9_nightmin', None, {6: 'max'}),
+    ('vwnd.500_daymax', None, {6: 'max'}),
+    ('shum.2m_daymean', 'diff', None),
+    ('pres.sfc', 'max', None),
+    ('rpi', 'max', None),
+    ('wspd.10m_daymax', None, {3: 'max'}),
+    ('wspd.10m', 'max', {3: 'min'}),
+    ('wspd.10m', 'max', {3: 'mean'}),
+    ('lftx4', 'mean', None),
+    ('vwnd.500', 'min', None),
+    ('hgt.850', 'max', {6: 'max'}),
+]
+for var, dstat, multidstat in narr_d36specs:
+    registerd36(var, NARRoutdir, dstat, multidstat)
+
+#In station mode, derived variables and statistics are only computed at air quality station cells after sites are
+#projected (see EXTRACT ALL METEOROLOGICAL VARIABLES FOR EACH STATION-DATE COMBINATION)
+if not narrstationmode:
+    #Compute the covariates of Porter et al. 2015 available in the registry and the variables they depend on
+    narrcovars = sorted(set([var for var in porter2015_covarlist if var in narrvars]))
+    print('Covariates not derived from NARR: {}'.format(
+        sorted(set([var for var in porter2015_covarlist if var is not None and var not in narrvars]))))
+    requestnarrvars(narrcovars, years=yearlist, memofile=os.path.join(NARRoutdir, '_narrvars.json'))
 
 #-----------------------------------------------------------------------------------------------------------------------
 # CREATE POINT SHAPEFILE AND BUFFER
@@ -724,28 +1800,26 @@ yearlist = range(2014, 2020)
 epadl_url = "https://aqs.epa.gov/aqsweb/airdata/"
 spec25_list = [os.path.join(epadl_url, "daily_SPEC_{}.zip".format(year)) for year in yearlist]
 spec10_list = [os.path.join(epadl_url, "daily_PM10SPEC_{}.zip".format(year)) for year in yearlist]
-for file in spec25_list + spec10_list:
-    dlfile(file, outpath=os.path.join(AQIdir))
-
-#Collate all data
+dlbatch(spec25_list + spec10_list, outpath=AQIdir, cachedir=dlcachedir, extract=False)
+
+#Ingest data straight from zip files, only reading the columns needed with compact types and only keeping records
+#of chemical elements at selected sites (see AQSziptoparquet)
+airdat_usecols = ['State Code', 'County Code', 'Site Num', 'Parameter Code', 'POC', 'Latitude', 'Longitude', 'Datum',
+                  'Parameter Name', 'Sample Duration', 'Date Local', 'Units of Measure', 'Event Type',
+                  'Observation Count', 'Observation Percent', 'Arithmetic Mean', '1st Max Value', 'Method Code']
+airdat_df_dtypes = {'State Code': 'category', 'County Code': 'category', 'Site Num': 'category',
+                    'Parameter Code': 'category', 'POC': 'category', 'Latitude': np.float64, 'Longitude':np.float64,
+                    'Datum': 'category', 'Parameter Name': 'category', 'Sample Duration': 'category',
+                    'Units of Measure': 'category', 'Event Type': 'category', 'Observation Count': np.int32,
+                    'Observation Percent': np.float32, 'Arithmetic Mean': np.float32, '1st Max Value': np.float32,
+                    'Method Code': 'category'} #Keep coordinates as float64 as UID is computed from their string representation
 if not os.path.exists(airdatall):
-    mergedel(AQIdir, 'daily_.*SPEC.*[0-9]{4,6}[.]csv$', airdatall, verbose=True)
-airdat_df_dtypes = {'State Code':np.object, 'County Code':np.object, 'Site Num':np.object, 'Parameter Code': np.object,
-                    'Latitude': np.float64, 'Longitude':np.float64, 'Datum':np.object, 'Parameter Name':np.object,
-                    'Sample Duration':np.object, 'Pollutant Standard': np.object, 'Date Local': np.object,
-                    'Units of Measure': np.object, 'Event Type': np.object, 'Observation Count': int,
-                    'Observation Percent':np.float16, 'Arithmetic Mean': np.float64, '1st Max Value': np.float32,
-                    '1st Max Hour': np.float32, 'AQI': np.object, 'Method Code': np.object, 'Method Name': np.object,
-                    'Local Site Name': np.object, 'Address': np.object, 'State Name': np.object,'County Name': np.object,
-                    'City Name': np.object, 'CBSA Name': np.object, 'Date of Last Change': np.object}
-airdat_df = pd.read_csv(airdatall, dtype= airdat_df_dtypes, parse_dates=['Date Local', 'Date of Last Change'])
-
-print('Compute unique ID for each monitoring site...')
-airdat_df['UID'] = airdat_df['State Code'].astype(str).str.zfill(2) + \
-                   airdat_df['County Code'].astype(str) + \
-                   airdat_df['Site Num'].astype(str) + \
-                   airdat_df["Latitude"].astype(str).str[-3:] + \
-                   airdat_df["Longitude"].astype(str).str[-3:]
+    AQSziptoparquet([os.path.join(AQIdir, os.path.split(url)[1]) for url in spec25_list + spec10_list],
+                    outdir=airdatall, usecols=airdat_usecols, dtype=airdat_df_dtypes,
+                    paramregex=elems_regex, paramexclregex=elemsout_regex, UIDset=set(sites_gpd_lambers['UID']))
+if not os.path.exists(airdatstore):
+    stationdaystore(airdatall, airdatstore, datecol='Date Local')
+airdat_df = readstationdays(airdatstore, UIDs=sites_gpd_lambers['UID'])
 
 #-----------------------------------------------------------------------------------------------------------------------
 # FORMAT AQI DATA
@@ -776,47 +1850,73 @@ else:
 #-----------------------------------------------------------------------------------------------------------------------
 # EXTRACT ALL METEOROLOGICAL VARIABLES FOR EACH STATION-DATE COMBINATION
 #-----------------------------------------------------------------------------------------------------------------------
-#Make dictionnary of netcdf files to extract to air quality stations
-vardict = defaultdict(list)
-for netc in getfilelist(NARRoutdir, re.compile('.*(mean|max|min|diff).*[.]nc')):
-    vardict[re.sub(r'[0-9]{4}_', '', os.path.splitext(os.path.split(netc)[1])[0])].append(netc)
+narrjoin_pq = os.path.join(rootdir, 'results/daily_SPEC_NARR.parquet')
+narrvar_regex = re.compile('.*(mean|max|min|diff).*[.]nc')
+
+if narrstationmode and not os.path.exists(narrjoin_pq):
+    #Extract time series of raw NARR variables at station cells (and their 9x9 neighbourhood for smoothed variables)
+    #then compute derived variables and statistics on these compact arrays, in the same sequence as for the entire grid
+    narrsites = pd.DataFrame(sites_gpd_lambers.drop(columns='geometry')).drop_duplicates(subset='UID')
+    narrcells = (narrsites['UID'].astype(str).values,) + \
+                stationcells(glob.glob(os.path.join(NARRdir, 'air.sfc*.nc'))[0],
+                             narrsites['x'].values, narrsites['y'].values)
+    narrstore = {}
+
+    #Rechunk raw NARR files read in station mode so that station time series are read from a few tiles of each file
+    if narrrechunk:
+        narr_rechunkspecs = [('hgt.*.nc', 850), ('vwnd.2*.nc', 500), ('air.20*.nc', 700), ('pottmp.sfc.*.nc', None),
+                             ('uwnd.10m.*.nc', None), ('vwnd.10m.*.nc', None), ('crain.*.nc', None),
+                             ('air.sfc*.nc', None), ('shum.2m*.nc', None), ('dswrf*.nc', None), ('lftx4*.nc', None),
+                             ('air.2m*.nc', None), ('rhum.2m*.nc', None), ('pres.sfc*.nc', None)]
+        for pattern, level in narr_rechunkspecs:
+            narr_rechunkstore(NARRdir, pattern, NARRrechunkdir, level=level)
+    if os.path.exists(os.path.join(NARRrechunkdir, '_index.json')):
+        registerrechunked(NARRrechunkdir)
+
+    station_subsetlevel(narrstore, NARRdir, 'hgt.*.nc', 850, os.path.join(NARRoutdir, 'hgt.850.nc'), narrcells)
+    station_subsetlevel(narrstore, NARRdir, 'vwnd.2*.nc', 500, os.path.join(NARRoutdir, 'vwnd.500.nc'), narrcells)
+    station_subsetlevel(narrstore, NARRdir, 'air.20*.nc', 700, os.path.join(NARRoutdir, 'air.700.nc'), narrcells)
+    station_lts(narrstore, os.path.join(NARRoutdir, 'air.700.nc'), glob.glob(os.path.join(NARRdir, 'pottmp.sfc.*.nc')),
+                NARRoutdir, narrcells)
+    for yr in range(2014, 2020):
+        station_wspdrpi(narrstore, uwndnc=os.path.join(NARRdir, 'uwnd.10m.{}.nc'.format(yr)),
+                        vwndnc=os.path.join(NARRdir, 'vwnd.10m.{}.nc'.format(yr)),
+                        outwspd=os.path.join(NARRoutdir, 'wspd.10m.{}.nc'.format(yr)),
+                        outrpi=os.path.join(NARRoutdir, 'rpi.{}.nc'.format(yr)), cells=narrcells)
+    station_boxmean(narrstore, glob.glob(os.path.join(NARRdir, 'crain.*.nc')), 'crain', NARRoutdir, narrcells)
+    station_boxmean(narrstore, glob.glob(os.path.join(NARRdir, 'air.sfc*.nc')), 'air', NARRoutdir, narrcells)
+
+    for var, dnlist, statlist in narr_daynightspecs:
+        indir, pattern = narrvarpattern(var)
+        station_daynightstat(narrstore, indir=indir, regexpattern=pattern, outdir=NARRoutdir, cells=narrcells,
+                             dnlist=dnlist, statlist=statlist)
+    for var, dstat, multidstat in narr_d36specs:
+        indir, pattern = narrvarpattern(var)
+        station_d36stat(narrstore, indir=indir, regexpattern=pattern, outdir=NARRoutdir, cells=narrcells,
+                        dstat=dstat, multidstat=multidstat)
+
+    stationstoDF(indf=airdat_uniquedfproj, store=narrstore, outdir=NARRoutdir, regexpattern=narrvar_regex,
+                 outfile=narrjoin_pq, datecol='date', idcol='UID')
+    del narrstore
+else:
+    #Make dictionnary of netcdf files to extract to air quality stations
+    vardict = defaultdict(list)
+    for netc in getfilelist(NARRoutdir, narrvar_regex):
+        vardict[re.sub(r'[0-9]{4}_', '', os.path.splitext(os.path.split(netc)[1])[0])].append(netc)
 
-#Iterate through variables to extract
-for var in vardict:
-    try:
-        print('Processing {}...'.format(var))
-        extractCDFtoDF(indf = airdat_uniquedfproj, incdf= vardict[var], indir=NARRdir, varname=var,
-                       datecol = 'date', keepcols = ['UID', 'date', 'x', 'y', var], overwrite=False,
-                       outfile= os.path.join(rootdir, 'results/daily_SPEC_{}.p'.format(var.replace('.', '_'))))
-    except Exception:
-        traceback.print_exc()
-        print('Skipping...')
-        pass
+    #Extract all variables in a single pass to a wide table of station-dates
+    extractCDFstoDF(indf=airdat_uniquedfproj, vardict=vardict, outfile=narrjoin_pq, datecol='date', idcol='UID',
+                    overwrite=False)
 
 #Collate all air data
 try:
     airdat_climmerge = airdat_df
 except:
-    airdat_climmerge = pd.read_csv(airdatall, dtype= airdat_df_dtypes, parse_dates=['Date Local', 'Date of Last Change'])
-    print('Compute unique ID for each monitoring site...')
-    airdat_climmerge['UID'] = airdat_climmerge['State Code'].astype(str).str.zfill(2) + \
-                              airdat_climmerge['County Code'].astype(str) + \
-                              airdat_climmerge['Site Num'].astype(str) + \
-                              airdat_climmerge["Latitude"].astype(str).str[-3:] + \
-                              airdat_climmerge["Longitude"].astype(str).str[-3:]
-
-plist = [os.path.join(rootdir, 'results/daily_SPEC_{}.p'.format(var.replace('.', '_'))) for var in vardict]
-with open(plist[0], "rb") as input_file:
-    narrjoin = pickle.load(input_file)
-for pname in plist:
-    if pname != plist[0]:
-        print(pname)
-        with open(pname, "rb") as input_file:
-            indf = pickle.load(input_file)
-        narrjoin = narrjoin.merge(indf.drop(columns=['x', 'y']), on=['UID', 'date'], how='outer')
-        print(narrjoin.shape)
-narrjoin['Date Local'] = narrjoin['date']
-airdat_climmerge = airdat_climmerge.merge(narrjoin, on=['UID', 'Date Local'])
+    airdat_climmerge = readstationdays(airdatstore)
+
+airdat_climmerge = collatestationdays(airdat_climmerge, [narrjoin_pq], datecol='Date Local', sourcedatecol='date',
+                                      how='inner')
+airdat_climmerge['date'] = airdat_climmerge['Date Local']
 
 #-----------------------------------------------------------------------------------------------------------------------
 # EXTRACT SMOKE DATA FOR EACH STATION-DATE COMBINATION
@@ -914,7 +2014,8 @@ sites_smoke_stat = sites_smoke_stat.set_index(['UID', 'fcdate']). \
     join(roll3d, on=['UID', 'fcdate']).join(roll6d, on=['UID', 'fcdate']).reset_index().rename(columns={'fcdate':'date'})
 
 #Merge air quality station + NARR data with smoke variables
-airdat_climmerge = pd.merge(airdat_climmerge, sites_smoke_stat, on=['UID', 'date'], how='left')
+airdat_climmerge = collatestationdays(airdat_climmerge, [sites_smoke_stat], datecol='date', how='left')
 
 #Write out data to table (should use feather but some module conflicts and don't want to deal with it)
-airdat_climmerge.to_csv(os.path.join(rootdir, 'results/airdat_NARRjoin.csv'))
\ No newline at end of file
+airdat_climmerge.to_csv(os.path.join(rootdir, 'results/airdat_NARRjoin.csv'))
+writestationdays(airdat_climmerge, os.path.join(rootdir, 'results/airdat_NARRjoin.parquet'), datecol='date')
\ No newline at end of file
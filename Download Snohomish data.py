@@ -8,54 +8,22 @@ import arcpy
 from os import *
 import itertools
 import glob
+from Download_gist import *
 arcpy.env.overwriteOutput = True
 
-#Download road data for snohomish county
+#Download road data for snohomish county (see Download_gist.RESTdownload)
 baseURL = "http://gismaps.snoco.org/snocogis/rest/services/transportation/transportation/MapServer/11/query"
 outdir = "C:/Mathis/ICSL/stormwater/data/Snohomish_20180602"
 arcpy.env.workspace = outdir
 name='snocoroads'
-IDrange = range(0,100000, 1000)
-for i,j in itertools.izip(IDrange, IDrange[1:]):
-    where = "OBJECTID>{0} AND OBJECTID<{1}".format(i,j)
-    #&geometryType=esriGeometryPoint
-    query = "?where={}&returnGeometry=true&f=json".format(where)
-    fsURL = baseURL + query
-    fs = arcpy.FeatureSet()
-    fs.load(fsURL)
-    if long(arcpy.GetCount_management(fs)[0])>0 :
-        name = '{0}_{1}_{2}'.format(name,i,j)
-        arcpy.CopyFeatures_management(fs, name)
-        print(name)
-    else:
-        break
-        print('Downloaded up to {} features'.format(i))
-
-arcpy.Merge_management(arcpy.ListFeatureClasses('snocoroads_*.shp'),output='snocoroads.shp')
-for fc in arcpy.ListFeatureClasses('snocoroads_*.shp'):
-    arcpy.Delete_management(fc)
-#
+RESTdownload(baseURL, outfile=os.path.join(outdir, '{}.gpkg'.format(name)), itersize=1000)
+arcpy.CopyFeatures_management(os.path.join(outdir, '{}.gpkg'.format(name), 'main.{}'.format(name)), '{}.shp'.format(name))
 
 #Download
 baseURL = "http://gismaps.snoco.org/snocogis/rest/services/transportation/transportation_infrastructure/MapServer/19/query"
-outdir = "C:/Mathis/ICSL/stormwater/data/Snohomish_20180602"
-arcpy.env.workspace = outdir
 name='snocorow'
-IDrange = range(0,100000, 1000)
-for i,j in itertools.izip(IDrange, IDrange[1:]):
-    where = "OBJECTID>{0} AND OBJECTID<{1}".format(i,j)
-    #&geometryType=esriGeometryPoint
-    query = "?where={}&returnGeometry=true&f=json".format(where)
-    fsURL = baseURL + query
-    fs = arcpy.FeatureSet()
-    fs.load(fsURL)
-    if long(arcpy.GetCount_management(fs)[0])>0 :
-        name = '{0}_{1}_{2}'.format(name,i,j)
-        arcpy.CopyFeatures_management(fs, name)
-        print(name)
-    else:
-        break
-        print('Downloaded up to {} features'.format(i))
+RESTdownload(baseURL, outfile=os.path.join(outdir, '{}.gpkg'.format(name)), itersize=1000)
+arcpy.CopyFeatures_management(os.path.join(outdir, '{}.gpkg'.format(name), 'main.{}'.format(name)), '{}.shp'.format(name))
 
 
 
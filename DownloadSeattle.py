@@ -9,6 +9,7 @@ import arcpy
 from os import *
 import itertools
 import glob
+from Download_gist import *
 arcpy.env.overwriteOutput = True
 
 #Folder structure
@@ -31,36 +32,9 @@ arcpy.env.workspace = FEMAdraftgdb
 
 
 
-#Input geometry
-
-
-def APIdownload(URL, name, itersize, ingeom, proj):
-    if ingeom is str and
-
-
-    IDrange = range(0,10000000, itersize)
-    for i,j in itertools.izip(IDrange, IDrange[1:]):
-        where = "OBJECTID>{0} AND OBJECTID<{1}".format(i,j)
-        #&geometryType=esriGeometryPoint
-        query = "?where={}&&text=&objectIds=&time=&geometry=&geometryType=esriGeometryPolygon&inSR=&\
-        spatialRel=esriSpatialRelIntersects&relationParam=&outFields=*&returnGeometry=true&returnTrueCurves=false&\
-        maxAllowableOffset=&geometryPrecision=&outSR=&returnIdsOnly=false&returnCountOnly=false&orderByFields=&\
-        groupByFieldsForStatistics=&outStatistics=&returnZ=false&returnM=false&gdbVersion=&returnDistinctValues=false&\
-        resultOffset=&resultRecordCount=&queryByDistance=&returnExtentsOnly=false&datumTransformation=&parameterValues=&\
-        rangeValues=&f=pjson".format(where)
-        fsURL = URL + query
-        fs = arcpy.FeatureSet()
-        fs.load(fsURL)
-        if long(arcpy.GetCount_management(fs)[0])>0 :
-            outname = '{0}_{1}_{2}'.format(name,i,j)
-            arcpy.CopyFeatures_management(fs, outname)
-            print(outname)
-        else:
-            break
-            print('Downloaded up to {} features'.format(i))
-    arcpy.Merge_management(arcpy.ListFeatureClasses('{}_*'.format(name)),output='{}'.format(name))
-    for fc in arcpy.ListFeatureClasses('{}_*'.format(name)):
-        arcpy.Delete_management(fc)
-
-APIdownload("https://hazards.fema.gov/gis/nfhl/rest/services/PrelimPending/Prelim_NFHL/MapServer/24/query",
-            'S_Fld_Haz_Ar', 100)
\ No newline at end of file
+#Download layer from REST API (see Download_gist.RESTdownload)
+FEMAprelim = os.path.join(FEMAdraftdir, 'S_Fld_Haz_Ar.gpkg')
+if not os.path.exists(FEMAprelim):
+    RESTdownload("https://hazards.fema.gov/gis/nfhl/rest/services/PrelimPending/Prelim_NFHL/MapServer/24/query",
+                 outfile=FEMAprelim, itersize=100)
+arcpy.CopyFeatures_management(os.path.join(FEMAprelim, 'main.S_Fld_Haz_Ar'), 'S_Fld_Haz_Ar')
@@ -2,16 +2,34 @@ import os
 import re
 import requests
 import pandas as pd
+import geopandas as gpd
 import zipfile
 import gzip
 import io
 import csv
-import arcpy
 import itertools
 import traceback
-import urlparse
 import sys
 import ftplib
+import hashlib
+import json
+import time
+import shutil
+import tempfile
+import threading
+import contextlib
+from functools import partial
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+from multiprocessing.pool import ThreadPool
+from shapely.geometry import Point, MultiPoint, LineString, MultiLineString, LinearRing, Polygon, \
+    MultiPolygon
 
 #Function to download and unzip miscellaneous types of files
 #Partly inspired from https://www.codementor.io/aviaryan/downloading-files-from-urls-in-python-77q3bs0un
@@ -20,13 +38,108 @@ def getfilelist(dir, repattern):
             for (dirpath, dirnames, filenames) in os.walk(dir)
             for file in filenames if re.search(repattern, file)]
 
-def mergedel(dir, repattern, outfile, delete=False, verbose=False):
+def arrowschema(df):
+    """Arrow schema of a DataFrame chunk that stays the same across chunks: object columns are always strings
+    (even if all null in this chunk) and categorical columns are dictionaries of strings"""
+    import pyarrow as pa
+    fields = []
+    for col in df.columns:
+        if str(df[col].dtype) == 'category':
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), pa.string())))
+        elif pd.api.types.is_string_dtype(df[col].dtype) or df[col].dtype == object:
+            fields.append(pa.field(col, pa.string()))
+        elif pd.api.types.is_datetime64_any_dtype(df[col].dtype):
+            fields.append(pa.field(col, pa.timestamp('ns')))
+        elif df[col].dtype == 'float16': #Not supported by parquet
+            fields.append(pa.field(col, pa.float32()))
+        else:
+            fields.append(pa.field(col, pa.from_numpy_dtype(df[col].dtype)))
+    return(pa.schema(fields))
+
+def kwaymerge(runlist, outfile, sortcol, chunksize=500000, **kwargs):
+    """Merge CSV files that are each sorted on sortcol into a single sorted CSV, holding about chunksize rows in
+    memory in total: each input is read in chunks of chunksize/len(runlist) rows. At each step, all rows with a key
+    lower or equal to the smallest of the last keys in memory are sorted and written out, and the inputs whose chunk
+    was exhausted are read further.
+    kwargs are passed to pandas.read_csv"""
+    runchunk = max(1, chunksize//max(1, len(runlist)))
+    readers = [pd.read_csv(run, chunksize=runchunk, **kwargs) for run in runlist]
+    buffers = [next(reader, None) for reader in readers]
+    first = True
+    with open(outfile, 'w') as output:
+        while any(b is not None for b in buffers):
+            active = [i for i, b in enumerate(buffers) if b is not None]
+            bound = min(buffers[i][sortcol].iloc[-1] for i in active)
+            outlist = []
+            for i in active:
+                n = buffers[i][sortcol].searchsorted(bound, side='right')
+                outlist.append(buffers[i].iloc[:n])
+                buffers[i] = buffers[i].iloc[n:]
+                while buffers[i] is not None and len(buffers[i]) == 0:
+                    buffers[i] = next(readers[i], None)
+            pd.concat(outlist, axis=0).sort_values(sortcol, kind='mergesort') \
+                .to_csv(output, header=first, index=False)
+            first = False
+
+def mergedel(dir, repattern, outfile, delete=False, verbose=False, dtype=None, parse_dates=None, sortcol=None,
+             partitioncol=None, chunksize=500000):
+    """Merge all tables in dir whose name matches repattern, streaming them in chunks of chunksize rows so that
+    the full merged table is never held in memory.
+    outfile (required): if it ends in .csv, a single CSV sorted on sortcol, produced by sorting each chunk to a
+        temporary run file and merging the runs (see kwaymerge). Otherwise, a parquet dataset partitioned by the year
+        of partitioncol (one directory year=YYYY per year)
+    delete (optional): whether to delete input tables once merged
+    dtype, parse_dates (optional): schema of input tables passed to pandas.read_csv, so that all chunks have the
+        same column types
+    sortcol (optional): column to sort CSV output on, defaults to the first column (parsed as a date if
+        parse_dates is not provided)
+    partitioncol (optional): date column used to partition parquet output by year, defaults to sortcol"""
     flist = getfilelist(dir, repattern)
-    pd.concat([pd.read_csv(file, index_col=[0], parse_dates=[0])
-               for file in flist],
-              axis=0) \
-        .sort_index() \
-        .to_csv(outfile)
+    if len(flist) == 0:
+        print('No table matching {0} in {1}...'.format(repattern, dir))
+        return
+    if sortcol is None:
+        sortcol = pd.read_csv(flist[0], nrows=0).columns[0]
+        if parse_dates is None:
+            parse_dates = [sortcol]
+    if partitioncol is None:
+        partitioncol = sortcol
+    readargs = {'dtype': dtype, 'parse_dates': parse_dates if parse_dates is not None else False}
+
+    if os.path.splitext(outfile)[1] == '.csv':
+        rundir = tempfile.mkdtemp(dir=os.path.split(os.path.abspath(outfile))[0])
+        try:
+            #Write sorted runs of at most chunksize rows
+            runlist = []
+            for file in flist:
+                for chunk in pd.read_csv(file, chunksize=chunksize, **readargs):
+                    runlist.append(os.path.join(rundir, 'run{}.csv'.format(len(runlist))))
+                    chunk.sort_values(sortcol, kind='mergesort').to_csv(runlist[-1], index=False)
+                if verbose == True:
+                    print('Sorted {}'.format(file))
+            kwaymerge(runlist, outfile + '.tmp', sortcol, chunksize=chunksize, **readargs)
+            movefile(outfile + '.tmp', outfile)
+        finally:
+            shutil.rmtree(rundir)
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        partdir = outfile + '_part'
+        if os.path.exists(partdir):
+            shutil.rmtree(partdir)
+        schema = None
+        for file in flist:
+            for chunk in pd.read_csv(file, chunksize=chunksize, **readargs):
+                chunk['year'] = pd.to_datetime(chunk[partitioncol]).dt.year
+                if schema is None:
+                    schema = arrowschema(chunk)
+                pq.write_to_dataset(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False),
+                                    root_path=partdir, partition_cols=['year'])
+            if verbose == True:
+                print('Merged {}'.format(file))
+        if os.path.exists(outfile):
+            shutil.rmtree(outfile)
+        os.rename(partdir, outfile)
     print('Merged and written to {}'.format(outfile))
 
     if delete == True:
@@ -73,144 +186,742 @@ def unzip(infile):
     else:
         raise ValueError('Not a zip file')
 
-def dlfile(url, outpath, outfile=None, fieldnames=None):
+def dlfile(url, outpath, outfile=None, fieldnames=None, cachedir=None, revalidate=True):
     """Function to download file from URL path and unzip it.
     URL (required): URL of file to download
     outpath (required): the full path including
     outfile (optional): the output name without file extension, otherwise gets it from URL
-    fieldnames (optional): fieldnames in output table if downloading plain text"""
+    fieldnames (optional): fieldnames in output table if downloading plain text
+    cachedir (optional): directory of a download cache shared across scripts (see dlstream)
+    The file is streamed to disk, resumed if interrupted, and only renamed to its final name once complete
+    (see dlstream)"""
+    return(dlstream(url, outpath, outfile=outfile, fieldnames=fieldnames, cachedir=cachedir, revalidate=revalidate))
+
+def getoutname(url, outpath, outfile=None, headers=None):
+    """Get output path for a download: outfile + URL file extension if outfile is provided,
+    otherwise the name from the content-disposition header if any, otherwise the last part of the URL"""
+    if outfile is not None:
+        return(os.path.join(outpath, outfile + os.path.splitext(urlparse.urlparse(url).path)[1]))
+    if headers is not None and headers.get('content-disposition'):
+        fname = re.findall('filename=(.+)', headers.get('content-disposition'))
+        if len(fname) > 0:
+            return(os.path.join(outpath, fname[0].strip('"\' ')))
+    return(os.path.join(outpath, os.path.split(urlparse.urlparse(url).path)[1]))
 
+def dlsession(maxworkers=8):
+    "requests.Session with a connection pool large enough for maxworkers concurrent downloads"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=maxworkers, pool_maxsize=maxworkers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return(session)
+
+def readpartinfo(partfile):
+    "Read the validator (ETag or Last-Modified) recorded for a partial download, if any"
     try:
-        if is_downloadable(url): #check that url is not just html
-            # Get output file name
-            if outfile is None:
-                outfile = get_filename_from_cd(url)
-                if outfile is not None:
-                    out = os.path.join(outpath, outfile)
-                else:
-                    out = os.path.join(outpath, os.path.split(url)[1])
-            else:
-                out = os.path.join(outpath, outfile + os.path.splitext(url)[1])
-            del outfile
-
-            #http request
-            f = requests.get(url, allow_redirects=True)
-            print "downloading " + url
-
-            # Open local file for writing
-            if not os.path.exists(out):
-                if 'csv' in f.headers.get('content-type').lower(): #If csv file
-                    df = pd.read_csv(io.StringIO(f.text))
-                    df.to_csv(out, index=False)
-
-                elif f.headers.get('content-type').lower() == 'text/plain': #If plain text
-                    dialect = csv.Sniffer().sniff(f.text)
-                    txtF = csv.DictReader(f.text.split('\n'),
-                                          delimiter=dialect.delimiter,
-                                          fieldnames=fieldnames)
-                    with open(out, "wb") as local_file:
-                        writer = csv.DictWriter(local_file, fieldnames=fieldnames)
-                        writer.writeheader()
-                        for row in txtF:
-                            writer.writerow(row)
-
-                elif f.headers.get('content-type').lower() == 'application/x-gzip':
-                    outunzip = os.path.splitext(out)[0]
-
-                    #Very inelegant. But trying to download and decompress in memory always messes up files
-                    response = requests.get(url, stream=True)
-                    if response.status_code == 200:
-                        with open(out, 'wb') as f:
-                            f.write(response.raw.read())
-                    with gzip.GzipFile(out, 'rb') as input:
-                        s = input.read()
-                        with open(outunzip, 'wb') as output:
-                            output.write(s)
-
-                else: #Otherwise, just try reading
-                    try: #Try writing to local file
-                        with open(out, "wb") as local_file:
-                            local_file.write(f.read())
-                        # Unzip downloaded file
-                        try:
-                            unzip(out + '.zip')
-                        except:
-                            z = zipfile.ZipFile(io.BytesIO(f.content))
-                            if isinstance(z, zipfile.ZipFile):
-                                z.extractall(os.path.split(out)[0])
-                    except Exception: #If fails and is zip, directly download zip in memory
-                        print('Try downloading zip in memory...')
-                        os.remove(out)
-                        if os.path.splitext(url)[1] == '.zip':
-                            z = zipfile.ZipFile(io.BytesIO(f.content))
-            else:
-                print('{} already exists...'.format(out))
+        with open(partfile + '.info') as f:
+            return(f.read().strip() or None)
+    except (IOError, OSError):
+        return(None)
+
+def writepartinfo(partfile, headers):
+    "Record the validator (ETag or Last-Modified) of a partial download to allow resuming it with If-Range"
+    validator = headers.get('etag') or headers.get('last-modified')
+    if validator is not None:
+        with open(partfile + '.info', 'w') as f:
+            f.write(validator)
+    elif os.path.exists(partfile + '.info'):
+        os.remove(partfile + '.info')
+
+def removepart(partfile):
+    "Delete a partial download and its validator"
+    for f in [partfile, partfile + '.info']:
+        if os.path.exists(f):
+            os.remove(f)
+
+def movefile(src, dst):
+    "Rename src to dst, replacing dst if it exists (os.rename does not on Windows)"
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def addfieldnames(infile, fieldnames, chunksize=2**20):
+    """Rewrite a plain text delimited table with a header row of fieldnames, line by line.
+    The delimiter is sniffed from the first chunk of the file"""
+    with open(infile, 'r') as f:
+        dialect = csv.Sniffer().sniff(f.read(chunksize))
+    with open(infile, 'r') as f, open(infile + '.tmp', 'w') as output:
+        txtF = csv.DictReader(f, delimiter=dialect.delimiter, fieldnames=fieldnames)
+        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        writer.writeheader()
+        for row in txtF:
+            writer.writerow(row)
+    movefile(infile + '.tmp', infile)
+
+def gunzip(infile, chunksize=2**20):
+    "Decompress a gzip file in a streaming pass to the same path without the .gz extension, atomically"
+    outunzip = os.path.splitext(infile)[0]
+    try:
+        with gzip.open(infile, 'rb') as input, open(outunzip + '.part', 'wb') as output:
+            shutil.copyfileobj(input, output, chunksize)
+    except Exception:
+        if os.path.exists(outunzip + '.part'):
+            os.remove(outunzip + '.part')
+        raise
+    movefile(outunzip + '.part', outunzip)
+    return(outunzip)
+
+#Lock shared by download threads to update the download cache manifest
+manifestlock = threading.Lock()
+
+def filehash(infile, blocksize=2**20):
+    "sha256 hash of the content of a file, read by blocks"
+    h = hashlib.sha256()
+    with open(infile, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return(h.hexdigest())
+
+def readmanifest(cachedir):
+    """Read the manifest of a download cache: dictionary by URL of dictionaries with the ETag, Last-Modified,
+    size and sha256 of the payload, the file name it was downloaded under, and the output paths it was written to"""
+    manifest = os.path.join(cachedir, 'manifest.json')
+    if not os.path.exists(manifest):
+        return({})
+    with open(manifest, 'r') as f:
+        return(json.load(f))
+
+def writemanifest(cachedir, manifestdict):
+    "Write the manifest of a download cache atomically"
+    manifest = os.path.join(cachedir, 'manifest.json')
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump(manifestdict, f, indent=1, sort_keys=True)
+    movefile(manifest + '.tmp', manifest)
+
+def cacheblob(cachedir, sha256):
+    "Path of the payload with a given sha256 in a download cache"
+    return(os.path.join(cachedir, 'blobs', sha256[:2], sha256))
+
+def linkfile(src, dst):
+    "Hard link src to dst if possible (same drive, os.link available), otherwise copy it. Written atomically"
+    try:
+        if os.path.exists(dst + '.tmp'):
+            os.remove(dst + '.tmp')
+        os.link(src, dst + '.tmp')
+    except (AttributeError, OSError):
+        shutil.copyfile(src, dst + '.tmp')
+    movefile(dst + '.tmp', dst)
+
+def cacheget(cachedir, url):
+    "Manifest entry of a URL in a download cache, if its payload is still in the cache"
+    with manifestlock:
+        entry = readmanifest(cachedir).get(url)
+    if entry is not None and os.path.exists(cacheblob(cachedir, entry['sha256'])):
+        return(entry)
+    return(None)
+
+def cacheput(cachedir, url, out, headers):
+    """Add a downloaded file to a download cache and record it in the manifest.
+    Payloads are stored once by sha256, so identical files downloaded from different URLs or to different output
+    paths share the same copy in the cache; out is then replaced by a hard link to it where possible."""
+    sha256 = filehash(out)
+    blob = cacheblob(cachedir, sha256)
+    with manifestlock:
+        if not os.path.exists(blob):
+            if not os.path.exists(os.path.split(blob)[0]):
+                os.makedirs(os.path.split(blob)[0])
+            linkfile(out, blob)
         else:
-            print('File not downloadable...')
+            linkfile(blob, out)
+        manifestdict = readmanifest(cachedir)
+        entry = manifestdict.get(url, {})
+        paths = entry.get('paths', []) if entry.get('sha256') == sha256 else []
+        if os.path.abspath(out) not in paths:
+            paths.append(os.path.abspath(out))
+        manifestdict[url] = {'etag': headers.get('etag'),
+                             'last_modified': headers.get('last-modified'),
+                             'size': os.path.getsize(out),
+                             'sha256': sha256,
+                             'name': os.path.split(out)[1],
+                             'paths': paths,
+                             'fetched': time.strftime('%Y-%m-%d %H:%M:%S')}
+        writemanifest(cachedir, manifestdict)
+    return(sha256)
+
+def cacherestore(cachedir, url, entry, out):
+    "Write the cached payload of a URL to out and record out in the manifest"
+    linkfile(cacheblob(cachedir, entry['sha256']), out)
+    with manifestlock:
+        manifestdict = readmanifest(cachedir)
+        if url in manifestdict and os.path.abspath(out) not in manifestdict[url]['paths']:
+            manifestdict[url]['paths'].append(os.path.abspath(out))
+            writemanifest(cachedir, manifestdict)
 
-    #handle errors
-    except requests.exceptions.HTTPError, e:
-        print "HTTP Error:", e.code, url
+def postdownload(url, out, status, extract=True, fieldnames=None, chunksize=2**20):
+    """Add fieldnames to plain text tables and unzip/decompress a downloaded file. Returns the dlstream output tuple,
+    with status 'failed' if the file could not be processed (e.g. a .gz file that is not gzip data)"""
+    try:
+        if fieldnames is not None and not zipfile.is_zipfile(out):
+            addfieldnames(out, fieldnames, chunksize)
+        if extract:
+            if zipfile.is_zipfile(out):
+                unzip(out)
+            elif os.path.splitext(out)[1] == '.gz':
+                gunzip(out, chunksize)
     except Exception:
         traceback.print_exc()
-        if os.path.exists(out):
-            os.remove(out)
-
-def APIdownload(baseURL, workspace, basename, itersize, IDlist, geometry):
-    IDrange = range(IDlist[0], IDlist[1], itersize)
-    arcpy.env.workspace = workspace
-
-    for i, j in itertools.izip(IDrange, IDrange[1:]):
-        itertry = itersize
-        downlist = []
-        # It seems like REST API server also has a limitation on the size of the downloads so sometimes won't allow
-        # Therefore, if fails to download, try smaller increments until reaches increments of 2 if still fails at increments
-        # of 2, then throw a proper error and break
-        while True:
+        print('Could not process {}...'.format(out))
+        return((url, out, 'failed'))
+    return((url, out, status))
+
+
+def dlstream(url, outpath, outfile=None, session=None, hostlimits=None, retries=3, backoff=1,
+             chunksize=2**20, timeout=60, extract=True, fieldnames=None, cachedir=None, revalidate=True):
+    """Download a file with a streamed GET request, writing it to disk in chunks.
+    The file is written to <output path>.part and only renamed to its final name once its size has been checked
+    against the size announced by the server, so that interrupted downloads are never mistaken for complete files.
+    If a .part file is left from a previous attempt (or a dropped connection), the download is resumed with an HTTP
+    Range request, conditional on the ETag/Last-Modified of the partial file being unchanged (If-Range).
+    url (required): URL of file to download
+    outpath (required): directory where the file is written
+    outfile (optional): the output name without file extension, otherwise gets it from content-disposition or URL
+    session (optional): requests.Session to reuse connections across downloads (see dlsession)
+    hostlimits (optional): dictionary of threading.BoundedSemaphore by host to limit concurrent requests per host
+    retries, backoff (optional): number of retries for connection errors, truncated downloads and 429/5xx
+        responses, waiting backoff*2^attempt seconds between attempts
+    extract (optional): whether to unzip zip files and decompress gzip files after download
+    fieldnames (optional): fieldnames in output table if downloading plain text
+    cachedir (optional): directory of a download cache (see cacheput). URLs already in the cache are revalidated with
+        a conditional request (If-None-Match/If-Modified-Since) and restored from the cache if unchanged (304)
+    revalidate (optional): if False, URLs already in the cache are restored without any request
+    Returns a tuple (url, output path or None, status) with status one of
+    'downloaded', 'cached', 'exists', 'not downloadable', 'missing' (HTTP 404/410), 'failed'"""
+    if session is None:
+        session = requests
+    #Skip without any request if the file already exists under its default name
+    out = getoutname(url, outpath, outfile)
+    if os.path.exists(out):
+        print('{} already exists...'.format(out))
+        return((url, out, 'exists'))
+    partfile = out + '.part'
+    host = urlparse.urlparse(url).netloc
+    hostlock = hostlimits.get(host) if hostlimits is not None else None
+
+    #Check download cache
+    entry = None
+    if cachedir is not None:
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        entry = cacheget(cachedir, url)
+        if entry is not None and not revalidate:
+            out = getoutname(url, outpath, outfile) if outfile is not None else os.path.join(outpath, entry['name'])
+            print('{} restored from cache...'.format(out))
+            cacherestore(cachedir, url, entry, out)
+            return(postdownload(url, out, 'cached', extract, fieldnames, chunksize))
+
+    out = None
+    for attempt in range(retries + 1):
+        try:
+            #Resume from partial file if its validator is known
+            headers = {}
+            offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+            validator = readpartinfo(partfile)
+            if offset > 0 and validator is not None:
+                headers = {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+            elif entry is not None: #Conditional request for cached URL
+                if entry.get('etag'):
+                    headers['If-None-Match'] = entry['etag']
+                if entry.get('last_modified'):
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+            if hostlock is not None:
+                hostlock.acquire()
             try:
-                IDrangetry = list(
-                    sorted(set(range(i, j + 1, itertry) + [j])))  # To make sure that the list goes until the maximum
-                # Loop with smaller increment within range
-                for k, l in itertools.izip(IDrangetry, IDrangetry[1:]):
-                    print('From {0} to {1}'.format(k, l))
-                    where = "OBJECTID>={0} AND OBJECTID<{1}".format(k, l)
-                    # &geometryType=esriGeometryPoint
-                    query = "?where={0}&returnGeometry={1}&f=json&outFields=*".format(where, str(geometry).lower())
-                    fsURL = baseURL + query
-                    if geometry == True:
-                        fs = arcpy.FeatureSet()
-                    elif geometry == False:
-                        fs = arcpy.RecordSet()
-                    else:
-                        raise ValueError('Invalid geometry argument: only boolean values are accepted')
-                    fs.load(fsURL)
-                    if long(arcpy.GetCount_management(fs)[0]) > 0:
-                        outname = '{0}_{1}_{2}'.format(basename, k, l)
-                        downlist.append(outname)
-                        if geometry == True:
-                            arcpy.CopyFeatures_management(fs, outname)
-                        else:
-                            arcpy.CopyRows_management(fs, '{}.csv'.format(outname))
-                        print(outname)
+                with contextlib.closing(session.get(url, headers=headers, stream=True, allow_redirects=True,
+                                                    timeout=timeout)) as r:
+                    if r.status_code in (429, 500, 502, 503, 504) and attempt < retries:
+                        raise requests.exceptions.RetryError('HTTP {}'.format(r.status_code))
+                    if r.status_code == 416: #Range not satisfiable, start over
+                        removepart(partfile)
+                        raise requests.exceptions.RetryError('HTTP 416')
+                    if r.status_code == 304 and entry is not None: #Unchanged since cached
+                        out = getoutname(url, outpath, outfile) if outfile is not None \
+                            else os.path.join(outpath, entry['name'])
+                        print('{} not modified, restored from cache...'.format(url))
+                        cacherestore(cachedir, url, entry, out)
+                        return(postdownload(url, out, 'cached', extract, fieldnames, chunksize))
+                    r.raise_for_status()
+                    #Check that url is not just html (replaces separate HEAD request)
+                    if 'html' in r.headers.get('content-type', '').lower():
+                        print('File not downloadable... {}'.format(url))
+                        return((url, None, 'not downloadable'))
+
+                    out = getoutname(url, outpath, outfile, headers=r.headers)
+                    if os.path.exists(out):
+                        print('{} already exists...'.format(out))
+                        return((url, out, 'exists'))
+
+                    #Only append if the server honoured the range for an unchanged file, otherwise start over
+                    newvalidator = r.headers.get('etag') or r.headers.get('last-modified')
+                    resume = (r.status_code == 206 and newvalidator == validator and
+                              r.headers.get('content-range', '').startswith('bytes {}-'.format(offset)))
+                    if not resume:
+                        offset = 0
+                        writepartinfo(partfile, r.headers)
+
+                    #Expected final size from Content-Range total or Content-Length
+                    expected = None
+                    if r.status_code == 206:
+                        total = r.headers.get('content-range', '').split('/')[-1]
+                        if total.isdigit():
+                            expected = int(total)
+                    elif r.headers.get('content-length', '').isdigit():
+                        expected = int(r.headers.get('content-length'))
+
+                    #Write raw bytes so that sizes match what the server announced. If the server applied a
+                    #content-encoding to a file that is not itself compressed, decode it and skip the size check
+                    encoding = r.headers.get('content-encoding', 'identity').lower()
+                    decode = encoding not in ('identity', '') and not url.lower().endswith('.gz')
+                    if decode:
+                        stream = r.iter_content(chunk_size=chunksize)
+                        expected = None
+                        offset = 0
                     else:
-                        print('No data from OBJECTID {0} to OBJECTID {1}'.format(k, l))
-                break
-            except:
-                if itertry > 5:
-                    print('Count not download, delete previous {0} datasets, try downloading in smaller increments'.format(
-                        len(downlist)))
-                    if len(downlist) > 0:
-                        for fc in downlist:
-                            arcpy.Delete_management(fc)
-                        downlist = []
-                    itertry = itertry / 2
+                        stream = r.raw.stream(chunksize, decode_content=False)
+
+                    print('{0} {1}'.format('resuming' if offset > 0 else 'downloading', url))
+                    with open(partfile, 'ab' if offset > 0 else 'wb') as local_file:
+                        for chunk in stream:
+                            if chunk:
+                                local_file.write(chunk)
+            finally:
+                if hostlock is not None:
+                    hostlock.release()
+
+            #Check that the file is complete before putting it in place
+            size = os.path.getsize(partfile)
+            if expected is not None and size != expected:
+                if size > expected:
+                    removepart(partfile)
+                raise requests.exceptions.ChunkedEncodingError(
+                    'Incomplete download ({0} of {1} bytes)'.format(size, expected))
+            movefile(partfile, out)
+            removepart(partfile)
+            if cachedir is not None:
+                cacheput(cachedir, url, out, r.headers)
+            break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.RetryError,
+                requests.packages.urllib3.exceptions.HTTPError) as e: #urllib3 errors raised when reading raw stream
+            #Partial file is kept to resume from it
+            if attempt < retries:
+                print('{0} for {1}, retrying in {2} s...'.format(e, url, backoff * 2 ** attempt))
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                print('Failed to download {0}: {1}'.format(url, e))
+                return((url, None, 'failed'))
+        except requests.exceptions.HTTPError as e:
+            print('HTTP Error: {0} {1}'.format(e.response.status_code, url))
+            if e.response.status_code in (404, 410): #Resource does not exist
+                return((url, None, 'missing'))
+            return((url, None, 'failed'))
+        except Exception:
+            traceback.print_exc()
+            removepart(partfile)
+            return((url, None, 'failed'))
+
+    return(postdownload(url, out, 'downloaded', extract, fieldnames, chunksize))
+
+def dlbatch(urllist, outpath, outfilelist=None, maxworkers=8, perhost=4, retries=3, backoff=1, extract=True,
+            cachedir=None, revalidate=True):
+    """Download a list of files concurrently with a bounded thread pool sharing a requests.Session connection pool.
+    Each file is downloaded with a single streamed request (see dlstream).
+    urllist (required): list of URLs to download
+    outpath (required): directory where files are written
+    outfilelist (optional): list of output names without file extension, of the same length as urllist
+    maxworkers (optional): maximum number of concurrent downloads
+    perhost (optional): maximum number of concurrent downloads from the same host
+    cachedir, revalidate (optional): download cache directory and whether to revalidate cached URLs (see dlstream)
+    Returns a list of (url, output path, status) tuples in the same order as urllist (see dlstream)"""
+    if outfilelist is None:
+        outfilelist = [None] * len(urllist)
+    session = dlsession(maxworkers)
+    hostlimits = {host: threading.BoundedSemaphore(perhost)
+                  for host in set(urlparse.urlparse(url).netloc for url in urllist)}
+
+    def dlworker(urlout):
+        return(dlstream(urlout[0], outpath, outfile=urlout[1], session=session, hostlimits=hostlimits,
+                        retries=retries, backoff=backoff, extract=extract, cachedir=cachedir,
+                        revalidate=revalidate))
+
+    p = ThreadPool(max(min(maxworkers, len(urllist)), 1))
+    try:
+        dlout = p.map(dlworker, list(zip(urllist, outfilelist)))
+    finally:
+        p.close()
+        p.join()
+        session.close()
+
+    missinglist = [url for url, out, status in dlout if status == 'missing']
+    if len(missinglist) > 0:
+        print('{} not found on server (HTTP 404/410)...'.format(','.join(missinglist)))
+    failedlist = [url for url, out, status in dlout if status == 'failed']
+    if len(failedlist) > 0:
+        print('{} failed to download...'.format(','.join(failedlist)))
+    return(dlout)
+
+#Correspondence between ArcGIS REST field types and arrow types, for a consistent schema across pages
+esrifieldtypes = {'esriFieldTypeOID': 'int64',
+                  'esriFieldTypeInteger': 'int64',
+                  'esriFieldTypeSmallInteger': 'int32',
+                  'esriFieldTypeDouble': 'float64',
+                  'esriFieldTypeSingle': 'float32',
+                  'esriFieldTypeDate': 'timestamp[ms]',
+                  'esriFieldTypeString': 'string',
+                  'esriFieldTypeGUID': 'string',
+                  'esriFieldTypeGlobalID': 'string'}
+
+def restrequest(URL, params, session=None, retries=3, backoff=1, timeout=120):
+    """Send a request to an ArcGIS REST endpoint and return the parsed JSON response.
+    Retries connection errors and 429/5xx responses, waiting backoff*2^attempt seconds between attempts.
+    Raises ValueError if the server returns an error in the JSON body (as ArcGIS Server does with HTTP status 200)"""
+    if session is None:
+        session = requests
+    params = dict(params, f='json')
+    for attempt in range(retries + 1):
+        try:
+            #POST to avoid URL length limits with long where clauses
+            r = session.post(URL, data=params, timeout=timeout)
+            if r.status_code in (429, 500, 502, 503, 504) and attempt < retries:
+                raise requests.exceptions.RetryError('HTTP {}'.format(r.status_code))
+            r.raise_for_status()
+            out = r.json()
+            if 'error' in out:
+                raise ValueError('{0}: {1}'.format(URL, out['error']))
+            return(out)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.RetryError) as e:
+            if attempt < retries:
+                time.sleep(backoff * 2 ** attempt)
+            else:
+                raise
+
+def restlayerinfo(baseURL, session=None):
+    "Get the description of an ArcGIS REST layer (fields, objectIdField, maxRecordCount, spatialReference...)"
+    layerURL = re.sub('/query/?$', '', baseURL)
+    info = restrequest(layerURL, {}, session=session)
+    if info.get('objectIdField') is None:
+        info['objectIdField'] = [f['name'] for f in info.get('fields', []) if f['type'] == 'esriFieldTypeOID'][0]
+    return(info)
+
+def restwindows(baseURL, oidfield, where='1=1', itersize=1000, session=None):
+    """Split the features of an ArcGIS REST layer into windows of at most itersize features.
+    Gets the list of all object IDs matching where (returnIdsOnly) and cuts it into windows of consecutive IDs.
+    If the server does not return the ID list, falls back on windows of itersize over the range of object IDs
+    (from returnCountOnly and outStatistics min/max), which may be sparse.
+    Returns a list of tuples (min OID, max OID, number of features or None if unknown)"""
+    try:
+        oids = sorted(restrequest(baseURL, {'where': where, 'returnIdsOnly': 'true'},
+                                  session=session).get('objectIds') or [])
+        print('{0} features to download in {1} windows...'.format(len(oids), -(-len(oids) // itersize)))
+        return([(oids[i], oids[min(i + itersize, len(oids)) - 1], len(oids[i:i + itersize]))
+                for i in range(0, len(oids), itersize)])
+    except Exception:
+        traceback.print_exc()
+        print('Could not get list of object IDs, use range of object IDs instead...')
+        stats = [{'statisticType': stat, 'onStatisticField': oidfield, 'outStatisticFieldName': 'oid' + stat}
+                 for stat in ['min', 'max']]
+        attrs = restrequest(baseURL, {'where': where, 'outStatistics': json.dumps(stats)},
+                            session=session)['features'][0]['attributes']
+        attrs = {k.lower(): v for k, v in attrs.items()}
+        if attrs['oidmin'] is None:
+            return([])
+        return([(i, min(i + itersize - 1, attrs['oidmax']), None)
+                for i in range(attrs['oidmin'], attrs['oidmax'] + 1, itersize)])
+
+def esritoshape(geom):
+    """Convert an ArcGIS REST JSON geometry to a shapely geometry.
+    Polygon rings are sorted into exterior (clockwise) and interior (counter-clockwise) rings, and holes are
+    assigned to the exterior ring that contains them"""
+    if geom is None:
+        return(None)
+    if 'x' in geom:
+        return(Point(geom['x'], geom['y']) if geom['x'] is not None and geom['x'] == geom['x'] else None)
+    if 'points' in geom:
+        return(MultiPoint(geom['points']) if len(geom['points']) > 0 else None)
+    if 'paths' in geom:
+        paths = [p for p in geom['paths'] if len(p) > 1]
+        if len(paths) == 0:
+            return(None)
+        return(LineString(paths[0]) if len(paths) == 1 else MultiLineString(paths))
+    if 'rings' in geom:
+        rings = [LinearRing(r) for r in geom['rings'] if len(r) > 3]
+        exteriors = [[r, []] for r in rings if not r.is_ccw]
+        if len(exteriors) == 0: #Wrongly oriented rings, consider them all as exteriors
+            exteriors = [[r, []] for r in rings]
+        else:
+            for hole in [r for r in rings if r.is_ccw]:
+                holepoint = Point(hole.coords[0])
+                container = [e for e in exteriors if Polygon(e[0]).contains(holepoint)]
+                if len(container) > 0:
+                    container[0][1].append(hole)
                 else:
-                    e = sys.exc_info()[1]
-                    print('Exit with error: ' + e.args[0])
-                    # sys.exit(1)
+                    exteriors.append([hole, []])
+        polys = [Polygon(e, holes) for e, holes in exteriors]
+        if len(polys) == 0:
+            return(None)
+        return(polys[0] if len(polys) == 1 else MultiPolygon(polys))
+    raise ValueError('Unknown geometry type: {}'.format(list(geom.keys())))
+
+def restfeaturestodf(features, fields, geometry=True, crs=None):
+    """Convert a list of ArcGIS REST JSON features to a DataFrame (or GeoDataFrame if geometry) with columns ordered
+    and typed as fields. Dates are converted from epoch milliseconds"""
+    df = pd.DataFrame([f['attributes'] for f in features], columns=[f['name'] for f in fields])
+    for f in fields:
+        if f['type'] == 'esriFieldTypeDate':
+            df[f['name']] = pd.to_datetime(df[f['name']], unit='ms')
+        elif esrifieldtypes.get(f['type'], 'string') == 'string':
+            df[f['name']] = df[f['name']].astype(object)
+    if geometry:
+        return(gpd.GeoDataFrame(df, geometry=[esritoshape(f.get('geometry')) for f in features], crs=crs))
+    return(df)
+
+def restfetchwindow(baseURL, window, oidfield, where='1=1', geometry=True, outSR=None, session=None,
+                    retries=2, backoff=1):
+    """Download the features of an ArcGIS REST layer in a window of object IDs (see restwindows).
+    Returns a tuple (window, list of features or None if failed, error message)"""
+    params = {'where': '({0}) AND ({1} >= {2}) AND ({1} <= {3})'.format(where, oidfield, window[0], window[1]),
+              'outFields': '*',
+              'returnGeometry': str(geometry).lower(),
+              'orderByFields': oidfield}
+    if outSR is not None:
+        params['outSR'] = outSR
+    try:
+        out = restrequest(baseURL, params, session=session, retries=retries, backoff=backoff)
+        features = out.get('features', [])
+        #Truncated response: server limit on number of records or size
+        if out.get('exceededTransferLimit') or (window[2] is not None and len(features) != window[2]):
+            return((window, None, 'Incomplete window: {0} of {1} features'.format(len(features), window[2])))
+        return((window, features, None))
+    except Exception as e:
+        return((window, None, '{0}: {1}'.format(type(e).__name__, e)))
+
+def bisectwindow(window):
+    "Split a window of object IDs (see restwindows) in two halves. The number of features in each half is unknown"
+    mid = (window[0] + window[1]) // 2
+    return([(window[0], mid, None), (mid + 1, window[1], None)])
+
+def RESTdownload(baseURL, outfile, where='1=1', itersize=None, geometry=True, outSR=None, maxworkers=4,
+                 retries=2, backoff=1, layer=None):
+    """Download all features of an ArcGIS REST MapServer/FeatureServer layer to a single file, without arcpy.
+    The object IDs matching where are first listed and split into windows of at most itersize features
+    (see restwindows). Windows are then downloaded concurrently and each page is appended to the output as soon as it
+    is received, so that only maxworkers pages are held in memory. Windows that fail or come back truncated are split
+    in two (bisection) and retried, down to single features.
+    baseURL (required): URL of the layer query endpoint (.../MapServer/<layer id>/query)
+    outfile (required): output file, .gpkg (GeoPackage, only with geometry), .parquet (geometries encoded as WKB) or
+        .csv (table only)
+    where (optional): SQL where clause to subset features
+    itersize (optional): maximum number of features per request, defaults to the layer's maxRecordCount
+    geometry (optional): whether to download geometries (tables are downloaded with geometry=False)
+    outSR (optional): WKID of the output spatial reference, defaults to that of the layer
+    maxworkers (optional): number of concurrent requests
+    layer (optional): name of the GeoPackage layer, defaults to the output file name
+    The output is written to a temporary file which is renamed to outfile once all windows have been processed.
+    Returns the list of windows (min OID, max OID, count) that could not be downloaded"""
+    ext = os.path.splitext(outfile)[1].lower()
+    if ext not in ['.gpkg', '.parquet', '.csv']:
+        raise ValueError('Invalid output format {}: only .gpkg, .parquet and .csv are accepted'.format(ext))
+    if ext == '.csv':
+        geometry = False
+    if ext == '.gpkg' and not geometry:
+        raise ValueError('Cannot write a table without geometry to a GeoPackage: use .parquet or .csv instead')
+    if layer is None:
+        layer = os.path.splitext(os.path.split(outfile)[1])[0]
+    partfile = os.path.splitext(outfile)[0] + '_part' + ext
+    if os.path.exists(partfile):
+        os.remove(partfile)
+
+    session = dlsession(maxworkers)
+    info = restlayerinfo(baseURL, session=session)
+    oidfield = info['objectIdField']
+    fields = [f for f in info['fields'] if f['type'] in esrifieldtypes]
+    if itersize is None:
+        itersize = info.get('maxRecordCount') or 1000
+    sr = info.get('extent', {}).get('spatialReference') or info.get('sourceSpatialReference') or {}
+    wkid = outSR if outSR is not None else sr.get('latestWkid', sr.get('wkid'))
+    crs = {'init': 'epsg:{}'.format(wkid)} if (geometry and wkid is not None) else None
+
+    if ext == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([(f['name'], pa.type_for_alias(esrifieldtypes[f['type']])) for f in fields] +
+                           ([('geometry', pa.binary())] if geometry else []))
+        writer = pq.ParquetWriter(partfile, schema, compression='snappy')
+
+    def writepage(df, first):
+        if ext == '.gpkg':
+            df.to_file(partfile, layer=layer, driver='GPKG', mode='w' if first else 'a')
+        elif ext == '.parquet':
+            if geometry:
+                df = pd.DataFrame(df.drop(columns='geometry')).assign(
+                    geometry=[geom.wkb if geom is not None else None for geom in df.geometry])
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        else:
+            df.to_csv(partfile, mode='w' if first else 'a', header=first, index=False, encoding='utf-8')
+
+    pending = restwindows(baseURL, oidfield, where=where, itersize=itersize, session=session)
+    failed = []
+    nfeatures = 0
+    p = ThreadPool(max(min(maxworkers, len(pending)), 1))
+    try:
+        while len(pending) > 0:
+            retrylist = []
+            for window, features, error in p.imap_unordered(
+                    partial(restfetchwindow, baseURL, oidfield=oidfield, where=where, geometry=geometry,
+                            outSR=outSR, session=session, retries=retries, backoff=backoff), pending):
+                if features is None:
+                    if window[0] < window[1]:
+                        print('{0} from {1} to {2}, split window in two...'.format(error, window[0], window[1]))
+                        retrylist.extend(bisectwindow(window))
+                    else:
+                        print('Could not download {0} {1}: {2}'.format(oidfield, window[0], error))
+                        failed.append(window)
+                elif len(features) > 0:
+                    writepage(restfeaturestodf(features, fields, geometry=geometry, crs=crs), nfeatures == 0)
+                    nfeatures += len(features)
+                    print('{0} from {1} to {2}: {3} features ({4} total)'.format(
+                        oidfield, window[0], window[1], len(features), nfeatures))
+            pending = retrylist
+    finally:
+        p.close()
+        p.join()
+        session.close()
+        if ext == '.parquet':
+            writer.close()
+
+    if nfeatures > 0 or ext == '.parquet':
+        movefile(partfile, outfile)
+        print('{0} features written to {1}'.format(nfeatures, outfile))
+    else:
+        print('No features downloaded from {}'.format(baseURL))
+    if len(failed) > 0:
+        print('{} object IDs could not be downloaded...'.format(len(failed)))
+    return(failed)
+
+def ftpconnect(host, path='/', user='', passwd='', timeout=60):
+    "Open an FTP connection to host (or host:port), log in (anonymously by default), change to path and switch to binary mode"
+    hostname, _, port = host.partition(':')
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(hostname, int(port) if port else 21)
+    ftp.login(user, passwd)
+    ftp.cwd(path)
+    ftp.voidcmd('TYPE I') #SIZE is only reliable in binary mode
+    return(ftp)
+
+def ftpfetch(ftp, remotefile, out, blocksize=2**16):
+    """Download a file through an open FTP connection (see ftpconnect), checking it against the remote SIZE.
+    The file is written to out + '.part' and renamed to out once its size matches the remote size. If a partial file
+    exists, the download is resumed from its end with a REST offset. Existing files that do not match the remote size
+    (e.g. truncated by an interrupted download) are resumed the same way.
+    Returns 'downloaded' or 'exists'"""
+    partfile = out + '.part'
+    try:
+        remotesize = ftp.size(remotefile)
+    except ftplib.error_perm: #Some servers do not support SIZE
+        remotesize = None
+
+    #Check existing file, zero-byte or truncated files are resumed
+    if os.path.exists(out):
+        if os.path.getsize(out) > 0 and (remotesize is None or os.path.getsize(out) == remotesize):
+            print('{} already exists... skipping'.format(os.path.split(out)[1]))
+            return('exists')
+        movefile(out, partfile)
+
+    offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+    if remotesize is not None and offset > remotesize:
+        offset = 0
+    print('{0} {1}'.format('resuming' if offset > 0 else 'downloading', remotefile))
+    with open(partfile, 'ab' if offset > 0 else 'wb') as fobj: #using 'w' as mode argument will create invalid zip files
+        ftp.retrbinary('RETR {}'.format(remotefile), fobj.write, blocksize=blocksize, rest=offset or None)
+
+    size = os.path.getsize(partfile)
+    if size == 0 or (remotesize is not None and size != remotesize):
+        raise ftplib.error_temp('Incomplete download of {0} ({1} of {2} bytes)'.format(remotefile, size, remotesize))
+    movefile(partfile, out)
+    return('downloaded')
+
+def ftpbatch(host, path, filelist, outdir, maxconnections=4, retries=3, backoff=1, user='', passwd='', timeout=60):
+    """Download a list of files from the same FTP directory with a pool of logged-in connections.
+    Worker threads take a connection from the pool for each file (see ftpfetch), so that at most maxconnections
+    connections are opened to the server. Connections that fail are re-opened and the download is resumed from the
+    partial file, waiting backoff*2^attempt seconds between attempts. Files missing from the server (permanent
+    errors) are not retried. Zero-byte leftovers of failed downloads are deleted.
+    host, path (required): FTP server and directory
+    filelist (required): list of file names to download from path
+    outdir (required): directory where files are written
+    Returns a list of (file name, output path, status) tuples in the same order as filelist,
+    with status one of 'downloaded', 'exists', 'failed'"""
+    connections = Queue.Queue()
+    for i in range(max(min(maxconnections, len(filelist)), 1)):
+        connections.put(None) #Connections are opened when first needed
+    x = [0]
+    xlock = threading.Lock()
+
+    def ftpworker(remotefile):
+        out = os.path.join(outdir, remotefile)
+        status = 'failed'
+        ftp = connections.get()
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    if ftp is None:
+                        ftp = ftpconnect(host, path, user=user, passwd=passwd, timeout=timeout)
+                    status = ftpfetch(ftp, remotefile, out)
                     break
+                except ftplib.error_perm as e: #e.g. 550 file not found
+                    print('Could not download {0}: {1}'.format(remotefile, e))
+                    break
+                except ftplib.all_errors as e:
+                    try:
+                        ftp.close()
+                    except Exception:
+                        pass
+                    ftp = None
+                    if attempt < retries:
+                        print('{0} for {1}, retrying in {2} s...'.format(e, remotefile, backoff * 2 ** attempt))
+                        time.sleep(backoff * 2 ** attempt)
+                    else:
+                        print('Failed to download {0}: {1}'.format(remotefile, e))
+        finally:
+            connections.put(ftp)
+            if status == 'failed' and os.path.exists(out + '.part') and os.path.getsize(out + '.part') == 0:
+                os.remove(out + '.part')
+            with xlock:
+                x[0] += 1
+                print('{}% of data downloaded'.format(100 * x[0] / len(filelist)))
+        return((remotefile, out, status))
+
+    p = ThreadPool(max(min(maxconnections, len(filelist)), 1))
+    try:
+        dlout = p.map(ftpworker, filelist)
+    finally:
+        p.close()
+        p.join()
+        while not connections.empty():
+            ftp = connections.get()
+            if ftp is not None:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    ftp.close()
+
+    failedlist = [remotefile for remotefile, out, status in dlout if status == 'failed']
+    if len(failedlist) > 0:
+        print('{} failed to download...'.format(','.join(failedlist)))
+    return(dlout)
 
-def downloadroads(countyfipslist, year=None, outdir=None):
+def downloadroads(countyfipslist, year=None, outdir=None, maxconnections=4):
     if year is None:
         year=2018
     if year < 2008:
@@ -222,62 +933,13 @@ def downloadroads(countyfipslist, year=None, outdir=None):
         print('Creating {}...'.format(outdir))
         os.mkdir(outdir)
 
-    #Open ftp connection
-    try:
-        failedlist = []
-        rooturl = "ftp://ftp2.census.gov/geo/tiger/TIGER{0}/ROADS".format(year)
-        urlp = urlparse.urlparse(rooturl)
-        ftp = ftplib.FTP(urlp.netloc)
-        ftp.login()
-        ftp.cwd(urlp.path)
-
-        #Iterate over county fips
-        x=0
-        N = len(countyfipslist)
-
-        for county_code in countyfipslist:
-            outfile = "tl_{0}_{1}_roads.zip".format(year, county_code)
-            out = os.path.join(outdir, outfile)
-            if not os.path.exists(out):
-                # ftp download
-                print "downloading " + outfile
-                try:
-                    with open(out, 'wb') as fobj: #using 'w' as mode argument will create invalid zip files
-                        ftp.retrbinary('RETR {}'.format(outfile), fobj.write)
-                except Exception:
-                    traceback.print_exc()
-                    failedlist.append(county_code)
-                    pass
-
-                ######DID NOT WORK
-                # urllib.urlretrieve(url, out)
-                ######KEPT HANGING
-                # try:
-                #     r = urllib2.urlopen(url)
-                #     print "downloading " + url
-                #     with open(out, 'wb') as f:
-                #         shutil.copyfileobj(r, f)
-                # finally:
-                #     if r:
-                #         r.close()
-
-                ######KEPT HANGING
-                # with contextlib.closing(urllib2.urlopen(url)) as ftprequest:
-                #     print "downloading " + url
-                #     with open(out, 'wb') as local_file:
-                #         shutil.copyfileobj(ftprequest, local_file)
+    #Download with a pool of ftp connections (see ftpbatch)
+    urlp = urlparse.urlparse("ftp://ftp2.census.gov/geo/tiger/TIGER{0}/ROADS".format(year))
+    return(ftpbatch(urlp.netloc, urlp.path,
+                    ["tl_{0}_{1}_roads.zip".format(year, county_code) for county_code in countyfipslist],
+                    outdir, maxconnections=maxconnections))
 
-            else:
-                print('{} already exists... skipping'.format(outfile))
-            x += 1
-            print('{}% of county-level data downloaded'.format(100 * x / N))
-    finally:
-        if ftp:
-            ftp.quit()
-        if len(failedlist) > 0:
-            print('{} failed to download...'.format(','.join(failedlist)))
-
-def downloadNARR(folder, variable, years, outdir=None):
+def downloadNARR(folder, variable, years, outdir=None, maxconnections=4):
     if outdir==None:
         print('Downloading to {}...'.format(os.getcwd()))
         outdir = os.getcwd()
@@ -285,41 +947,126 @@ def downloadNARR(folder, variable, years, outdir=None):
         print('Creating {}...'.format(outdir))
         os.mkdir(outdir)
 
-    #Open ftp connection
-    try:
-        failedlist = []
-        rooturl = "ftp://ftp.cdc.noaa.gov/Datasets/NARR/{0}".format(folder)
-        urlp = urlparse.urlparse(rooturl)
-        ftp = ftplib.FTP(urlp.netloc)
-        ftp.login()
-        ftp.cwd(urlp.path)
-
-        #Iterate over county fips
-        x=0
-        N = len(years)
-
-        for year in years:
-            outfile = "{0}.{1}.nc".format(variable, year)
-            out = os.path.join(outdir, outfile)
-            if not os.path.exists(out):
-                # ftp download
-                print "downloading " + outfile
-                try:
-                    with open(out, 'wb') as fobj: #using 'w' as mode argument will create invalid zip files
-                        ftp.retrbinary('RETR {}'.format(outfile), fobj.write)
-                except Exception:
-                    traceback.print_exc()
-                    failedlist.append(outfile)
-                    #Remove empty dataset
-                    if os.path.exists(out) and os.path.getsize(out) == 0L:
-                        os.remove(out)
-                    pass
+    #Download with a pool of ftp connections (see ftpbatch)
+    urlp = urlparse.urlparse("ftp://ftp.cdc.noaa.gov/Datasets/NARR/{0}".format(folder))
+    return(ftpbatch(urlp.netloc, urlp.path, ["{0}.{1}.nc".format(variable, year) for year in years],
+                    outdir, maxconnections=maxconnections))
+
+def readjson(injson):
+    "Read a json file, returns an empty dictionary if it does not exist"
+    if not os.path.exists(injson):
+        return({})
+    with open(injson, 'r') as f:
+        return(json.load(f))
+
+def writejson(indict, outjson):
+    "Write a dictionary to a json file atomically"
+    with open(outjson + '.tmp', 'w') as f:
+        json.dump(indict, f, indent=1, sort_keys=True)
+    movefile(outjson + '.tmp', outjson)
+
+def smokefetchday(day, outdir, baseurl, session=None, hostlimits=None, extlist=['shp', 'dbf', 'shx']):
+    """Fetch the HMS smoke polygon shapefile of a day (hms_smokeYYYYMMDD.shp, .dbf, .shx) from baseurl, trying the
+    gzipped file first (files were gzipped until summer 2018) then the plain file.
+    baseurl is either an http(s) URL or a local mirror directory with the same structure as the HMS archive
+    (YYYY/GIS/SMOKE/hms_smokeYYYYMMDD.ext[.gz])
+    Corrupt gzip files are deleted so that they are fetched again in the next run.
+    Returns a tuple (day, status) with status one of 'complete' (all files in outdir), 'missing' (not in archive),
+    'failed'"""
+    def smokegunzip(gzfile):
+        try:
+            gunzip(gzfile)
+            return('downloaded')
+        except Exception as e:
+            print('Could not decompress {0}: {1}'.format(gzfile, e))
+            os.remove(gzfile)
+            return('failed')
+
+    statuslist = []
+    for ext in extlist:
+        fname = 'hms_smoke{0}.{1}'.format(day, ext)
+        out = os.path.join(outdir, fname)
+        if os.path.exists(out):
+            statuslist.append('exists')
+            continue
+        src = '/'.join([baseurl.rstrip('/'), day[0:4], 'GIS/SMOKE', fname])
+        if os.path.isdir(baseurl): #Local mirror
+            src = os.path.join(baseurl, day[0:4], 'GIS', 'SMOKE', fname)
+            if os.path.exists(src + '.gz'):
+                shutil.copyfile(src + '.gz', out + '.gz')
+                statuslist.append(smokegunzip(out + '.gz'))
+            elif os.path.exists(src):
+                shutil.copyfile(src, out + '.part')
+                movefile(out + '.part', out)
+                statuslist.append('downloaded')
             else:
-                print('{} already exists... skipping'.format(outfile))
-            x += 1
-            print('{}% of data downloaded'.format(100 * x / N))
+                statuslist.append('missing')
+        else:
+            status = dlstream('{}.gz'.format(src), outdir, session=session, hostlimits=hostlimits)[2]
+            if status == 'missing':
+                status = dlstream(src, outdir, session=session, hostlimits=hostlimits)[2]
+            elif status == 'exists' and not os.path.exists(out): #gz file left from a previous run
+                status = smokegunzip(out + '.gz')
+            elif status == 'failed' and os.path.exists(out + '.gz'): #Downloaded but could not be decompressed
+                os.remove(out + '.gz')
+            statuslist.append(status)
+        if statuslist[-1] == 'missing': #No need to request other files of the day
+            break
+    if any(status in ['failed', 'not downloadable'] for status in statuslist):
+        return((day, 'failed'))
+    if any(status == 'missing' for status in statuslist):
+        return((day, 'missing'))
+    if not all(os.path.exists(os.path.join(outdir, 'hms_smoke{0}.{1}'.format(day, ext))) for ext in extlist):
+        return((day, 'failed'))
+    return((day, 'complete'))
+
+def downloadsmoke(outdir, startdate='2014-01-01', enddate=None, manifest=None, maxworkers=8, perhost=4,
+                  recentdays=30, baseurl="https://satepsanone.nesdis.noaa.gov/pub/volcano/FIRE/HMS_ARCHIVE"):
+    """Incrementally synchronize daily HMS smoke polygon shapefiles with a local directory (see smokefetchday).
+    A manifest records the status of every day that was processed: 'complete' days (all files fetched) and
+    'missing' days (not in the archive) are not requested again in later runs, so that only new days and days that
+    previously failed are fetched. Days are fetched concurrently with a thread pool.
+    outdir (required): local directory where shapefiles are written
+    startdate, enddate (optional): range of days to synchronize, enddate defaults to yesterday
+    manifest (optional): path of the json manifest, defaults to outdir/smoke_manifest.json
+    recentdays (optional): days missing from the archive that are less than recentdays old are not recorded as
+        missing, as they may not have been published yet
+    baseurl (optional): root of the HMS archive, either a URL or a local mirror directory
+    Returns the manifest dictionary by day (YYYYMMDD) of {'status':..., 'checked':...}"""
+    if not os.path.exists(outdir):
+        print('Creating {}...'.format(outdir))
+        os.mkdir(outdir)
+    if manifest is None:
+        manifest = os.path.join(outdir, 'smoke_manifest.json')
+    if enddate is None:
+        enddate = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    smokemanifest = readjson(manifest)
+
+    daylist = [d for d in pd.date_range(start=startdate, end=enddate).strftime('%Y%m%d')
+               if smokemanifest.get(d, {}).get('status') not in ['complete', 'missing']]
+    print('{} days to synchronize...'.format(len(daylist)))
+    if len(daylist) == 0:
+        return(smokemanifest)
+
+    session = dlsession(maxworkers)
+    hostlimits = {urlparse.urlparse(baseurl).netloc: threading.BoundedSemaphore(perhost)}
+    recentlimit = (pd.Timestamp.today() - pd.Timedelta(days=recentdays)).strftime('%Y%m%d')
+    p = ThreadPool(max(min(maxworkers, len(daylist)), 1))
+    try:
+        for x, (day, status) in enumerate(p.imap_unordered(
+                partial(smokefetchday, outdir=outdir, baseurl=baseurl, session=session, hostlimits=hostlimits),
+                daylist)):
+            if status == 'complete' or (status == 'missing' and day < recentlimit):
+                smokemanifest[day] = {'status': status, 'checked': time.strftime('%Y-%m-%d %H:%M:%S')}
+            if x % 50 == 0: #Save progress regularly
+                writejson(smokemanifest, manifest)
     finally:
-        if ftp:
-            ftp.quit()
-        if len(failedlist) > 0:
-            print('{} failed to download...'.format(','.join(failedlist)))
\ No newline at end of file
+        p.close()
+        p.join()
+        session.close()
+        writejson(smokemanifest, manifest)
+
+    failedlist = sorted(set(daylist) - set(d for d in daylist if d in smokemanifest))
+    if len(failedlist) > 0:
+        print('{} failed or not yet available, will be retried in the next run...'.format(','.join(failedlist)))
+    return(smokemanifest)
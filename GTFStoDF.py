@@ -0,0 +1,629 @@
+'''
+Author: Mathis Messager
+Contact info: messamat@uw.edu
+Creation date: December 2018
+
+Required Arguments:
+    - gtfs_dir (directory or .zip file): directory that contains GTFS* text file set or zip file. Zip files are read
+            directly without being extracted
+
+Optional arguments:
+    - current (True/False): whether to only take in account current trips (True) or also future trips (False)
+                            based on calendar.txt start_date field and current date (datetime.datetime.now())
+
+Description: arcpy-free counterpart to GTFStoSHP.GTFStoSHPweeklynumber. Takes a GTFS file set, builds one line per
+    shape from shapes.txt (or shapes.shp) and computes for each shape the number of trips that run on it every week,
+    all in memory with pandas/geopandas (no intermediate gdb tables or feature classes). The output fields are the same
+    as those of GTFStoSHPweeklynumber (normalnum_SUM, adjustnum_SUM, service_len_MIN, service_len_MAX).
+    GTFShourlyfrequency streams stop_times.txt in chunks to compute the weekly number of trips by hour of the day for
+    each shape. routestats computes vertex count, length and vertex density for all shapes at once and
+    dedupesegments merges identical segments shared by multiple routes and sums their number of trips.
+    GTFSbatchweeklynumber processes a list of feeds in a process pool and concatenates the results into a single
+    route layer with a 'feed' identifier column. Parsed tables and outputs can be cached as parquet files keyed on
+    each feed's content hash so that reruns only reprocess feeds that changed.
+
+*GTFS: General Transit Feed Specification
+'''
+
+import os
+import re
+import io
+import glob
+import shutil
+import hashlib
+import zipfile
+import time
+import logging
+import traceback
+import multiprocessing
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import LineString
+from shapely import wkb
+
+#ID fields are imported as text (same as the schema.ini written by GTFStoSHP.format_schema_import) so that e.g.
+#0200062 does not become 200062
+idfields = ['AgencyName', 'route_id', 'service_id', 'trip_id', 'shape_id', 'block_id']
+
+def feedname(gtfs_dir):
+    "Feed identifier used in output names and in the 'feed' column"
+    return(re.sub(r'\W', '_', os.path.splitext(os.path.split(os.path.normpath(gtfs_dir))[1])[0]))
+
+def listgtfsfiles(gtfs_dir):
+    "List all files in a GTFS directory or zip file"
+    if zipfile.is_zipfile(gtfs_dir):
+        with zipfile.ZipFile(gtfs_dir) as zipf:
+            return([info.filename for info in zipf.infolist()])
+    else:
+        return([os.path.join(dirpath, file)
+                for (dirpath, dirnames, filenames) in os.walk(gtfs_dir)
+                for file in filenames])
+
+def readgtfstable(gtfs_dir, gtfs_files, repattern, required=True, **kwargs):
+    """Read a GTFS table matching repattern either from a directory or directly from a zip file.
+    Returns None if the table does not exist and required == False"""
+    flist = list(filter(re.compile(repattern).search, gtfs_files))
+    if len(flist) == 0:
+        if required:
+            raise ValueError('No file matching {0} in {1}'.format(repattern, gtfs_dir))
+        return(None)
+
+    dtypes = {f: str for f in idfields}
+    if zipfile.is_zipfile(gtfs_dir):
+        with zipfile.ZipFile(gtfs_dir) as zipf:
+            df = pd.read_csv(io.BytesIO(zipf.read(flist[0])), dtype=dtypes, skipinitialspace=True, **kwargs)
+    else:
+        df = pd.read_csv(flist[0], dtype=dtypes, skipinitialspace=True, **kwargs)
+    df.columns = [c.strip() for c in df.columns]
+    return(df)
+
+def parsegtfsdate(s):
+    "Parse GTFS dates (YYYYMMDD), falling back on automatic parsing for badly formatted records"
+    s = s.astype(str).str.strip()
+    parsed = pd.to_datetime(s, format='%Y%m%d', errors='coerce')
+    if parsed.isnull().any():
+        parsed.loc[parsed.isnull()] = pd.to_datetime(s[parsed.isnull()], errors='coerce')
+    return(parsed)
+
+def agencykey(df, agency, field):
+    "Create unique key AgencyName + field, in the same format as in GTFStoSHP"
+    return(df['AgencyName'].fillna(agency).astype(str) + '._.' + df[field].astype(str))
+
+def GTFSshapes(gtfs_dir, gtfs_files, agency):
+    "Create a GeoDataFrame of lines (one per shape) from shapes.txt or from a shapes shapefile"
+    shapesf = list(filter(re.compile('.*shapes[.](csv|txt|shp)$').search, gtfs_files))[0]
+    if os.path.splitext(shapesf)[1] == '.shp':
+        if zipfile.is_zipfile(gtfs_dir):
+            shapes = gpd.read_file('zip://{0}!{1}'.format(gtfs_dir, shapesf))
+        else:
+            shapes = gpd.read_file(shapesf)
+        shapes['shape_id'] = shapes['shape_id'].astype(str)
+    else:
+        pts = readgtfstable(gtfs_dir, gtfs_files, '.*shapes[.](csv|txt)$',
+                            usecols=lambda c: c.strip() in ['AgencyName', 'shape_id', 'shape_pt_lat',
+                                                            'shape_pt_lon', 'shape_pt_sequence'])
+        if 'AgencyName' not in pts.columns:
+            pts['AgencyName'] = agency
+        pts = pts.dropna(subset=['shape_pt_lat', 'shape_pt_lon']). \
+            sort_values(['AgencyName', 'shape_id', 'shape_pt_sequence'], kind='mergesort')
+        #Equivalent of PointsToLine_management(Line_Field='shape_id'), a shape needs at least two vertices
+        shapes_l = []
+        for (agname, shape_id), grp in pts.groupby(['AgencyName', 'shape_id'], sort=False):
+            if len(grp) > 1:
+                shapes_l.append((agname, shape_id,
+                                 LineString(np.column_stack([grp['shape_pt_lon'].values.astype(float),
+                                                             grp['shape_pt_lat'].values.astype(float)]))))
+            else:
+                logging.warning('Shape {0} of {1} has less than two vertices, skipping...'.format(shape_id, agname))
+        shapes = gpd.GeoDataFrame(pd.DataFrame(shapes_l, columns=['AgencyName', 'shape_id', 'geometry']),
+                                  geometry='geometry', crs={'init': 'epsg:4326'})
+    if 'AgencyName' not in shapes.columns:
+        shapes['AgencyName'] = agency
+    shapes['Agency_shape_id'] = agencykey(shapes, agency, 'shape_id')
+    return(shapes)
+
+def readgtfsfeed(gtfs_dir, gtfs_files, agency):
+    """Read the GTFS tables used to compute weekly trips into a dictionary of data frames.
+    Optional tables (calendar, calendar_dates) are None if missing"""
+    gtfstabs = {'routes': readgtfstable(gtfs_dir, gtfs_files, '.*routes[.](csv|txt)$'),
+                'trips': readgtfstable(gtfs_dir, gtfs_files, '.*trips[.](csv|txt)$'),
+                'calendar': readgtfstable(gtfs_dir, gtfs_files, '.*calendar[.](csv|txt)$', required=False),
+                'calendar_dates': readgtfstable(gtfs_dir, gtfs_files, '.*calendar_dates[.](csv|txt)$',
+                                                required=False)}
+    for tab in gtfstabs.values():
+        if tab is not None and 'AgencyName' not in tab.columns:
+            tab['AgencyName'] = agency
+    return(gtfstabs)
+
+weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+def GTFScalendar(gtfstabs, agency, current=True):
+    """Compute number of days/week for each service_id from calendar and calendar_dates (see GTFStoSHP for details).
+    Returns a data frame with Agency_service_id, normalnum, adjustnum, service_len and, for each weekday, the average
+    number of times per week that a trip of this service runs on that weekday (w_monday... w_sunday)"""
+    calendar = gtfstabs['calendar'].copy() if gtfstabs['calendar'] is not None else None
+    caldates = gtfstabs['calendar_dates'].copy() if gtfstabs['calendar_dates'] is not None else None
+    wcols = ['w_{}'.format(d) for d in weekdays]
+
+    if calendar is None:
+        calendar = pd.DataFrame(columns=['AgencyName', 'service_id', 'start_date', 'end_date'] + weekdays)
+
+    #Analyze calendar dates for trips with no calendar schedule (see GTFStoSHP for details)
+    if caldates is not None and len(caldates) > 0:
+        caldates['Agency_service_id'] = agencykey(caldates, agency, 'service_id')
+        caldates['service_date'] = parsegtfsdate(caldates['date'])
+        caldates['date_added'] = (caldates['exception_type'] == 1).astype(int)
+        caldates['date_removed'] = (caldates['exception_type'] == 2).astype(int)
+        cal_dic = caldates.groupby('Agency_service_id').agg({'date_added': 'sum', 'date_removed': 'sum',
+                                                             'service_date': ['min', 'max']})
+        cal_dic.columns = ['date_added', 'date_removed', 'date_min', 'date_max']
+        #Net number of added dates by weekday
+        caldates['date_net'] = caldates['date_added'] - caldates['date_removed']
+        caldates['weekday'] = caldates['service_date'].dt.weekday
+        cal_wk = caldates.dropna(subset=['weekday']). \
+            pivot_table(index='Agency_service_id', columns='weekday', values='date_net', aggfunc='sum', fill_value=0). \
+            reindex(columns=range(7), fill_value=0)
+        cal_wk.columns = wcols
+        cal_dic = cal_dic.join(cal_wk)
+    else:
+        cal_dic = pd.DataFrame(columns=['date_added', 'date_removed', 'date_min', 'date_max'] + wcols)
+
+    #Correct bug in NTM table whereby the end_date for a given agency includes a line break \n and the service_id
+    calendar['end_date'] = calendar['end_date'].astype(str).str.split(',').str[-1]
+
+    #Compute number of days/week for each service_id in calendar
+    calendar['Agency_service_id'] = agencykey(calendar, agency, 'service_id')
+    calendar = calendar[calendar['start_date'].notnull() & calendar['end_date'].notnull() &
+                        (calendar['end_date'] != 'nan')].copy()
+    sdate = parsegtfsdate(calendar['start_date'])
+    calendar['service_len'] = np.maximum((parsegtfsdate(calendar['end_date']) - sdate).dt.days, 1)
+    calendar = calendar.join(cal_dic[['date_added', 'date_removed']], on='Agency_service_id')
+    calendar[['date_added', 'date_removed']] = calendar[['date_added', 'date_removed']].fillna(0).astype(float)
+    calendar['date_weekavg'] = (calendar['date_added'] - calendar['date_removed']) / \
+                               (calendar['service_len'].astype(float) / 7.0)
+    calendar['normalnum'] = calendar[weekdays].astype(float).sum(axis=1)
+    calendar['adjustnum'] = np.maximum(calendar['normalnum'] + calendar['date_weekavg'], 0)
+    if current == True: #If start_date > current date
+        calendar.loc[(sdate > datetime.now()).values, ['normalnum', 'adjustnum']] = 0
+    #Spread exceptions evenly across the days of service. Services without any regular day of service but with added
+    #dates are spread across the weekdays of their added dates, or evenly across the week if these are all removed
+    adjustratio = (calendar['adjustnum'] / calendar['normalnum']).where(calendar['normalnum'] > 0, 0)
+    addedwk = np.maximum(calendar[['Agency_service_id']].join(cal_dic[wcols], on='Agency_service_id')[wcols].
+                         astype(float).fillna(0), 0)
+    addedsum = addedwk.sum(axis=1)
+    for d, wcol in zip(weekdays, wcols):
+        calendar[wcol] = (calendar[d].astype(float) * adjustratio).where(
+            calendar['normalnum'] > 0, calendar['adjustnum'] * (addedwk[wcol] / addedsum).where(addedsum > 0, 1 / 7.0))
+
+    #Append service_ids only defined in calendar_dates, keeping only those that span at least a month
+    caladd = cal_dic[~cal_dic.index.isin(calendar['Agency_service_id'])].copy()
+    if len(caladd) > 0:
+        caladd['service_len'] = np.maximum((caladd['date_max'] - caladd['date_min']).dt.days, 1)
+        caladd = caladd[caladd['service_len'] > 30].copy()
+        caladd['adjustnum'] = np.maximum((caladd['date_added'] - caladd['date_removed']) /
+                                         (caladd['service_len'].astype(float) / 7.0), 0)
+        for wcol in wcols:
+            caladd[wcol] = np.maximum(caladd[wcol].astype(float) / (caladd['service_len'].astype(float) / 7.0), 0)
+    else:
+        caladd['service_len'] = caladd['adjustnum'] = []
+    caladd['normalnum'] = np.nan
+    outcols = ['Agency_service_id', 'normalnum', 'adjustnum', 'service_len'] + wcols
+    return(pd.concat([calendar[outcols], caladd.rename_axis('Agency_service_id').reset_index()[outcols]],
+                     ignore_index=True))
+
+def GTFStripcount(gtfstabs, agency, current=True):
+    """Compute number of weekly trips for each shape_id-route_id combination from a dictionary of GTFS tables
+    (see readgtfsfeed). Same computation as in GTFStoSHP.GTFStoSHPweeklynumber but with vectorized pandas operations
+    rather than cursors"""
+    routes = gtfstabs['routes'].copy()
+    trips = gtfstabs['trips'].copy()
+    calendar = GTFScalendar(gtfstabs, agency, current=current)[['Agency_service_id', 'normalnum',
+                                                                 'adjustnum', 'service_len']]
+
+    #Join calendar and routes to trips
+    trips['Agency_service_id'] = agencykey(trips, agency, 'service_id')
+    trips['Agency_route_id'] = agencykey(trips, agency, 'route_id')
+    routes['Agency_route_id'] = agencykey(routes, agency, 'route_id')
+    trc = trips[['Agency_service_id', 'Agency_route_id', 'AgencyName', 'route_id', 'shape_id']]. \
+        merge(calendar.drop_duplicates('Agency_service_id'), on='Agency_service_id', how='left'). \
+        merge(routes.drop_duplicates('Agency_route_id')[['Agency_route_id', 'route_type']],
+              on='Agency_route_id', how='left')
+
+    #Summarize trips by route_id & shape_id
+    gfields = ['shape_id', 'AgencyName', 'route_id', 'route_type']
+    #route_type becomes float when some trips have no matching route, write it as e.g. '3' rather than '3.0'
+    routetype = pd.to_numeric(trc['route_type'], errors='coerce')
+    trc['route_type'] = trc['route_type'].astype(object).where(
+        routetype.isnull(), routetype.fillna(0).astype(np.int64).astype(str))
+    trc[gfields] = trc[gfields].fillna('None').astype(str)
+    trc_count = trc.groupby(gfields).agg({'normalnum': 'sum', 'adjustnum': 'sum', 'service_len': ['min', 'max']})
+    trc_count.columns = ['normalnum_SUM', 'adjustnum_SUM', 'service_len_MIN', 'service_len_MAX']
+    trc_count = trc_count.reset_index()
+    trc_count['Agency_shape_id'] = agencykey(trc_count, agency, 'shape_id')
+    return(trc_count)
+
+def readgtfschunks(gtfs_dir, gtfs_files, repattern, chunksize, **kwargs):
+    "Iterate over chunks of a (large) GTFS table, read either from a directory or directly from a zip file"
+    flist = list(filter(re.compile(repattern).search, gtfs_files))
+    if len(flist) == 0:
+        raise ValueError('No file matching {0} in {1}'.format(repattern, gtfs_dir))
+    dtypes = {f: str for f in idfields}
+    if zipfile.is_zipfile(gtfs_dir):
+        with zipfile.ZipFile(gtfs_dir) as zipf:
+            with zipf.open(flist[0]) as txt:
+                for chunk in pd.read_csv(txt, dtype=dtypes, skipinitialspace=True, chunksize=chunksize, **kwargs):
+                    yield chunk
+    else:
+        for chunk in pd.read_csv(flist[0], dtype=dtypes, skipinitialspace=True, chunksize=chunksize, **kwargs):
+            yield chunk
+
+def GTFSfirstdeparture(gtfs_dir, gtfs_files, chunksize=10**6, verbose=True):
+    """Stream stop_times.txt in chunks and get the departure time of the first stop of each trip. Memory use is
+    bounded by the chunk size and the number of trips, not by the number of stop times.
+    Returns a data frame with trip_id, hour (0-23) and dayoffset (number of days after the service day, as GTFS
+    times can exceed 24:00:00 for trips that run past midnight)"""
+    firstdep = None
+    nrows = 0
+    tic = time.time()
+    stcols = ['trip_id', 'departure_time', 'stop_sequence']
+    for chunk in readgtfschunks(gtfs_dir, gtfs_files, '.*stop_times[.](csv|txt)$', chunksize=chunksize,
+                                usecols=lambda c: c.strip() in stcols):
+        nrows += len(chunk)
+        chunk.columns = [c.strip() for c in chunk.columns]
+        chunk = chunk.dropna(subset=['departure_time'])
+        #Trips may span several chunks so keep the earliest stop of each trip among chunks processed so far
+        firstdep = pd.concat([firstdep, chunk[stcols]], ignore_index=True) if firstdep is not None else chunk[stcols]
+        firstdep = firstdep.sort_values('stop_sequence', kind='mergesort').drop_duplicates('trip_id')
+        if verbose:
+            print('{0} stop times processed ({1} rows/s)...'.format(nrows, int(nrows / max(time.time() - tic, 1e-6))))
+
+    if firstdep is None:
+        return(pd.DataFrame(columns=['trip_id', 'hour', 'dayoffset']))
+    if verbose:
+        print('Processed {0} stop times in {1} s ({2} rows/s)'.format(
+            nrows, round(time.time() - tic, 1), int(nrows / max(time.time() - tic, 1e-6))))
+    hours = pd.to_numeric(firstdep['departure_time'].astype(str).str.strip().str.split(':').str[0],
+                          errors='coerce')
+    firstdep = firstdep[hours.notnull()].copy()
+    hours = hours[hours.notnull()].astype(int)
+    firstdep['hour'] = hours % 24
+    firstdep['dayoffset'] = hours // 24
+    return(firstdep[['trip_id', 'hour', 'dayoffset']])
+
+def GTFShourlyfrequency(gtfs_dir, current=True, byweekday=False, chunksize=10**6, verbose=True):
+    """Compute the weekly number of trips departing in each hour of the day for each shape of a GTFS feed.
+    stop_times.txt is streamed in chunks (see GTFSfirstdeparture). Each trip is binned by the hour and weekday of its
+    first departure and weighted by the number of times it runs on that weekday every week (see GTFScalendar), so that
+    the sum across hours is equal to adjustnum_SUM in GTFStoDFweeklynumber.
+    - byweekday (True/False): if True, return one row per shape and weekday rather than summing across weekdays
+
+    Returns a data frame indexed by Agency_shape_id (and weekday) with one column per hour (h00...h23)"""
+    agency = feedname(gtfs_dir)
+    gtfs_files = listgtfsfiles(gtfs_dir)
+    gtfstabs = readgtfsfeed(gtfs_dir, gtfs_files, agency)
+    calendar = GTFScalendar(gtfstabs, agency, current=current).drop_duplicates('Agency_service_id')
+    trips = gtfstabs['trips']
+    trips = pd.DataFrame({'trip_id': trips['trip_id'],
+                          'Agency_service_id': agencykey(trips, agency, 'service_id'),
+                          'Agency_shape_id': agencykey(trips, agency, 'shape_id')})
+
+    print('Getting first departure time of every trip for {}...'.format(agency))
+    firstdep = GTFSfirstdeparture(gtfs_dir, gtfs_files, chunksize=chunksize, verbose=verbose)
+    tripdep = trips.merge(firstdep, on='trip_id', how='inner'). \
+        merge(calendar, on='Agency_service_id', how='inner')
+
+    #Long format: one record per trip and weekday of service, shifted to the next day(s) for trips after midnight
+    wcols = ['w_{}'.format(d) for d in weekdays]
+    tripwk = pd.DataFrame({
+        'Agency_shape_id': np.repeat(tripdep['Agency_shape_id'].values, 7),
+        'weekday': (np.tile(np.arange(7), len(tripdep)) + np.repeat(tripdep['dayoffset'].values, 7)) % 7,
+        'hour': np.repeat(tripdep['hour'].values, 7),
+        'trips': tripdep[wcols].values.astype(float).ravel()})
+    tripwk = tripwk[tripwk['trips'] > 0]
+
+    gfields = ['Agency_shape_id', 'weekday'] if byweekday else ['Agency_shape_id']
+    shapehour = tripwk.pivot_table(index=gfields, columns='hour', values='trips', aggfunc='sum', fill_value=0). \
+        reindex(columns=range(24), fill_value=0)
+    shapehour.columns = ['h{}'.format(str(h).zfill(2)) for h in range(24)]
+    if byweekday:
+        shapehour = shapehour.rename(index=dict(enumerate(weekdays)), level='weekday')
+    return(shapehour)
+
+def linecoords(geoms):
+    """Get the vertices of a sequence of (multi)line geometries as flat arrays.
+    Returns a tuple of (coords: N x 2 array of vertex coordinates, partidx: index of the line part each vertex belongs to,
+    featidx: index of the feature each line part belongs to)"""
+    geoms = np.asarray(geoms, dtype=object)
+    if hasattr(shapely, 'get_coordinates'): #shapely >= 2.0, vectorized
+        parts, featidx = shapely.get_parts(geoms, return_index=True)
+        coords, partidx = shapely.get_coordinates(parts, return_index=True)
+        return((coords, partidx, featidx))
+
+    coordlist, partlist, featlist = [], [], []
+    for i, geom in enumerate(geoms):
+        if geom is None or geom.is_empty:
+            continue
+        for part in (geom.geoms if hasattr(geom, 'geoms') else [geom]):
+            partcoords = np.asarray(part.coords)[:, :2]
+            coordlist.append(partcoords)
+            partlist.append(np.repeat(len(featlist), len(partcoords)))
+            featlist.append(i)
+    if len(coordlist) == 0:
+        return((np.empty((0, 2)), np.empty(0, dtype=int), np.empty(0, dtype=int)))
+    return((np.concatenate(coordlist), np.concatenate(partlist), np.asarray(featlist)))
+
+def routestats(routes):
+    """Compute vertex count, length and vertex density (vertex count/length) for all features of a line layer at once,
+    e.g. to identify shapes that do not follow the actual trajectory of a route but just connect stops.
+    - routes: GeoDataFrame, GeoSeries, sequence of shapely geometries or of WKB geometries, or path to a (Geo)Parquet
+        file with WKB geometries in a 'geometry' column
+
+    Returns a data frame with the same index as routes and fields vrtx_count, length and vrtxlength_ratio
+    (NaN for null or zero-length geometries)"""
+    if isinstance(routes, str):
+        routes = pd.read_parquet(routes, columns=['geometry'])['geometry']
+    index = routes.index if isinstance(routes, (pd.Series, pd.DataFrame)) else pd.RangeIndex(len(routes))
+    geoms = routes.geometry.values if isinstance(routes, gpd.GeoDataFrame) else np.asarray(routes, dtype=object)
+    if len(geoms) > 0 and isinstance(geoms[0], (bytes, bytearray)):
+        if hasattr(shapely, 'from_wkb'):
+            geoms = shapely.from_wkb(geoms)
+        else:
+            geoms = np.asarray([wkb.loads(bytes(geom)) if geom is not None else None for geom in geoms], dtype=object)
+
+    coords, partidx, featidx = linecoords(geoms)
+    vertexfeat = featidx[partidx]
+    vcount = np.bincount(vertexfeat, minlength=len(geoms))
+    samepart = partidx[1:] == partidx[:-1]
+    seglength = np.hypot(*(coords[1:] - coords[:-1]).T)[samepart]
+    length = np.bincount(vertexfeat[1:][samepart], weights=seglength, minlength=len(geoms))
+
+    stats = pd.DataFrame({'vrtx_count': vcount, 'length': length}, index=index)
+    stats['vrtxlength_ratio'] = (stats['vrtx_count'] / stats['length']).where(stats['length'] > 0)
+    stats.loc[stats['vrtx_count'] == 0, ['length', 'vrtxlength_ratio']] = np.nan
+    return(stats)
+
+def dedupesegments(gdf, valuefield, tolerance=0.001):
+    """Split lines at vertices and merge identical segments shared by multiple lines, summing valuefield across them.
+    Replaces the sequence SplitLine_management - FindIdentical_management(fields='Shape') - AddJoin_management -
+    Dissolve_management - RepairGeometry_management with a single pandas groupby.
+    - gdf: GeoDataFrame of (multi)lines, ideally in a projected coordinate system
+    - valuefield: numeric field to sum across identical segments (e.g. adjustnum_int)
+    - tolerance: coordinates are snapped to a grid of this size (in the gdf linear unit) to identify identical segments
+
+    Returns a GeoDataFrame of unique two-vertex segments with fields SUM_valuefield and FREQUENCY (number of segments
+    merged). Segments are identical regardless of their direction; zero-length segments are dropped"""
+    coords, partidx, featidx = linecoords(gdf.geometry.values)
+
+    #Explode lines into vertex-pair segments (consecutive vertices in the same part)
+    samepart = partidx[1:] == partidx[:-1]
+    segstart = coords[:-1][samepart]
+    segend = coords[1:][samepart]
+    segvalue = gdf[valuefield].values[featidx[partidx[:-1][samepart]]]
+
+    #Quantize coordinates and normalize direction so that A-B and B-A are the same segment
+    qstart = np.round(segstart / tolerance).astype(np.int64)
+    qend = np.round(segend / tolerance).astype(np.int64)
+    swap = (qstart[:, 0] > qend[:, 0]) | ((qstart[:, 0] == qend[:, 0]) & (qstart[:, 1] > qend[:, 1]))
+    qstart[swap], qend[swap] = qend[swap], qstart[swap].copy()
+    segstart[swap], segend[swap] = segend[swap], segstart[swap].copy()
+    nonnull = ~((qstart == qend).all(axis=1))
+
+    segdf = pd.DataFrame({'qx1': qstart[nonnull, 0], 'qy1': qstart[nonnull, 1],
+                          'qx2': qend[nonnull, 0], 'qy2': qend[nonnull, 1],
+                          'x1': segstart[nonnull, 0], 'y1': segstart[nonnull, 1],
+                          'x2': segend[nonnull, 0], 'y2': segend[nonnull, 1],
+                          valuefield: segvalue[nonnull]})
+    sumfield = 'SUM_{}'.format(valuefield)
+    segdiss = segdf.groupby(['qx1', 'qy1', 'qx2', 'qy2'], sort=False). \
+        agg({'x1': 'first', 'y1': 'first', 'x2': 'first', 'y2': 'first', valuefield: ['sum', 'size']})
+    segdiss.columns = ['x1', 'y1', 'x2', 'y2', sumfield, 'FREQUENCY']
+    segdiss = segdiss.reset_index(drop=True)
+
+    segcoords = np.stack([segdiss[['x1', 'y1']].values, segdiss[['x2', 'y2']].values], axis=1)
+    if hasattr(shapely, 'linestrings'):
+        geoms = shapely.linestrings(segcoords)
+    else:
+        geoms = [LineString(seg) for seg in segcoords]
+    return(gpd.GeoDataFrame(segdiss[[sumfield, 'FREQUENCY']], geometry=geoms, crs=gdf.crs))
+
+def gdftoparquet(gdf, outfile):
+    "Write a GeoDataFrame to parquet with geometries encoded as WKB"
+    df = pd.DataFrame(gdf.drop(columns='geometry'))
+    df['geometry'] = [geom.wkb if geom is not None else None for geom in gdf.geometry]
+    df.to_parquet(outfile, compression='snappy', index=False)
+
+def parquettogdf(infile, crs={'init': 'epsg:4326'}, columns=None):
+    "Read a parquet file written by gdftoparquet back to a GeoDataFrame"
+    df = pd.read_parquet(infile, columns=columns)
+    df['geometry'] = [wkb.loads(bytes(geom)) if geom is not None else None for geom in df['geometry']]
+    return(gpd.GeoDataFrame(df, geometry='geometry', crs=crs))
+
+def feedhash(gtfs_dir, blocksize=2**20):
+    """sha256 hash of the content of a GTFS feed. For a zip file, hash of the archive; for a directory, hash of the
+    relative paths and content of all files in it"""
+    h = hashlib.sha256()
+    if zipfile.is_zipfile(gtfs_dir):
+        flist = [gtfs_dir]
+    else:
+        flist = sorted(listgtfsfiles(gtfs_dir))
+    for fpath in flist:
+        h.update(os.path.relpath(fpath, gtfs_dir).replace('\\', '/').encode('utf-8'))
+        with open(fpath, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                h.update(block)
+    return(h.hexdigest())
+
+def GTFScachepath(gtfs_dir, cachedir, current=True, fhash=None):
+    """Get path of cache entry for a feed: cachedir/feedname/sha256/.
+    With current=True, services that have not started yet are excluded based on the current date, so the routes
+    output is also keyed on the date (routes_currentTrueYYYYMMDD.parquet).
+    Returns tuple of (entry directory, path of cached routes output)"""
+    if fhash is None:
+        fhash = feedhash(gtfs_dir)
+    entrydir = os.path.join(cachedir, feedname(gtfs_dir), fhash)
+    outkey = datetime.now().strftime('True%Y%m%d') if current == True else 'False'
+    return((entrydir, os.path.join(entrydir, 'routes_current{}.parquet'.format(outkey))))
+
+gtfstabnames = ['routes', 'trips', 'calendar', 'calendar_dates']
+
+def readgtfscache(entrydir):
+    """Read the parsed GTFS tables of a cache entry (see GTFStoDFweeklynumber), or None if they were not written
+    completely"""
+    tabsfile = os.path.join(entrydir, 'gtfstables.txt')
+    if not os.path.exists(tabsfile):
+        return(None)
+    with open(tabsfile, 'r') as f:
+        written = f.read().split()
+    return({tabname: pd.read_parquet(os.path.join(entrydir, '{}.parquet'.format(tabname)))
+            if tabname in written else None for tabname in gtfstabnames})
+
+def GTFStoDFweeklynumber(gtfs_dir, current=True, cachedir=None, fhash=None):
+    """Convert a GTFS feed to a GeoDataFrame of shapes with the weekly number of trips on each of them
+    (see module description).
+    - cachedir (optional): if provided, parsed tables and output are stored as parquet in a cache entry keyed on
+        the feed content hash (see GTFScachepath). If the feed has not changed since the last run, the output is
+        read from the cache, or recomputed from the cached tables if only the current argument or date changed.
+        Outdated cache entries for the feed are deleted
+    - fhash (optional): content hash of the feed if already computed (see feedhash)"""
+    if not (os.path.exists(gtfs_dir) and (os.path.isdir(gtfs_dir) or zipfile.is_zipfile(gtfs_dir))):
+        raise Exception("{} does not exist or is not a directory or zip file".format(gtfs_dir))
+
+    agency = feedname(gtfs_dir)
+    if cachedir is not None:
+        entrydir, routes_cache = GTFScachepath(gtfs_dir, cachedir, current=current, fhash=fhash)
+        if os.path.exists(routes_cache):
+            print('{} has not changed, reading from cache...'.format(agency))
+            return(parquettogdf(routes_cache))
+
+    gtfs_files = listgtfsfiles(gtfs_dir)
+    print('Summarizing data for {}...'.format(agency))
+    gtfstabs = readgtfscache(entrydir) if cachedir is not None else None
+    if gtfstabs is None:
+        gtfstabs = readgtfsfeed(gtfs_dir, gtfs_files, agency)
+    else:
+        print('Read parsed tables for {} from cache...'.format(agency))
+    trc_count = GTFStripcount(gtfstabs, agency, current=current)
+
+    print('Joining data for {}...'.format(agency))
+    shapes = GTFSshapes(gtfs_dir, gtfs_files, agency)
+    #Same as AddJoin_management: keep all shapes and only the first matching record in the trip count table
+    routes = pd.DataFrame(shapes[['shape_id', 'AgencyName', 'Agency_shape_id', 'geometry']]).merge(
+        trc_count.drop_duplicates('Agency_shape_id').drop(columns=['shape_id', 'AgencyName']),
+        on='Agency_shape_id', how='left')
+    routes = gpd.GeoDataFrame(routes, geometry='geometry', crs=shapes.crs)
+
+    if cachedir is not None:
+        print('Writing {} to cache...'.format(agency))
+        #Delete outdated entries for this feed
+        for olddir in glob.glob(os.path.join(os.path.dirname(entrydir), '*')):
+            if olddir != entrydir:
+                shutil.rmtree(olddir)
+        if not os.path.exists(entrydir):
+            os.makedirs(entrydir)
+        if not os.path.exists(os.path.join(entrydir, 'gtfstables.txt')):
+            for tabname, tab in gtfstabs.items():
+                if tab is not None:
+                    tab.to_parquet(os.path.join(entrydir, '{}.parquet'.format(tabname)), compression='snappy',
+                                   index=False)
+            #List tables last so that tables are only read back from complete entries
+            with open(os.path.join(entrydir, 'gtfstables.txt'), 'w') as f:
+                f.write('\n'.join(tabname for tabname, tab in gtfstabs.items() if tab is not None))
+        #Delete outputs computed for previous dates
+        for oldout in glob.glob(os.path.join(entrydir, 'routes_currentTrue*.parquet')):
+            if current == True and oldout != routes_cache:
+                os.remove(oldout)
+        #Write output last so that an interrupted run does not leave an entry that looks complete
+        gdftoparquet(routes, routes_cache + '.tmp')
+        os.rename(routes_cache + '.tmp', routes_cache)
+    return(routes)
+
+def GTFSfeedworker(gtfs_dir, current=True, logdir=None, cachedir=None, fhash=None):
+    """Process a single feed in a worker process, logging errors to a feed-specific log that is deleted if empty.
+    Returns a tuple of (feed identifier, GeoDataFrame or None if processing failed)"""
+    outname = feedname(gtfs_dir)
+    errorlog = None
+    if logdir is not None:
+        # Create log to write out errors (https://docs.python.org/3/howto/logging.html#logging-basic-tutorial)
+        errorlog = os.path.join(logdir, datetime.now().strftime('errorlog_{}_%Y%m%d%H%M%S.log'.format(outname)))
+        fh = logging.FileHandler(errorlog)
+        fh.setLevel(logging.WARNING)
+        logging.getLogger().addHandler(fh)
+
+    try:
+        routes = GTFStoDFweeklynumber(gtfs_dir, current=current, cachedir=cachedir, fhash=fhash)
+        routes['feed'] = outname
+    except Exception as e:
+        traceback.print_exc()
+        logging.error('{0} \n {1}'.format(e, traceback.format_exc()))
+        routes = None
+    finally:
+        if errorlog is not None:
+            logging.getLogger().removeHandler(fh)
+            fh.close() #close handler
+            if os.stat(errorlog).st_size == 0: #Delete log if empty
+                os.remove(errorlog)
+    return((outname, routes))
+
+def GTFSbatchweeklynumber(feedlist, current=True, logdir=None, processes=None, cachedir=None):
+    """Process a list of GTFS feeds (directories or zip files) in a process pool and concatenate the per-shape results
+    into a single GeoDataFrame with a 'feed' identifier column.
+    - logdir (optional): directory where per-feed error logs are written
+    - processes (optional): number of worker processes, by default half of the CPUs
+    - cachedir (optional): directory of the feed cache (see GTFStoDFweeklynumber). Only feeds whose content hash
+        changed since the last run are reprocessed, the others are read from the cache"""
+    feedlist = [f for f in feedlist if os.path.isdir(f) or zipfile.is_zipfile(f)]
+    if processes is None:
+        processes = max(int(multiprocessing.cpu_count()/2), 1)
+
+    feedout = []
+    if cachedir is not None:
+        #Hash each feed once, and pass the hash to workers
+        tofeedlist = []
+        for gtfs_dir in feedlist:
+            fhash = feedhash(gtfs_dir)
+            routes_cache = GTFScachepath(gtfs_dir, cachedir, current=current, fhash=fhash)[1]
+            if os.path.exists(routes_cache):
+                routes = parquettogdf(routes_cache)
+                routes['feed'] = feedname(gtfs_dir)
+                feedout.append((feedname(gtfs_dir), routes))
+            else:
+                tofeedlist.append((gtfs_dir, fhash))
+        print('{0} feeds read from cache, {1} to process...'.format(len(feedout), len(tofeedlist)))
+    else:
+        tofeedlist = [(gtfs_dir, None) for gtfs_dir in feedlist]
+
+    if len(tofeedlist) > 0:
+        p = multiprocessing.Pool(min(processes, len(tofeedlist)))
+        try:
+            results = [p.apply_async(GTFSfeedworker, (gtfs_dir,), {'current': current, 'logdir': logdir,
+                                                                   'cachedir': cachedir, 'fhash': fhash})
+                       for gtfs_dir, fhash in tofeedlist]
+            feedout.extend([r.get() for r in results])
+        finally:
+            p.close()
+            p.join()
+
+    failedlist = [name for name, routes in feedout if routes is None]
+    if len(failedlist) > 0:
+        print('{} failed to process...'.format(','.join(failedlist)))
+
+    routeslist = [routes for name, routes in feedout if routes is not None]
+    if len(routeslist) == 0:
+        raise ValueError('No GTFS feed could be processed')
+    return(gpd.GeoDataFrame(pd.concat(routeslist, ignore_index=True, sort=False),
+                            geometry='geometry', crs=routeslist[0].crs))
+
+if __name__ == '__main__':
+    #Batch entry point: python GTFStoDF.py <directory of feeds> <output .gpkg> [current (True/False)] [cache directory]
+    #Run as a separate script so that worker processes do not re-execute the calling script when spawned on Windows
+    import sys
+    feeds_dir, out_gpkg = sys.argv[1], sys.argv[2]
+    current = (sys.argv[3] != 'False') if len(sys.argv) > 3 else True
+    cachedir = sys.argv[4] if len(sys.argv) > 4 else None
+    routes_gpd = GTFSbatchweeklynumber(feedlist=[os.path.join(feeds_dir, f) for f in os.listdir(feeds_dir)],
+                                       current=current, logdir=feeds_dir, cachedir=cachedir)
+    routes_gpd.to_file(out_gpkg, layer=os.path.splitext(os.path.split(out_gpkg)[1])[0], driver='GPKG')
+    print('{0} routes from {1} feeds written to {2}'.format(len(routes_gpd), routes_gpd['feed'].nunique(), out_gpkg))
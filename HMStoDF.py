@@ -0,0 +1,203 @@
+'''
+Author: Mathis Messager
+Contact info: messamat@uw.edu
+Creation date: May 2019
+
+Required Arguments:
+    - smokedir (directory): directory of daily NOAA Hazard Mapping System (HMS) smoke polygon shapefiles
+            (hms_smokeYYYYMMDD.shp, see Download_gist.downloadsmoke)
+
+Description: arcpy-free counterpart to the per-year FieldMappings merges of DownloadSmoke.py. smoketoparquet reads
+    all daily shapefiles with a thread pool, normalizes their fields (ID, Satellite, Start, End as text and Density as
+    a number, whatever their type and length in the original files), adds the name of the daily file (fcname) and
+    its date, and writes one GeoParquet dataset partitioned by year (outdir/year=YYYY/smoke.parquet, geometries
+    encoded as WKB). Records are sorted by date and carry their bounding box (minx, miny, maxx, maxy), so that
+    row group statistics act as a date and spatial index within each partition. A json index records the date range,
+    bounding box, number of records and daily files of each partition: partitions whose daily files have not changed
+    are not rewritten, and readsmoke only opens the partitions that overlap the queried dates and bounding box.
+'''
+
+import os
+import re
+import glob
+import json
+import hashlib
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from shapely import wkb
+from shapely.geometry import box
+
+#Normalized schema of smoke polygon attributes
+smokefields = ['ID', 'Satellite', 'Start', 'End', 'Density']
+smokeschema = pa.schema([(f, pa.string()) for f in ['ID', 'Satellite', 'Start', 'End']] +
+                        [('Density', pa.float64()), ('fcname', pa.string()), ('date', pa.timestamp('ns'))] +
+                        [(f, pa.float64()) for f in ['minx', 'miny', 'maxx', 'maxy']] +
+                        [('geometry', pa.binary())])
+geoparquetversion = '1.1.0'
+
+def geoparquetmeta(geoms, bbox):
+    """GeoParquet 'geo' file metadata (https://geoparquet.org) for WKB geometries in a 'geometry' column, with the
+    bounding box of each record in minx, miny, maxx, maxy columns. No crs means OGC:CRS84 (WGS84 longitude/latitude)"""
+    return(json.dumps({'version': geoparquetversion,
+                       'primary_column': 'geometry',
+                       'columns': {'geometry': {
+                           'encoding': 'WKB',
+                           'geometry_types': sorted(set(geom.geom_type for geom in geoms if geom is not None)),
+                           'bbox': bbox,
+                           'covering': {'bbox': {'xmin': ['minx'], 'ymin': ['miny'],
+                                                 'xmax': ['maxx'], 'ymax': ['maxy']}}}}}))
+
+def smokefiledate(smokefile):
+    "Date of a daily HMS smoke shapefile from its name (hms_smokeYYYYMMDD.shp)"
+    return(pd.to_datetime(re.search('(?<=hms_smoke)[0-9]{8}', os.path.split(smokefile)[1]).group(), format='%Y%m%d'))
+
+def readsmokefile(smokefile):
+    """Read a daily HMS smoke shapefile and normalize its fields (see smokefields). Field names are matched
+    case-insensitively, missing fields are filled with nulls and whitespace is stripped from text fields.
+    Returns None for files without any polygon"""
+    try:
+        gdf = gpd.read_file(smokefile)
+    except Exception as e:
+        print('Could not read {0}: {1}'.format(smokefile, e))
+        return(None)
+    gdf = gdf[~(gdf.geometry.isnull() | gdf.geometry.is_empty)]
+    if len(gdf) == 0:
+        return(None)
+
+    colmatch = {c.lower(): c for c in gdf.columns}
+    df = pd.DataFrame(index=gdf.index)
+    for f in smokefields:
+        if f.lower() in colmatch:
+            col = gdf[colmatch[f.lower()]]
+            df[f] = col.astype(str).str.strip().where(col.notnull(), None) #Keep nulls rather than 'nan'/'None'
+        else:
+            df[f] = None
+    df['Density'] = pd.to_numeric(df['Density'].str.replace(r'\s', '', regex=True), errors='coerce')
+    df['fcname'] = os.path.splitext(os.path.split(smokefile)[1])[0]
+    df['date'] = smokefiledate(smokefile)
+    bounds = gdf.geometry.bounds
+    #Daily files have no projection file, HMS polygons are in WGS84
+    return(gpd.GeoDataFrame(pd.concat([df, bounds], axis=1), geometry=list(gdf.geometry), crs={'init': 'epsg:4326'}))
+
+def filelisthash(filelist):
+    "sha256 hash of the names, sizes and modification times of a list of files, to detect changes"
+    h = hashlib.sha256()
+    for f in sorted(filelist):
+        h.update('{0}_{1}_{2}'.format(os.path.split(f)[1], os.path.getsize(f), os.path.getmtime(f)).encode('utf-8'))
+    return(h.hexdigest())
+
+def smoketoparquet(smokedir, outdir, years=None, maxworkers=8, row_group_size=10000, overwrite=False):
+    """Merge daily HMS smoke shapefiles into a GeoParquet dataset partitioned by year (see module description).
+    years (optional): list of years to process, all years in smokedir by default
+    maxworkers (optional): number of shapefiles read concurrently
+    overwrite (optional): whether to rewrite partitions whose daily files have not changed
+    Returns the index dictionary by year"""
+    if not os.path.exists(outdir):
+        os.mkdir(outdir)
+    indexfile = os.path.join(outdir, '_index.json')
+    smokeindex = {}
+    if os.path.exists(indexfile):
+        with open(indexfile, 'r') as f:
+            smokeindex = json.load(f)
+
+    smokefiles = glob.glob(os.path.join(smokedir, 'hms_smoke[0-9]*.shp'))
+    yeardict = {}
+    for smokefile in smokefiles:
+        yeardict.setdefault(str(smokefiledate(smokefile).year), []).append(smokefile)
+    if years is not None:
+        yeardict = {yr: flist for yr, flist in yeardict.items() if int(yr) in years}
+
+    p = ThreadPool(maxworkers)
+    try:
+        for yr in sorted(yeardict):
+            fhash = filelisthash(yeardict[yr])
+            outfile = os.path.join(outdir, 'year={}'.format(yr), 'smoke.parquet')
+            if not overwrite and os.path.exists(outfile) and smokeindex.get(yr, {}).get('hash') == fhash and \
+                    smokeindex[yr].get('geoparquet') == geoparquetversion:
+                print('Smoke polygons for {} are up to date, skipping...'.format(yr))
+                continue
+
+            print('Reading {0} daily smoke files for {1}...'.format(len(yeardict[yr]), yr))
+            gdflist = [gdf for gdf in p.map(readsmokefile, sorted(yeardict[yr])) if gdf is not None]
+            if len(gdflist) == 0:
+                continue
+            smokeyr = pd.concat(gdflist, axis=0, ignore_index=True).sort_values('date', kind='mergesort')
+            df = pd.DataFrame(smokeyr.drop(columns='geometry'))
+            df['geometry'] = [geom.wkb for geom in smokeyr.geometry]
+
+            if not os.path.exists(os.path.split(outfile)[0]):
+                os.mkdir(os.path.split(outfile)[0])
+            bbox = [float(df['minx'].min()), float(df['miny'].min()), float(df['maxx'].max()), float(df['maxy'].max())]
+            table = pa.Table.from_pandas(df, schema=smokeschema, preserve_index=False)
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                                       geo=geoparquetmeta(smokeyr.geometry, bbox)))
+            pq.write_table(table, outfile + '.tmp', row_group_size=row_group_size, compression='snappy')
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            os.rename(outfile + '.tmp', outfile)
+
+            smokeindex[yr] = {'hash': fhash,
+                              'files': len(yeardict[yr]),
+                              'count': len(df),
+                              'mindate': str(df['date'].min().date()),
+                              'maxdate': str(df['date'].max().date()),
+                              'bbox': bbox,
+                              'geoparquet': geoparquetversion}
+            with open(indexfile + '.tmp', 'w') as f:
+                json.dump(smokeindex, f, indent=1, sort_keys=True)
+            if os.path.exists(indexfile):
+                os.remove(indexfile)
+            os.rename(indexfile + '.tmp', indexfile)
+            print('{0} smoke polygons written to {1}'.format(len(df), outfile))
+    finally:
+        p.close()
+        p.join()
+    return(smokeindex)
+
+def readsmoke(indir, startdate=None, enddate=None, bbox=None, columns=None):
+    """Query the smoke polygon dataset written by smoketoparquet.
+    Only partitions whose date range and bounding box overlap the query are opened (see index), and filters on
+    date and bounding box columns are pushed down to the parquet reader so that other row groups are skipped.
+    startdate, enddate (optional): range of dates (inclusive)
+    bbox (optional): (minx, miny, maxx, maxy) in WGS84, only polygons that intersect it are returned
+    columns (optional): list of attribute columns to load, all by default
+    Returns a GeoDataFrame"""
+    with open(os.path.join(indir, '_index.json'), 'r') as f:
+        smokeindex = json.load(f)
+    startdate = pd.Timestamp(startdate) if startdate is not None else None
+    enddate = pd.Timestamp(enddate) if enddate is not None else None
+
+    filters = []
+    if startdate is not None:
+        filters.append(('date', '>=', startdate))
+    if enddate is not None:
+        filters.append(('date', '<=', enddate))
+    if bbox is not None:
+        filters.extend([('maxx', '>=', bbox[0]), ('maxy', '>=', bbox[1]), ('minx', '<=', bbox[2]),
+                        ('miny', '<=', bbox[3])])
+    if columns is not None:
+        columns = list(columns) + [c for c in ['date', 'geometry'] if c not in columns]
+
+    dflist = []
+    for yr in sorted(smokeindex):
+        yrindex = smokeindex[yr]
+        if (startdate is not None and pd.Timestamp(yrindex['maxdate']) < startdate) or \
+                (enddate is not None and pd.Timestamp(yrindex['mindate']) > enddate):
+            continue
+        if bbox is not None and not box(*yrindex['bbox']).intersects(box(*bbox)):
+            continue
+        dflist.append(pq.read_table(os.path.join(indir, 'year={}'.format(yr), 'smoke.parquet'), columns=columns,
+                                    filters=filters if len(filters) > 0 else None).to_pandas())
+    if len(dflist) == 0:
+        return(gpd.GeoDataFrame(geometry=[], crs={'init': 'epsg:4326'}))
+
+    df = pd.concat(dflist, axis=0, ignore_index=True)
+    gdf = gpd.GeoDataFrame(df.drop(columns='geometry'),
+                           geometry=[wkb.loads(bytes(geom)) for geom in df['geometry']], crs={'init': 'epsg:4326'})
+    if bbox is not None: #Exact test on candidate polygons
+        gdf = gdf.iloc[np.sort(gdf.sindex.query(box(*bbox), predicate='intersects'))]
+    return(gdf)
@@ -9,16 +9,20 @@ import zipfile
 import re
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 import numpy as np
 import time
 import logging
 import itertools
+import subprocess
+import sys
 
 #Custom modules
 from explode_overlapping import *
 from SpatialJoinLines_LargestOverlap import *
 from heatmap_custom import *
 from GTFStoSHP import *
+from GTFStoDF import *
 
 # create logger with GTFStoSHP
 logger = logging.getLogger('GTFStoSHP')
@@ -116,7 +120,6 @@ PStransit = os.path.join(rootdir, 'results/transit.gdb/PStransit')
 PStransitbus = PStransit + '_busroutes'
 PStransitbus_proj = PStransit + '_busroutes_proj'
 PStransitbus_splitdiss = PStransitbus_proj + '_splitv_diss'
-PStransitduplitab = os.path.join(rootdir, 'results/transit.gdb/explFindID')
 PStransitras = os.path.join(rootdir, 'results/transit.gdb/PStransit_ras')
 
 trees_aea = os.path.join(gdb, 'trees_aea')
@@ -281,29 +284,18 @@ with arcpy.da.UpdateCursor(PSOSM_all, ['fclass','fclassADT', 'fclassSPD']) as cu
 GTFStoSHPweeklynumber(gtfs_dir= STgtfs, out_gdb=os.path.dirname(soundtransit), out_fc = os.path.basename(soundtransit),
                       keep = False)
 
-for gtfsdir in os.listdir(transitwiki_dir):
-    indir = os.path.join(transitwiki_dir, gtfsdir)
-    outname = re.sub('\W','_', os.path.splitext(gtfsdir)[0])
-    if (os.path.isdir(indir) or zipfile.is_zipfile(indir)):
-        if not arcpy.Exists(os.path.join(os.path.dirname(PStransit), outname + '_routes')):
-            print(outname)
-            # Create log to write out errors (https://docs.python.org/3/howto/logging.html#logging-basic-tutorial)
-            errorlog = os.path.join(transitwiki_dir,
-                                    datetime.now().strftime('errorlog_{}_%Y%m%d%H%M%S.log'.format(outname)))
-            fh = logging.FileHandler(errorlog) # create file handler which logs even debug messages
-            fh.setLevel(logging.WARNING) #Set handler level
-            GTFStoSHPweeklynumber(gtfs_dir= indir, out_gdb=os.path.dirname(PStransit),
-                                  out_fc = outname, keep=False)
-            fh.close() #close handler
-            if os.stat(errorlog).st_size == 0L: #Delete log if empty
-                os.remove(errorlog)
-
-#Merge all transit datasets
-arcpy.Merge_management(arcpy.ListFeatureClasses('*_routes'), output = PStransit)
+#Process all TransitWiki feeds in parallel and merge them in memory into a single route layer
+#(run as a separate process so that pool workers do not re-execute this script). Only feeds that changed since
+#the last run are reprocessed, the others are read from the cache
+PStransit_gpkg = os.path.join(rootdir, 'results/PStransit.gpkg')
+if not arcpy.Exists(PStransit):
+    subprocess.check_call([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'GTFStoDF.py'),
+                           transitwiki_dir, PStransit_gpkg, 'True', os.path.join(rootdir, 'results/GTFScache')])
+    arcpy.CopyFeatures_management(os.path.join(PStransit_gpkg, 'main.PStransit'), PStransit)
 
 #Only keep buses with trips and whose schedule lasts more than 1 day
 arcpy.MakeFeatureLayer_management(PStransit, 'PStransit_lyr',
-                                  where_clause= '(route_type = 3) AND (MIN_service_len > 1) AND (SUM_adjustnum > 0)')
+                                  where_clause= "(route_type = '3') AND (service_len_MIN > 1) AND (adjustnum_SUM > 0)")
 arcpy.CopyFeatures_management('PStransit_lyr', PStransitbus)
 arcpy.Project_management(PStransitbus, PStransitbus_proj, cs_ref)
 
@@ -311,16 +303,17 @@ arcpy.Project_management(PStransitbus, PStransitbus_proj, cs_ref)
 # Convert weekly number of buses to integer
 arcpy.AddField_management(PStransitbus_proj, 'adjustnum_int', 'SHORT')
 arcpy.CalculateField_management(PStransitbus_proj, 'adjustnum_int',
-                                expression='int(10*!SUM_adjustnum!+0.5)', expression_type='PYTHON')
-
-#Split lines at all intersections so that small identical overlapping segments can be dissolved
-arcpy.SplitLine_management(PStransitbus_proj, PStransitbus_proj + '_split') #Split at intersection
-arcpy.FindIdentical_management(in_dataset=PStransitbus_proj + '_split', out_dataset=PStransitduplitab, fields="Shape") #Find overlapping segments and make them part of a group (FEAT_SEQ)
-arcpy.MakeFeatureLayer_management(PStransitbus_proj + '_split', "intlyr")
-arcpy.AddJoin_management("intlyr", arcpy.Describe("intlyr").OIDfieldName, PStransitduplitab, "IN_FID", "KEEP_ALL")
-arcpy.Dissolve_management("intlyr", PStransitbus_splitdiss, dissolve_field='explFindID.FEAT_SEQ',
-                          statistics_fields=[[os.path.split(PStransitbus_proj)[1] + '_split.adjustnum_int', 'SUM']]) #Dissolve overlapping segments
-arcpy.RepairGeometry_management(PStransitbus_splitdiss, delete_null = 'DELETE_NULL') #sometimes creates empty geom
+                                expression='int(10*!adjustnum_SUM!+0.5)', expression_type='PYTHON')
+
+#Split lines at vertices and merge identical overlapping segments, summing their number of trips
+PStransitbus_splitdiss_gpkg = os.path.join(rootdir, 'results/PStransit_busroutes_proj_splitv_diss.gpkg')
+PStransitbus_gpd = gpd.read_file(os.path.dirname(PStransitbus_proj), driver='FileGDB',
+                                 layer=os.path.basename(PStransitbus_proj))
+dedupesegments(PStransitbus_gpd, valuefield='adjustnum_int'). \
+    to_file(PStransitbus_splitdiss_gpkg, layer='PStransitbus_splitdiss', driver='GPKG')
+arcpy.CopyFeatures_management(os.path.join(PStransitbus_splitdiss_gpkg, 'main.PStransitbus_splitdiss'),
+                              PStransitbus_splitdiss)
+del PStransitbus_gpd
 
 #Get the length of a half pixel diagonal to create buffers for
 #guaranteeing that segments potentially falling within the same pixel are rasterized separately
@@ -339,7 +332,7 @@ for tile in tilelist:
         selexpr = '{0} = {1}'.format(tilef, tile)
         print(selexpr)
         arcpy.MakeFeatureLayer_management(PStransitbus_splitdiss, 'bus_lyr', where_clause= selexpr)
-        arcpy.PolylineToRaster_conversion('bus_lyr', value_field='SUM_PStransit_busroutes_proj_split_adjustnum_int',
+        arcpy.PolylineToRaster_conversion('bus_lyr', value_field='SUM_adjustnum_int',
                                           out_rasterdataset=outras, cellsize=restemplate)
 
 #Mosaic to new raster
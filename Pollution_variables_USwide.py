@@ -24,6 +24,7 @@ from collections import defaultdict
 
 from SpatialJoinLines_LargestOverlap import *
 from GTFStoSHP import *
+from GTFStoDF import *
 from explode_overlapping import *
 from heatmap_custom import *
 from Download_gist import *
@@ -39,6 +40,7 @@ USDOTdir = os.path.join(rootdir, "data\USDOT_0319")
 NTMdir = os.path.join(rootdir, "data\NTM_0319")
 resdir = os.path.join(rootdir, 'results/usdot')
 AQIgdb = os.path.join(rootdir, 'results/airdata/AQI.gdb')
+dlcachedir = os.path.join(rootdir, 'data/dlcache') #Download cache shared across scripts
 
 NED19proj = os.path.join(rootdir, 'results/ned19_psproj')
 NED13proj = os.path.join(rootdir, 'results/ned13_psproj')
@@ -166,7 +168,7 @@ hm20urltab = os.path.split(hm20url)[0] + '/' + \
                        if i not in os.path.split(hm20url)[0].split('/')])
 hm20tab = os.path.join(USDOTdir, os.path.split(hm20urltab)[1])
 if not arcpy.Exists(hm20tab):
-    dlfile(hm20urltab, hm20tab)
+    dlfile(hm20urltab, USDOTdir, cachedir=dlcachedir)
 else:
     print('{} already exists...'.format(hm20tab))
 
@@ -180,7 +182,7 @@ vm2urltab = os.path.split(vm2url)[0] + '/' + \
                        if i not in os.path.split(vm2url)[0].split('/')])
 vm2tab = os.path.join(USDOTdir, os.path.split(vm2urltab)[1])
 if not arcpy.Exists(vm2tab):
-    dlfile(vm2urltab, vm2tab)
+    dlfile(vm2urltab, USDOTdir, cachedir=dlcachedir)
 else:
     print('{} already exists...'.format(vm2tab))
 
@@ -247,7 +249,7 @@ USAADTformat.to_csv(os.path.join(resdir, 'checkAADT.csv'))
 #Download USHPMS data (https://www.bts.gov/geography/geospatial-portal/NTAD-direct-download)
 if not arcpy.Exists(hpms):
     dlfile(url="http://www.bts.gov/sites/bts.dot.gov/files/ntad/HPMS2016.gdb.zip",
-           outpath=USDOTdir)
+           outpath=USDOTdir, cachedir=dlcachedir)
 
 #Fill in AADT value for all roads based on state-wide averages
 #[[f.name, f.type] for f in arcpy.ListFields(hpms)]
@@ -294,7 +296,7 @@ missingstatefips = list(fsystemstats[(fsystemstats['f_system']==7) & (fsystemsta
 
 #Download list of all FIPS codes in the US (see https://www.census.gov/geo/reference/codes/cou.html for metadata)
 dlfile(url = 'https://www2.census.gov/geo/docs/reference/codes/files/national_county.txt', outpath = tiger16dir,
-       fieldnames = ['STATE', 'STATEFP', 'COUNTYFP', 'COUNTYNAME', 'CLASSFP'])
+       fieldnames = ['STATE', 'STATEFP', 'COUNTYFP', 'COUNTYNAME', 'CLASSFP'], cachedir=dlcachedir)
 fipslist = pd.read_csv(os.path.join(tiger16dir, 'national_county.txt'))
 
 missingcountyfips = fipslist[fipslist['STATEFP'].isin(missingstatefips)]
@@ -330,22 +332,17 @@ arcpy.CopyFeatures_management('tigerroads_lyr', tigerroads_sub)
 #Intersect with urbanized area boundaries to add urban code (but can't find adjusted urban areas)
 #Download tiger 2016 urban area data (not adjusted)
 UA2016_url = 'http://www2.census.gov/geo/tiger/GENZ2016/shp/cb_2016_us_ua10_500k.zip'
-dlfile(UA2016_url, outpath=tiger16dir)
+dlfile(UA2016_url, outpath=tiger16dir, cachedir=dlcachedir)
 UA2016 = '{}.shp'.format(os.path.join(tiger16dir,
                                       os.path.splitext(os.path.split(UA2016_url)[1])[0]))
 
 #Download USDOT urban area boundary file (not adjusted)
 UA_API = 'https://geo.dot.gov/server/rest/services/NTAD/Urbanized_Areas/MapServer/0/query'
 #print("/server/rest" in requests.get(UA_API).headers.get('Path')) could make sure that it's a rest api
-APIdownload(baseURL=UA_API,
-            workspace=USDOTdir,
-            basename='USDOT_UA',
-            itersize=100,
-            IDlist=[0,10000])
-arcpy.Merge_management(arcpy.ListFeatureClasses('{}_*'.format('USDOT_UA')),output='{}'.format('USDOT_UA'))
-for fc in arcpy.ListFeatureClasses('{}_*'.format('USDOT_UA')):
-    arcpy.Delete_management(fc)
-    print('Deleted {}...'.format(fc))
+USDOT_UA_gpkg = os.path.join(USDOTdir, 'USDOT_UA.gpkg')
+if not os.path.exists(USDOT_UA_gpkg):
+    RESTdownload(baseURL=UA_API, outfile=USDOT_UA_gpkg, itersize=100)
+arcpy.CopyFeatures_management(os.path.join(USDOT_UA_gpkg, 'main.USDOT_UA'), os.path.join(USDOTdir, 'USDOT_UA.shp'))
 
 #It seems that the tiger 2016 boundary file is the one that fits the HPMS urban codes best, so use that
 arcpy.SpatialJoin_analysis(tigerroads_sub, UA2016, tigerroads_UA, 'JOIN_ONE_TO_ONE',
@@ -467,75 +464,57 @@ arcpy.Project_management(hpmstiger, hpmstigerproj, out_coor_system= cs_ref)
 #Download tables and shapefile directly from API
 basename='NTM_shapes'
 if not arcpy.Exists(os.path.join(NTMdir, '{}.shp'.format(basename))):
-    APIdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/1/query",
-                workspace = NTMdir,
-                basename = basename,
-                itersize = 1000,
-                IDlist = [0,1000000],
-                geometry=True)
-    arcpy.Merge_management(arcpy.ListFeatureClasses('{}_*'.format(basename)),output='{}'.format(basename))
-    for fc in arcpy.ListFeatureClasses('{}_*'.format(basename)):
-        arcpy.Delete_management(fc)
-        print('Deleted {}...'.format(fc))
+    RESTdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/1/query",
+                 outfile = os.path.join(NTMdir, '{}.gpkg'.format(basename)),
+                 itersize = 1000,
+                 geometry=True)
+    arcpy.CopyFeatures_management(os.path.join(NTMdir, '{}.gpkg'.format(basename), 'main.{}'.format(basename)),
+                                  os.path.join(NTMdir, '{}.shp'.format(basename)))
 
 #Calendar dates
 outcaldates = os.path.join(NTMdir, 'NTMAPI_calendar_dates.csv')
 if not arcpy.Exists(outcaldates):
-    APIdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/2/query",
-                workspace = NTMdir, basename = 'NTM_calendar_dates', itersize = 1000, IDlist = [0,100000], geometry=False)
-    mergedel(NTMdir, 'NTM_calendar_dates_[0-9]+_[0-9]+[.]csv$', outcaldates, verbose=True)
+    RESTdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/2/query",
+                 outfile = outcaldates, itersize = 1000, geometry=False)
 #Trips
 outtrips = os.path.join(NTMdir, 'NTMAPI_trips.csv')
 if not arcpy.Exists(outtrips):
-    APIdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/7/query",
-                workspace = NTMdir, basename = 'NTM_trips', itersize = 1000, IDlist = [0,1700000], geometry=False)
-    mergedel(NTMdir, 'NTM_trips_[0-9]+_[0-9]+[.]csv$', os.path.join(NTMdir, 'NTMAPI_trips.csv'), verbose=True)
+    RESTdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/7/query",
+                 outfile = outtrips, itersize = 1000, geometry=False)
 #Calendar
 outcalendar = os.path.join(NTMdir, 'NTMAPI_calendar.csv')
 if not arcpy.Exists(outcalendar):
-    APIdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/9/query",
-                workspace = NTMdir, basename = 'NTM_calendar', itersize = 500, IDlist = [0,10000], geometry=False)
-    mergedel(NTMdir, 'NTM_calendar_[0-9]+_[0-9]+[.]csv$', outcalendar, verbose=True)
+    RESTdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/9/query",
+                 outfile = outcalendar, itersize = 500, geometry=False)
 #Routes
 outroutes = os.path.join(NTMdir, 'NTMAPI_routes.csv')
 if not arcpy.Exists(outroutes):
-    APIdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/11/query",
-                workspace = NTMdir, basename = 'NTM_routes', itersize = 1000, IDlist = [0,15000], geometry=False)
-    mergedel(NTMdir, 'NTM_routes_[0-9]+_[0-9]+[.]csv$', outroutes, verbose=True)
+    RESTdownload(baseURL="https://geo.dot.gov/server/rest/services/NTAD/GTFS_NTM/MapServer/11/query",
+                 outfile = outroutes, itersize = 1000, geometry=False)
 
 #Format data
 GTFStoSHPweeklynumber(gtfs_dir= NTMdir, out_gdb=os.path.join(rootdir, 'results/NTM.gdb'), out_fc = 'NTM',
                       current=False, keep = True)
 
 #Identify routes for which the shape does not correspond to the actual trajectory but just stops
-arcpy.AddField_management(NTMroutes, 'vrtx_count', 'LONG')
-arcpy.AddField_management(NTMroutes, 'vrtxlength_ratio', 'FLOAT')
-fc = int(arcpy.GetCount_management(NTMroutes).getOutput(0))
-with arcpy.da.UpdateCursor(NTMroutes, ['SHAPE@', 'vrtx_count', 'SHAPE@LENGTH', 'vrtxlength_ratio']) as cursor:
-    x=0
-    for row in cursor:
-        if x%100 == 0:
-            print('{}% of records processed'.format(100*x/fc))
-        vcount = 0
-        if row[0]: #Make sure that shape is valid (some 'None' shapes sometimes)
-            for part in row[0]: #Iterate through parts for multipart features
-                for pnt in part: #Iterate through part's points
-                    if pnt:
-                        vcount += 1
-            row[1] = vcount
-            row[3] = vcount/row[2] #vrtexlength_ratio = vertex count/shape_length
-
-            cursor.updateRow(row)
-        x += 1
+NTMroutes_gpd = gpd.read_file(os.path.dirname(NTMroutes), driver='FileGDB', layer=os.path.basename(NTMroutes))
+NTMroutes_gpd = NTMroutes_gpd.join(routestats(NTMroutes_gpd)[['vrtx_count', 'vrtxlength_ratio']])
 
 #Only keep overground transports (although some subways might have some overground sections)
-routeSQL = "(route_type IN ('0','2','3','5')) AND" \
-           "(service_len_MIN > 30) AND" \
-           "(adjustnum_SUM > 0) AND" \
-           "(((NOT AgencyName = 'NJTRANSITBUS_20080_277_1046') AND (vrtxlength_ratio > 0.0003)) OR" \
-           " ((AgencyName = 'NJTRANSITBUS_20080_277_1046') AND (vrtxlength_ratio > 0.001)))"
-arcpy.MakeFeatureLayer_management(NTMroutes, 'routes_lyr', where_clause= routeSQL)
-arcpy.CopyFeatures_management('routes_lyr', NTMsel)
+#Same as routeSQL = "(route_type IN ('0','2','3','5')) AND (service_len_MIN > 30) AND (adjustnum_SUM > 0) AND
+#                    (((NOT AgencyName = 'NJTRANSITBUS_20080_277_1046') AND (vrtxlength_ratio > 0.0003)) OR
+#                     ((AgencyName = 'NJTRANSITBUS_20080_277_1046') AND (vrtxlength_ratio > 0.001)))"
+#NOT AgencyName = '...' is false for null AgencyName in SQL, and route_type may be stored as text ('3') or number (3.0)
+njbus = NTMroutes_gpd['AgencyName'] == 'NJTRANSITBUS_20080_277_1046'
+routemask = (pd.to_numeric(NTMroutes_gpd['route_type'], errors='coerce').isin([0, 2, 3, 5])) & \
+            (NTMroutes_gpd['service_len_MIN'] > 30) & \
+            (NTMroutes_gpd['adjustnum_SUM'] > 0) & \
+            ((NTMroutes_gpd['AgencyName'].notnull() & (~njbus) & (NTMroutes_gpd['vrtxlength_ratio'] > 0.0003)) |
+             (njbus & (NTMroutes_gpd['vrtxlength_ratio'] > 0.001)))
+NTMsel_gpkg = os.path.join(rootdir, 'results/NTM_routes_sel.gpkg')
+NTMroutes_gpd[routemask].to_file(NTMsel_gpkg, layer='NTMsel', driver='GPKG')
+arcpy.CopyFeatures_management(os.path.join(NTMsel_gpkg, 'main.NTMsel'), NTMsel)
+del NTMroutes_gpd
 NTMproj = os.path.join(rootdir, 'results/NTM.gdb/NTM_routes_selproj')
 arcpy.Project_management(in_dataset=NTMsel, out_dataset=NTMproj, out_coor_system=cs_ref)
 
@@ -548,14 +527,13 @@ with arcpy.da.UpdateCursor(NTMproj, ['adjustnum_SUM', 'adjustnum_int']) as curso
             row[1] = int(10*row[0]+0.5)
             cursor.updateRow(row)
 
-#Split lines at all intersections so that small identical overlapping segments can be dissolved
-arcpy.SplitLine_management(NTMproj, NTMproj + '_split') #Split at intersection
-arcpy.FindIdentical_management(NTMproj + '_split', "explFindID", "Shape") #Find overlapping segments and make them part of a group (FEAT_SEQ)
-arcpy.MakeFeatureLayer_management(NTMproj + '_split', "intlyr")
-arcpy.AddJoin_management("intlyr", arcpy.Describe("intlyr").OIDfieldName, "explFindID", "IN_FID", "KEEP_ALL")
-arcpy.Dissolve_management("intlyr", NTMsplitdiss, dissolve_field='explFindID.FEAT_SEQ',
-                          statistics_fields=[[os.path.split(NTMproj)[1] + '_split.adjustnum_int', 'SUM']]) #Dissolve overlapping segments
-arcpy.RepairGeometry_management(NTMsplitdiss, delete_null = 'DELETE_NULL') #sometimes creates empty geom
+#Split lines at vertices and merge identical overlapping segments, summing their number of trips
+NTMsplitdiss_gpkg = os.path.join(rootdir, 'results/NTM_routes_selproj_splitv_diss.gpkg')
+NTMproj_gpd = gpd.read_file(os.path.dirname(NTMproj), driver='FileGDB', layer=os.path.basename(NTMproj))
+dedupesegments(NTMproj_gpd[NTMproj_gpd['adjustnum_int'].notnull()], valuefield='adjustnum_int'). \
+    to_file(NTMsplitdiss_gpkg, layer='NTMsplitdiss', driver='GPKG')
+arcpy.CopyFeatures_management(os.path.join(NTMsplitdiss_gpkg, 'main.NTMsplitdiss'), NTMsplitdiss)
+del NTMproj_gpd
 #Get the length of a half pixel diagonal to create buffers for
 #guaranteeing that segments potentially falling within the same pixel are rasterized separately
 tolerance = (2.0**0.5)*float(restemplate.getOutput(0))/2
@@ -590,7 +568,7 @@ for tile in tilelist:
             arcpy.MakeFeatureLayer_management(NTMsplitdiss, 'transit_lyr', where_clause= selexpr)
             tmplyr = os.path.join(tmpdir, 'transit{}.shp'.format(tile))
             arcpy.CopyFeatures_management('transit_lyr', tmplyr)
-            arcpy.PolylineToRaster_conversion(tmplyr, value_field='SUM_NTM_routes_selproj_split_adjustnum_int'[0:10],
+            arcpy.PolylineToRaster_conversion(tmplyr, value_field='SUM_adjustnum_int'[0:10],
                                               out_rasterdataset=outras, cellsize=restemplate)
         except:
             traceback.print_exc()
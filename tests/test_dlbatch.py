@@ -0,0 +1,119 @@
+#Tests of dlstream and dlbatch (Download_gist.py) against a local HTTP server
+import threading
+import collections
+from time import sleep as serversleep #Not affected by patching time.sleep in Download_gist
+import pytest
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+import Download_gist
+from Download_gist import dlstream, dlbatch
+
+BODY = b'0123456789' * 1000
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves BODY for any /files/ or /flaky/ path after a short delay.
+    /flaky/ paths answer 503 to their first server.flaky requests, /missing and /gone answer 404 and 410,
+    /forbidden answers 403. Requests are counted by path and concurrent requests are tracked by Host header"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def sendbody(self, code, body=b''):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        host = self.headers.get('Host')
+        with server.lock:
+            server.hits[self.path] += 1
+            server.active[host] += 1
+            server.maxactive[host] = max(server.maxactive[host], server.active[host])
+            server.maxtotal = max(server.maxtotal, sum(server.active.values()))
+        try:
+            serversleep(server.delay)
+            if self.path.startswith('/flaky/') and server.hits[self.path] <= server.flaky:
+                return(self.sendbody(503))
+            if self.path.startswith('/files/') or self.path.startswith('/flaky/'):
+                return(self.sendbody(200, BODY))
+            self.sendbody({'/missing': 404, '/gone': 410, '/forbidden': 403}.get(self.path.split('.')[0], 404))
+        finally:
+            with server.lock:
+                server.active[host] -= 1
+
+@pytest.fixture
+def httpserver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    server.lock = threading.Lock()
+    server.hits = collections.Counter()
+    server.active = collections.Counter()
+    server.maxactive = collections.Counter()
+    server.maxtotal = 0
+    server.delay = 0
+    server.flaky = 2
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.port = server.server_address[1]
+    server.url = 'http://127.0.0.1:{}'.format(server.port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    "Record the waits between retries instead of sleeping"
+    waits = []
+    monkeypatch.setattr(Download_gist.time, 'sleep', waits.append)
+    return(waits)
+
+def test_retry_backoff(httpserver, sleeps, tmp_path):
+    url = httpserver.url + '/flaky/a.bin'
+    assert dlstream(url, str(tmp_path), retries=3, backoff=1, extract=False) == \
+        (url, str(tmp_path / 'a.bin'), 'downloaded')
+    assert httpserver.hits['/flaky/a.bin'] == 3
+    assert sleeps == [1, 2] #backoff*2^attempt
+    assert (tmp_path / 'a.bin').read_bytes() == BODY
+    assert not (tmp_path / 'a.bin.part').exists()
+
+def test_retry_exhausted(httpserver, sleeps, tmp_path):
+    httpserver.flaky = 10
+    url = httpserver.url + '/flaky/b.bin'
+    assert dlstream(url, str(tmp_path), retries=2, backoff=3, extract=False) == (url, None, 'failed')
+    assert httpserver.hits['/flaky/b.bin'] == 3
+    assert sleeps == [3, 6]
+    assert not (tmp_path / 'b.bin').exists()
+
+def test_perhost_limit(httpserver, tmp_path):
+    #Two host names for the same server, each limited to perhost concurrent requests
+    httpserver.delay = 0.2
+    urllist = ['http://{0}:{1}/files/{2}.bin'.format(host, httpserver.port, i)
+               for i in range(6) for host in ['127.0.0.1', 'localhost']]
+    outfilelist = ['{0}_{1}'.format(i, host) for i in range(6) for host in ['ip', 'name']]
+    dlout = dlbatch(urllist, str(tmp_path), outfilelist=outfilelist, maxworkers=8, perhost=2, extract=False)
+    assert [status for url, out, status in dlout] == ['downloaded'] * 12
+    assert [url for url, out, status in dlout] == urllist
+    assert all(open(out, 'rb').read() == BODY for url, out, status in dlout)
+    assert sorted(httpserver.maxactive.values()) == [2, 2]
+    assert httpserver.maxtotal <= 4
+
+def test_missing_reported_separately(httpserver, sleeps, tmp_path, capsys):
+    urllist = [httpserver.url + path for path in ['/missing.bin', '/gone.bin', '/forbidden.bin', '/files/c.bin']]
+    dlout = dlbatch(urllist, str(tmp_path), extract=False)
+    assert [status for url, out, status in dlout] == ['missing', 'missing', 'failed', 'downloaded']
+    assert sleeps == [] #HTTP 4xx errors are not retried
+    lines = capsys.readouterr().out.splitlines()
+    assert '{0},{1} not found on server (HTTP 404/410)...'.format(urllist[0], urllist[1]) in lines
+    assert '{} failed to download...'.format(urllist[2]) in lines
@@ -0,0 +1,103 @@
+#Tests of smokefetchday and downloadsmoke (Download_gist.py) against a local HTTP server and a local mirror
+import os
+import gzip
+import threading
+import pytest
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from Download_gist import readjson, smokefetchday, downloadsmoke
+
+EXTLIST = ['shp', 'dbf', 'shx']
+
+def smokefiles(day, corrupt=False):
+    """Archive paths and content of the gzipped files of a day (YYYY/GIS/SMOKE/hms_smokeYYYYMMDD.ext.gz).
+    If corrupt, the .dbf.gz file is not gzip data"""
+    files = {}
+    for ext in EXTLIST:
+        body = gzip.compress('{0} {1}'.format(day, ext).encode('utf-8'))
+        if corrupt and ext == 'dbf':
+            body = b'<not gzip data>'
+        files['/{0}/GIS/SMOKE/hms_smoke{1}.{2}.gz'.format(day[0:4], day, ext)] = body
+    return(files)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    "Serves the files in server.files by path, 404 otherwise"
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.files.get(self.path)
+        self.send_response(404 if body is None else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body or b'')))
+        self.end_headers()
+        self.wfile.write(body or b'')
+
+@pytest.fixture
+def archive():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    server.files = {}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def writemirror(rootdir, files):
+    for path, body in files.items():
+        outfile = os.path.join(rootdir, *path.strip('/').split('/'))
+        if not os.path.exists(os.path.dirname(outfile)):
+            os.makedirs(os.path.dirname(outfile))
+        with open(outfile, 'wb') as f:
+            f.write(body)
+
+def test_corrupt_gzip(archive, tmp_path):
+    archive.files.update(smokefiles('20140101', corrupt=True))
+    archive.files.update(smokefiles('20140102'))
+    outdir = str(tmp_path / 'smoke')
+    manifest = downloadsmoke(outdir, startdate='2014-01-01', enddate='2014-01-02', baseurl=archive.url)
+    assert sorted(manifest) == ['20140102']
+    assert readjson(os.path.join(outdir, 'smoke_manifest.json'))['20140102']['status'] == 'complete'
+    assert not any(f.endswith('.part') or f.startswith('hms_smoke20140101.dbf') for f in os.listdir(outdir))
+    #Fixed on the server: the day is fetched again in the next run
+    archive.files.update(smokefiles('20140101'))
+    manifest = downloadsmoke(outdir, startdate='2014-01-01', enddate='2014-01-02', baseurl=archive.url)
+    assert manifest['20140101']['status'] == 'complete'
+    with open(os.path.join(outdir, 'hms_smoke20140101.dbf'), 'rb') as f:
+        assert f.read() == b'20140101 dbf'
+
+def test_mirror_corrupt_gzip(tmp_path):
+    #A corrupt file in a local mirror fails its day without aborting the synchronization
+    mirror = str(tmp_path / 'mirror')
+    writemirror(mirror, smokefiles('20140101', corrupt=True))
+    writemirror(mirror, smokefiles('20140102'))
+    outdir = str(tmp_path / 'smoke')
+    manifest = downloadsmoke(outdir, startdate='2014-01-01', enddate='2014-01-03', baseurl=mirror, recentdays=0)
+    assert manifest['20140102']['status'] == 'complete'
+    assert manifest['20140103']['status'] == 'missing'
+    assert '20140101' not in manifest
+    outfiles = sorted(f for f in os.listdir(outdir) if not f.endswith('.gz'))
+    assert outfiles == ['hms_smoke20140101.shp', 'hms_smoke20140101.shx', 'hms_smoke20140102.dbf',
+                        'hms_smoke20140102.shp', 'hms_smoke20140102.shx', 'smoke_manifest.json']
+
+def test_incomplete_day(tmp_path):
+    #A day is only complete once all its files are in the output directory
+    mirror = str(tmp_path / 'mirror')
+    writemirror(mirror, smokefiles('20140101'))
+    os.remove(os.path.join(mirror, '2014', 'GIS', 'SMOKE', 'hms_smoke20140101.shx.gz'))
+    outdir = tmp_path / 'smoke'
+    outdir.mkdir()
+    assert smokefetchday('20140101', str(outdir), mirror) == ('20140101', 'missing')
+    assert smokefetchday('20140101', str(outdir), mirror, extlist=EXTLIST[:2]) == ('20140101', 'complete')
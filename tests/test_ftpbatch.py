@@ -0,0 +1,125 @@
+#Tests of ftpfetch and ftpbatch (Download_gist.py) against a local FTP server
+import os
+import threading
+import pytest
+
+pyftpdlib = pytest.importorskip('pyftpdlib')
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+import Download_gist
+from Download_gist import ftpconnect, ftpfetch, ftpbatch
+
+BODY = bytes(bytearray(range(256))) * 400
+
+class RecordingHandler(FTPHandler):
+    """Records the commands received by the server. SIZE answers are offset by sizeoffset bytes to simulate a
+    download that does not match the remote size"""
+    commands = []
+    sizeoffset = 0
+
+    def pre_process_command(self, line, cmd, arg):
+        RecordingHandler.commands.append((cmd, arg))
+        return(FTPHandler.pre_process_command(self, line, cmd, arg))
+
+    def ftp_SIZE(self, path):
+        if RecordingHandler.sizeoffset:
+            return(self.respond('213 {}'.format(os.path.getsize(path) + RecordingHandler.sizeoffset)))
+        return(FTPHandler.ftp_SIZE(self, path))
+
+@pytest.fixture
+def ftpserver(tmp_path):
+    root = tmp_path / 'server'
+    (root / 'data').mkdir(parents=True)
+    for name in ['a.nc', 'b.nc', 'c.nc']:
+        (root / 'data' / name).write_bytes(BODY)
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(root))
+    RecordingHandler.authorizer = authorizer
+    RecordingHandler.commands = []
+    RecordingHandler.sizeoffset = 0
+    server = FTPServer(('127.0.0.1', 0), RecordingHandler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={'timeout': 0.1})
+    thread.daemon = True
+    thread.start()
+    server.host = '127.0.0.1:{}'.format(server.address[1])
+    yield server
+    server.close_all()
+    thread.join(5)
+
+@pytest.fixture
+def outdir(tmp_path):
+    out = tmp_path / 'out'
+    out.mkdir()
+    return(out)
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    "Record the waits between retries instead of sleeping"
+    waits = []
+    monkeypatch.setattr(Download_gist.time, 'sleep', waits.append)
+    return(waits)
+
+def test_ftpbatch(ftpserver, outdir):
+    dlout = ftpbatch(ftpserver.host, '/data', ['a.nc', 'b.nc', 'c.nc'], str(outdir), maxconnections=2)
+    assert [status for remotefile, out, status in dlout] == ['downloaded'] * 3
+    assert all((outdir / name).read_bytes() == BODY for name in ['a.nc', 'b.nc', 'c.nc'])
+    assert sorted(os.listdir(str(outdir))) == ['a.nc', 'b.nc', 'c.nc']
+    assert [cmd for cmd, arg in RecordingHandler.commands].count('USER') <= 2 #At most maxconnections, reused
+    #Complete files are checked against SIZE and not downloaded again
+    dlout = ftpbatch(ftpserver.host, '/data', ['a.nc', 'b.nc'], str(outdir))
+    assert [status for remotefile, out, status in dlout] == ['exists'] * 2
+    assert [cmd for cmd, arg in RecordingHandler.commands].count('RETR') == 3
+
+def test_resume_part(ftpserver, outdir):
+    (outdir / 'a.nc.part').write_bytes(BODY[:40000])
+    ftp = ftpconnect(ftpserver.host, '/data')
+    try:
+        assert ftpfetch(ftp, 'a.nc', str(outdir / 'a.nc')) == 'downloaded'
+    finally:
+        ftp.quit()
+    assert ('REST', '40000') in RecordingHandler.commands
+    assert (outdir / 'a.nc').read_bytes() == BODY
+    assert not (outdir / 'a.nc.part').exists()
+
+def test_resume_truncated(ftpserver, outdir):
+    #An existing file smaller than the remote SIZE is resumed from its end
+    (outdir / 'b.nc').write_bytes(BODY[:1000])
+    dlout = ftpbatch(ftpserver.host, '/data', ['b.nc'], str(outdir))
+    assert dlout[0][2] == 'downloaded'
+    assert ('REST', '1000') in RecordingHandler.commands
+    assert (outdir / 'b.nc').read_bytes() == BODY
+
+def test_part_larger_than_remote(ftpserver, outdir):
+    #A partial file larger than the remote file cannot be resumed and is downloaded again
+    (outdir / 'c.nc.part').write_bytes(BODY + b'extra')
+    dlout = ftpbatch(ftpserver.host, '/data', ['c.nc'], str(outdir))
+    assert dlout[0][2] == 'downloaded'
+    assert 'REST' not in [cmd for cmd, arg in RecordingHandler.commands]
+    assert (outdir / 'c.nc').read_bytes() == BODY
+
+def test_size_mismatch(ftpserver, outdir, sleeps):
+    #Downloads that do not match SIZE are retried (resuming from the partial file) then reported as failed
+    RecordingHandler.sizeoffset = 10
+    dlout = ftpbatch(ftpserver.host, '/data', ['a.nc'], str(outdir), retries=2, backoff=1)
+    assert dlout[0][2] == 'failed'
+    assert sleeps == [1, 2]
+    assert not (outdir / 'a.nc').exists()
+    assert (outdir / 'a.nc.part').read_bytes() == BODY #Kept to resume from it
+    assert ('REST', str(len(BODY))) in RecordingHandler.commands
+
+def test_missing_file(ftpserver, outdir, sleeps):
+    #Permanent errors (550) are not retried
+    dlout = ftpbatch(ftpserver.host, '/data', ['missing.nc', 'a.nc'], str(outdir), retries=2)
+    assert [status for remotefile, out, status in dlout] == ['failed', 'downloaded']
+    assert sleeps == []
+    assert not (outdir / 'missing.nc.part').exists()
+
+def test_downloadNARR_url(monkeypatch, tmp_path):
+    #Host and directory are parsed from the FTP URL
+    calls = []
+    monkeypatch.setattr(Download_gist, 'ftpbatch', lambda *args, **kwargs: calls.append(args))
+    Download_gist.downloadNARR('monolevel', 'air.2m', [2015, 2016], outdir=str(tmp_path))
+    assert calls == [('ftp.cdc.noaa.gov', '/Datasets/NARR/monolevel', ['air.2m.2015.nc', 'air.2m.2016.nc'],
+                      str(tmp_path))]
@@ -0,0 +1,33 @@
+#Tests of the weekly trip count of GTFStoDF.py on a small GTFS feed
+import pandas as pd
+import pytest
+
+from GTFStoDF import feedname, listgtfsfiles, readgtfsfeed, GTFStripcount
+
+@pytest.fixture
+def feed(tmp_path):
+    "Feed with two bus routes, one of which (r9) is referenced by a trip but missing from routes.txt"
+    tables = {
+        'routes.txt': 'route_id,agency_id,route_short_name,route_type\nr1,a,1,3\nr2,a,2,3\n',
+        'trips.txt': 'route_id,service_id,trip_id,shape_id\nr1,s1,t1,sh1\nr2,s1,t2,sh2\nr9,s1,t3,sh3\n',
+        'calendar.txt': 'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+                        's1,1,1,1,1,1,0,0,20180101,20301231\n'}
+    feeddir = tmp_path / 'feed-A'
+    feeddir.mkdir()
+    for name, text in tables.items():
+        (feeddir / name).write_text(text)
+    return(str(feeddir))
+
+def test_feedname(feed):
+    assert feedname(feed) == 'feed_A'
+
+def test_route_type_missing_route(feed):
+    #route_type is kept as '3' (not '3.0') for all trips when some trips have no route
+    agency = feedname(feed)
+    tripcount = GTFStripcount(readgtfsfeed(feed, listgtfsfiles(feed), agency), agency, current=False). \
+        set_index('route_id')
+    assert tripcount.loc['r1', 'route_type'] == '3'
+    assert tripcount.loc['r2', 'route_type'] == '3'
+    assert tripcount.loc['r9', 'route_type'] == 'None'
+    assert (tripcount['adjustnum_SUM'] == 5).all()
+    assert sorted(tripcount[tripcount['route_type'] == '3']['shape_id']) == ['sh1', 'sh2']
@@ -0,0 +1,52 @@
+#Tests of the GeoParquet smoke dataset written by HMStoDF.smoketoparquet
+import os
+import json
+import geopandas as gpd
+import pyarrow.parquet as pq
+from shapely.geometry import box
+
+from HMStoDF import smoketoparquet, readsmoke
+
+def writesmokefile(smokedir, day, polygons):
+    "Daily HMS smoke shapefile (hms_smokeYYYYMMDD.shp) with text fields and Density with padding spaces"
+    gdf = gpd.GeoDataFrame({'ID': [str(i) for i in range(len(polygons))],
+                            'Satellite': ['GOES-E'] + [None] * (len(polygons) - 1),
+                            'Start': ['2014001 1200'] * len(polygons),
+                            'End': ['2014001 1800'] * len(polygons),
+                            'Density': [' 5.000'] * len(polygons)},
+                           geometry=polygons, crs='EPSG:4326')
+    gdf.to_file(os.path.join(smokedir, 'hms_smoke{}.shp'.format(day)))
+
+def test_geoparquet(tmp_path):
+    smokedir = str(tmp_path / 'smoke')
+    os.mkdir(smokedir)
+    writesmokefile(smokedir, '20140101', [box(-120, 40, -119, 41), box(-100, 30, -98, 33)])
+    writesmokefile(smokedir, '20140102', [box(-90, 35, -89, 36)])
+    writesmokefile(smokedir, '20150101', [box(-80, 25, -79, 26)])
+    outdir = str(tmp_path / 'smokepq')
+    smokeindex = smoketoparquet(smokedir, outdir, maxworkers=2)
+    assert sorted(smokeindex) == ['2014', '2015']
+    assert smokeindex['2014']['bbox'] == [-120.0, 30.0, -89.0, 41.0]
+
+    #Partitions are GeoParquet files readable without readsmoke
+    outfile = os.path.join(outdir, 'year=2014', 'smoke.parquet')
+    geo = json.loads(pq.read_schema(outfile).metadata[b'geo'])
+    assert geo['primary_column'] == 'geometry'
+    assert geo['columns']['geometry']['encoding'] == 'WKB'
+    assert geo['columns']['geometry']['geometry_types'] == ['Polygon']
+    assert geo['columns']['geometry']['bbox'] == [-120.0, 30.0, -89.0, 41.0]
+    gdf = gpd.read_parquet(outfile)
+    assert gdf.crs.equals('OGC:CRS84') or gdf.crs.to_epsg() == 4326
+    assert len(gdf) == 3
+    assert gdf.geometry.iloc[0].equals(box(-120, 40, -119, 41))
+    assert list(gdf['Density']) == [5.0] * 3
+    assert gdf['Satellite'].isnull().sum() == 1
+
+    #Spatial and date queries
+    assert len(readsmoke(outdir, bbox=(-121, 39, -118, 42))) == 1
+    assert len(readsmoke(outdir, startdate='2014-01-02')) == 2
+
+    #Unchanged partitions are not rewritten
+    mtime = os.path.getmtime(outfile)
+    smoketoparquet(smokedir, outdir)
+    assert os.path.getmtime(outfile) == mtime
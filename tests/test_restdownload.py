@@ -0,0 +1,172 @@
+#Tests of RESTdownload (Download_gist.py) against a mock ArcGIS REST FeatureServer layer
+import json
+import re
+import threading
+import collections
+import pytest
+import pandas as pd
+import geopandas as gpd
+from shapely import wkb
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+from Download_gist import RESTdownload
+
+#Sparse object IDs, served in reverse order by returnIdsOnly
+OIDS = [i * 3 + 1 for i in range(237)]
+FIELDS = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'},
+          {'name': 'name', 'type': 'esriFieldTypeString'},
+          {'name': 'val', 'type': 'esriFieldTypeDouble'},
+          {'name': 'd', 'type': 'esriFieldTypeDate'},
+          {'name': 'Shape', 'type': 'esriFieldTypeGeometry'}]
+
+def mockfeature(oid):
+    "Square polygon (clockwise exterior ring) with a square hole (counter-clockwise ring)"
+    x = float(oid)
+    return({'attributes': {'OBJECTID': oid, 'name': 'f{}'.format(oid), 'val': oid / 2.0,
+                           'd': 1546300800000 + oid * 86400000},
+            'geometry': {'rings': [[[x, 0], [x, 1], [x + 1, 1], [x + 1, 0], [x, 0]],
+                                   [[x + .2, .2], [x + .8, .2], [x + .8, .8], [x + .2, .8], [x + .2, .2]]]}})
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FeatureServerHandler(BaseHTTPRequestHandler):
+    """Answers layer description, returnIdsOnly, outStatistics and OBJECTID range queries.
+    The behaviour of the layer is set by the server's cfg dictionary:
+    maxrec: maxRecordCount, larger queries are truncated with exceededTransferLimit
+    failbig: queries of more features than failbig return an error in the JSON body
+    idsok: whether returnIdsOnly queries succeed
+    badoid: object ID for which queries return HTTP 500"""
+    def log_message(self, *args):
+        pass
+
+    def sendjson(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        q = {k: v[0] for k, v in parse_qs(body).items()}
+        cfg = self.server.cfg
+        counts = self.server.counts
+        if not urlparse(self.path).path.endswith('/query'):
+            return(self.sendjson({'objectIdField': 'OBJECTID', 'maxRecordCount': cfg['maxrec'], 'fields': FIELDS,
+                                  'extent': {'spatialReference': {'wkid': 102100, 'latestWkid': 3857}}}))
+        if q.get('returnIdsOnly') == 'true':
+            counts['ids'] += 1
+            if not cfg['idsok']:
+                return(self.sendjson({'error': {'code': 400, 'message': 'Unable to complete operation'}}))
+            return(self.sendjson({'objectIdFieldName': 'OBJECTID', 'objectIds': OIDS[::-1]}))
+        if 'outStatistics' in q:
+            counts['stats'] += 1
+            return(self.sendjson({'features': [{'attributes': {'OIDMIN': min(OIDS), 'OIDMAX': max(OIDS)}}]}))
+
+        lo, hi = [int(x) for x in re.search(r'OBJECTID >= (\d+)\) AND \(OBJECTID <= (\d+)', q['where']).groups()]
+        sel = [oid for oid in OIDS if lo <= oid <= hi]
+        counts['pages'] += 1
+        if cfg['badoid'] in sel:
+            return(self.sendjson({}, code=500))
+        if len(sel) > cfg['failbig']:
+            return(self.sendjson({'error': {'code': 500, 'message': 'Error performing query operation'}}))
+        features = [mockfeature(oid) for oid in sel[:cfg['maxrec']]]
+        if q.get('returnGeometry') == 'false':
+            for f in features:
+                f.pop('geometry')
+        return(self.sendjson({'features': features, 'exceededTransferLimit': len(sel) > cfg['maxrec']}))
+
+@pytest.fixture
+def featureserver():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeatureServerHandler)
+    server.cfg = {'maxrec': 1000, 'failbig': 1000, 'idsok': True, 'badoid': None}
+    server.counts = collections.Counter()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:{}/arcgis/rest/services/Test/FeatureServer/0/query'.format(server.server_address[1])
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def readparquet(outfile):
+    df = pd.read_parquet(outfile)
+    df['geometry'] = [wkb.loads(bytes(g)) for g in df['geometry']]
+    return(df)
+
+def test_windows_parquet(featureserver, tmp_path):
+    outfile = str(tmp_path / 'layer.parquet')
+    failed = RESTdownload(featureserver.url, outfile, itersize=50, backoff=0)
+    assert failed == []
+    assert featureserver.counts['ids'] == 1
+    assert featureserver.counts['pages'] == 5 #237 features in windows of 50
+    df = readparquet(outfile)
+    assert sorted(df['OBJECTID']) == OIDS
+    assert not (tmp_path / 'layer_part.parquet').exists()
+    #Types and values
+    row = df.set_index('OBJECTID').loc[4]
+    assert row['name'] == 'f4' and row['val'] == 2.0
+    assert row['d'] == pd.Timestamp('2019-01-05')
+    assert row['geometry'].geom_type == 'Polygon'
+    assert len(row['geometry'].interiors) == 1
+    assert abs(row['geometry'].area - 0.64) < 1e-9
+
+def test_bisection(featureserver, tmp_path):
+    #Truncated (exceededTransferLimit) and failed (error in JSON body) windows are split in two
+    featureserver.cfg.update({'maxrec': 20, 'failbig': 30})
+    outfile = str(tmp_path / 'layer.parquet')
+    failed = RESTdownload(featureserver.url, outfile, itersize=50, backoff=0)
+    assert failed == []
+    assert featureserver.counts['pages'] > 5
+    df = readparquet(outfile)
+    assert sorted(df['OBJECTID']) == OIDS #No duplicates from truncated windows
+
+def test_bisection_single_feature(featureserver, tmp_path):
+    #A feature that cannot be downloaded is bisected down to a single-feature window and reported
+    featureserver.cfg['badoid'] = 100
+    outfile = str(tmp_path / 'layer.parquet')
+    failed = RESTdownload(featureserver.url, outfile, itersize=50, retries=0, backoff=0)
+    assert failed == [(100, 100, None)]
+    assert sorted(readparquet(outfile)['OBJECTID']) == [oid for oid in OIDS if oid != 100]
+
+def test_oidrange_fallback(featureserver, tmp_path):
+    #Without returnIdsOnly, windows span the range of object IDs (sparse, so counts are unknown)
+    featureserver.cfg['idsok'] = False
+    outfile = str(tmp_path / 'layer.csv')
+    failed = RESTdownload(featureserver.url, outfile, itersize=100, backoff=0)
+    assert failed == []
+    assert featureserver.counts['stats'] == 1
+    df = pd.read_csv(outfile)
+    assert sorted(df['OBJECTID']) == OIDS
+    assert 'geometry' not in df.columns
+
+def test_gpkg(featureserver, tmp_path):
+    outfile = str(tmp_path / 'layer.gpkg')
+    failed = RESTdownload(featureserver.url, outfile, itersize=60, maxworkers=2, backoff=0)
+    assert failed == []
+    gdf = gpd.read_file(outfile, layer='layer')
+    assert sorted(gdf['OBJECTID']) == OIDS
+    assert gdf.crs.to_epsg() == 3857
+    assert all(len(g.interiors) == 1 for g in gdf.geometry)
+
+def test_gpkg_without_geometry(featureserver, tmp_path):
+    #Tables cannot be written to a GeoPackage, the error is raised before any request
+    with pytest.raises(ValueError):
+        RESTdownload(featureserver.url, str(tmp_path / 'table.gpkg'), geometry=False)
+    assert sum(featureserver.counts.values()) == 0
+    assert not (tmp_path / 'table.gpkg').exists()
+    #Same table as parquet
+    outfile = str(tmp_path / 'table.parquet')
+    assert RESTdownload(featureserver.url, outfile, geometry=False, itersize=100, backoff=0) == []
+    df = pd.read_parquet(outfile)
+    assert sorted(df['OBJECTID']) == OIDS
+    assert 'geometry' not in df.columns